@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+画像アーカイブの書き出し（CBZ・マルチページTIFF・WebPのCBZ）
+PdfWriter と同じインターフェース（add_encoded_page / add_shared_page / has_image / close / abort）で
+エンコード済みのページをアーカイブに1ページずつ書き出すため、キャプチャのパイプラインや
+保存した画像からの並列エンコードをそのまま使える。
+
+エンコード済みのストリームはできるだけそのままコピーし、デコード・再エンコードはしない。
+- cbz:  JPEGはそのまま .jpg として無圧縮（stored）のZIPに入れる。可逆圧縮（PNGの予測付きFlate）の
+        ストリームはPNGのチャンクで包み直す。白黒（CCITT G4・Flate）のページは
+        CBZのビューアーが読めないため、1ビットのPNGに変換する
+- tiff: JPEG（compression 7）・CCITT G4（compression 4）・Flate（compression 8）のストリームを
+        そのままTIFFのストリップにする。内容が同じページは同じストリップを参照する。
+        TIFFにはPNGの予測がないため、可逆圧縮のページだけはデコードして予測なしのFlateにする
+- webp: ページをWebPにエンコードし（page_encoder、並列エンコードの段階で行う）、.webp としてCBZに入れる
+"""
+
+import io
+import os
+import struct
+import zipfile
+
+from pdf_writer import EncodedImage, PdfWriter
+
+FORMATS = ('pdf', 'cbz', 'tiff', 'webp')
+
+# 出力形式ごとのファイルの拡張子
+EXTENSIONS = {
+    'pdf': '.pdf',
+    'cbz': '.cbz',
+    'tiff': '.tif',
+    'webp': '.cbz',
+}
+
+# ストリームの形式ごとのCBZのページの拡張子（それ以外はPNGに変換する）
+_CBZ_EXTENSIONS = {
+    'DCTDecode': 'jpg',
+    'WebP': 'webp',
+}
+
+
+def create_writer(path, output_format='pdf', resolution=100.0, append=False, linearize=False):
+    """出力形式のライターを作る（PDF以外は追記・線形化できない）"""
+    if output_format == 'pdf':
+        return PdfWriter(path, resolution=resolution, append=append, linearize=linearize)
+    if append:
+        raise ValueError(f"{path} には追記できません（追記できるのはPDFのみです）")
+    if output_format == 'tiff':
+        return TiffWriter(path, resolution)
+    if output_format in ('cbz', 'webp'):
+        return CbzWriter(path, resolution)
+    raise ValueError(f"未対応の出力形式です: {output_format}")
+
+
+def output_path_for(path, output_format):
+    """出力ファイル名に出力形式の拡張子がなければ付ける"""
+    extension = EXTENSIONS[output_format]
+    if output_format == 'tiff' and path.lower().endswith('.tiff'):
+        return path
+    return path if path.lower().endswith(extension) else path + extension
+
+
+class ArchiveWriter:
+    """ページ画像のアーカイブに書き出すライターの基底クラス"""
+
+    def __init__(self, path, resolution=100.0):
+        self.path = str(path)
+        self.resolution = resolution
+        self._closed = False
+        self._pages = 0
+        # キー -> 書き出し済みのページの情報（_write_page の戻り値）
+        self._shared = {}
+        self.shared_pages = 0
+        self.shared_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    @property
+    def page_count(self):
+        return self._pages
+
+    def has_image(self, key):
+        """キーが一致する画像を書き出し済みか"""
+        return key in self._shared
+
+    def add_shared_page(self, key):
+        """書き出し済みの画像（キーで指定）のページを追加"""
+        if self._closed:
+            raise RuntimeError("ファイルは既に閉じられています")
+        self._pages += 1
+        self.shared_bytes += self._write_shared_page(self._shared[key])
+        self.shared_pages += 1
+
+    def add_encoded_page(self, encoded, key=None):
+        """エンコード済みの画像データを1ページとして書き出す
+
+        key を指定した場合、同じキーの画像を書き出し済みならそれを使う。
+        """
+        if key is not None and key in self._shared:
+            self.add_shared_page(key)
+            return
+        if self._closed:
+            raise RuntimeError("ファイルは既に閉じられています")
+        self._pages += 1
+        page = self._write_page(encoded)
+        if key is not None:
+            self._shared[key] = page
+
+    def _write_page(self, encoded):
+        raise NotImplementedError
+
+    def _write_shared_page(self, page):
+        """書き出し済みのページをもう一度追加し、節約したバイト数を返す"""
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._finish()
+
+    def abort(self):
+        """書きかけのファイルを閉じて削除"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._finish()
+        finally:
+            os.remove(self.path)
+
+
+class CbzWriter(ArchiveWriter):
+    """ページ画像を無圧縮のZIP（CBZ）に書き出すライター"""
+
+    def __init__(self, path, resolution=100.0):
+        super().__init__(path, resolution)
+        self._zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED)
+        self._reader = None
+
+    def _page_name(self, extension):
+        return f"{self._pages:04d}.{extension}"
+
+    def _write_page(self, encoded):
+        extension = _CBZ_EXTENSIONS.get(encoded.filter)
+        data = png_file(encoded)
+        if data is not None:
+            extension = 'png'
+        elif extension is None:
+            extension = 'png'
+            buf = io.BytesIO()
+            decode_stream(encoded).save(buf, 'PNG')
+            data = buf.getvalue()
+        elif extension != 'png':
+            data = encoded.data
+        name = self._page_name(extension)
+        self._zip.writestr(zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0)), data)
+        return (self._zip.getinfo(name), extension)
+
+    def _write_shared_page(self, page):
+        # ZIPには同じデータを参照させられないため、書き出し済みのページを読み直して追加する
+        info, extension = page
+        self._zip.fp.flush()
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        self._reader.seek(info.header_offset)
+        header = self._reader.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        self._reader.seek(info.header_offset + 30 + name_length + extra_length)
+        data = self._reader.read(info.file_size)
+        self._zip.writestr(zipfile.ZipInfo(self._page_name(extension), (1980, 1, 1, 0, 0, 0)),
+                           data)
+        return 0
+
+    def _finish(self):
+        if self._reader is not None:
+            self._reader.close()
+        self._zip.close()
+
+
+# TIFFのタグの型
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+
+# TIFFのIFDのうち、次のIFDの位置を書く場所（ヘッダーでは4バイト目）
+_HEADER_NEXT = 4
+
+
+class TiffWriter(ArchiveWriter):
+    """エンコード済みのストリームをそのままストリップにしたマルチページTIFFのライター
+
+    ページごとに、ストリップ・IFDの順に追記し、前のページのIFDから次のIFDを指す。
+    """
+
+    def __init__(self, path, resolution=100.0):
+        super().__init__(path, resolution)
+        self._fp = open(self.path, 'wb')
+        self._fp.write(b'II*\x00\x00\x00\x00\x00')
+        self._next_pointer = _HEADER_NEXT
+
+    def _write_page(self, encoded):
+        if encoded.filter == 'FlateDecode' and encoded.decode_parms:
+            encoded = _plain_flate(encoded)
+        tags = tiff_tags(encoded, self.resolution)
+        strip = (self._fp.tell(), len(encoded.data))
+        self._fp.write(encoded.data)
+        if self._fp.tell() % 2:
+            self._fp.write(b'\x00')
+        self._write_ifd(tags, strip)
+        return (tags, strip)
+
+    def _write_shared_page(self, page):
+        tags, strip = page
+        self._write_ifd(tags, strip)
+        return strip[1]
+
+    def _write_ifd(self, tags, strip):
+        offset = self._fp.tell()
+        if offset + strip[1] >= 1 << 32:
+            raise ValueError("TIFFの大きさの上限（4GB）を超えます")
+        ifd, next_pointer = _ifd_bytes(tags, strip, offset)
+        self._fp.write(ifd)
+        # 前のIFD（最初のページはヘッダー）から、このIFDを指す
+        self._fp.seek(self._next_pointer)
+        self._fp.write(struct.pack('<I', offset))
+        self._fp.seek(0, os.SEEK_END)
+        self._next_pointer = next_pointer
+        self._fp.flush()
+
+    def _finish(self):
+        self._fp.close()
+
+
+def tiff_tags(encoded, resolution=100.0):
+    """エンコード済みのストリームをそのままストリップにするTIFFのタグ（ストリップの位置・長さを除く）
+
+    タグ番号 -> (型, 値のリスト) の辞書を返す。
+    """
+    width, height = encoded.size
+    samples = 3 if encoded.colorspace == 'DeviceRGB' else 1
+    tags = {
+        256: (_LONG, [width]),
+        257: (_LONG, [height]),
+        258: (_SHORT, [encoded.bits] * samples),
+        277: (_SHORT, [samples]),
+        278: (_LONG, [height]),
+        296: (_SHORT, [2]),
+    }
+    dpi = resolution * encoded.scale
+    tags[282] = tags[283] = (_RATIONAL, [(round(dpi * 1000), 1000)])
+    if encoded.filter == 'DCTDecode':
+        tags[259] = (_SHORT, [7])
+        if samples == 3:
+            # JPEGはYCbCrで保存されているため、色差の間引きの比をJPEGのヘッダーから読む
+            tags[262] = (_SHORT, [6])
+            tags[530] = (_SHORT, list(jpeg_subsampling(encoded.data)))
+        else:
+            tags[262] = (_SHORT, [1])
+    elif encoded.filter == 'CCITTFaxDecode':
+        tags[259] = (_SHORT, [4])
+        # Pillowの group4 と同じく BlackIsZero（PDFでは /BlackIs1 true）
+        tags[262] = (_SHORT, [1])
+    elif encoded.filter == 'FlateDecode' and not encoded.decode_parms:
+        tags[259] = (_SHORT, [8])
+        tags[262] = (_SHORT, [2 if samples == 3 else 1])
+    else:
+        raise ValueError(f"{encoded.filter} のストリームはTIFFに入れられません")
+    return tags
+
+
+def _ifd_bytes(tags, strip, offset):
+    """offset に置くIFDのバイト列と、次のIFDの位置を書く場所を返す"""
+    tags = dict(tags)
+    tags[273] = (_LONG, [strip[0]])
+    tags[279] = (_LONG, [strip[1]])
+    entries = sorted(tags.items())
+    next_pointer = offset + 2 + len(entries) * 12
+    extra_offset = next_pointer + 4
+    table = [struct.pack('<H', len(entries))]
+    extra = []
+    for tag, (tag_type, values) in entries:
+        if tag_type == _RATIONAL:
+            value = b''.join(struct.pack('<II', *fraction) for fraction in values)
+        else:
+            value = struct.pack('<%d%s' % (len(values), 'H' if tag_type == _SHORT else 'I'),
+                                *values)
+        if len(value) <= 4:
+            table.append(struct.pack('<HHI', tag, tag_type, len(values)) + value.ljust(4, b'\x00'))
+        else:
+            table.append(struct.pack('<HHII', tag, tag_type, len(values), extra_offset))
+            extra.append(value)
+            extra_offset += len(value)
+    table.append(b'\x00\x00\x00\x00')
+    return b''.join(table + extra), next_pointer
+
+
+def jpeg_subsampling(data):
+    """JPEGの輝度の間引きの比（TIFFの YCbCrSubSampling、横, 縦）"""
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            break
+        marker = data[position + 1]
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            components = data[position + 9]
+            if components == 3:
+                factors = [data[position + 11 + index * 3] for index in range(3)]
+                luma = factors[0]
+                chroma = factors[1]
+                return ((luma >> 4) // max(chroma >> 4, 1), (luma & 0x0F) // max(chroma & 0x0F, 1))
+            break
+        position += 2 + length
+    return (1, 1)
+
+
+def _png_parameters(encoded):
+    """PNGの予測付きFlateのストリームなら (色数, ビット数, 幅) を返す（それ以外はNone）"""
+    import re
+
+    if encoded.filter != 'FlateDecode' or not encoded.decode_parms:
+        return None
+    values = dict(re.findall(rb'/(\w+)\s+(\d+)', encoded.decode_parms))
+    if int(values.get(b'Predictor', 1)) < 10:
+        return None
+    return (int(values.get(b'Colors', 1)), int(values.get(b'BitsPerComponent', 8)),
+            int(values.get(b'Columns', encoded.size[0])))
+
+
+def png_file(encoded):
+    """PNGの予測付きFlateのストリームを、デコードせずにPNGファイルにする（できなければNone）"""
+    import zlib
+
+    parameters = _png_parameters(encoded)
+    if parameters is None or parameters[0] not in (1, 3):
+        return None
+    colors, bits, width = parameters
+
+    def chunk(chunk_type, body):
+        return (struct.pack('>I', len(body)) + chunk_type + body
+                + struct.pack('>I', zlib.crc32(body, zlib.crc32(chunk_type))))
+
+    header = struct.pack('>IIBBBBB', width, encoded.size[1], bits, 2 if colors == 3 else 0,
+                         0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', encoded.data)
+            + chunk(b'IEND', b''))
+
+
+def _plain_flate(encoded):
+    """予測付きFlateのストリームを、予測なしのFlate（TIFFの compression 8）にし直す"""
+    import zlib
+
+    img = decode_stream(encoded)
+    if img.mode not in ('1', 'L', 'RGB'):
+        img = img.convert('RGB')
+    return EncodedImage(img.size, 'DeviceRGB' if img.mode == 'RGB' else 'DeviceGray',
+                        1 if img.mode == '1' else 8, 'FlateDecode', zlib.compress(img.tobytes(), 6),
+                        scale=encoded.scale)
+
+
+def decode_stream(encoded):
+    """エンコード済みのストリームをPIL画像に戻す（CBZに入れられない形式の変換用）"""
+    import zlib
+
+    from PIL import Image
+
+    if encoded.filter in ('DCTDecode', 'WebP'):
+        return Image.open(io.BytesIO(encoded.data))
+    png = png_file(encoded)
+    if png is not None:
+        return Image.open(io.BytesIO(png))
+    if encoded.filter == 'CCITTFaxDecode':
+        # ストリップが1つのTIFFとして読む（IFDは偶数の位置に置く）
+        strip = encoded.data + b'\x00' * (len(encoded.data) % 2)
+        ifd, _ = _ifd_bytes(tiff_tags(encoded), (8, len(encoded.data)), 8 + len(strip))
+        tiff = b'II*\x00' + struct.pack('<I', 8 + len(strip)) + strip + ifd
+        img = Image.open(io.BytesIO(tiff))
+        img.load()
+        return img
+    if encoded.filter == 'FlateDecode' and not encoded.decode_parms:
+        mode = '1' if encoded.bits == 1 else ('RGB' if encoded.colorspace == 'DeviceRGB' else 'L')
+        return Image.frombytes(mode, encoded.size, zlib.decompress(encoded.data))
+    raise ValueError(f"{encoded.filter} のストリームは変換できません")
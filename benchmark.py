@@ -0,0 +1,1228 @@
+#!/usr/bin/env python3
+"""
+Kindle to PDF ベンチマーク
+macOSやKindleアプリがなくても実行できるよう、合成ページ画像を使って計測する。
+
+使い方:
+    python benchmark.py pdf --pages 10 50 100
+    python benchmark.py pipeline --pages 20 --delay 0.2
+    python benchmark.py settle --pages 30
+    python benchmark.py turner --count 50
+    python benchmark.py fingerprint
+    python benchmark.py trim --pages 20
+    python benchmark.py encode --pages 20
+    python benchmark.py jobs --pages 48 --jobs 1 2 4 8
+    python benchmark.py append --pages 700 --tail 30
+    python benchmark.py suite --pages 30
+    python benchmark.py trace --count 100000
+    python benchmark.py dedup --pages 40
+    python benchmark.py profile --pages 20
+    python benchmark.py classify --pages 40
+    python benchmark.py queue --books 3 --pages 20
+    python benchmark.py spool --pages 30
+    python benchmark.py linearize --pages 300
+    python benchmark.py rebuild --pages 60 --jobs 4
+    python benchmark.py replay --session session.zip
+    python benchmark.py formats --pages 30 --jobs 4
+    python benchmark.py png --pages 50
+    python benchmark.py target --pages 60 --target-size 3MB --jobs 4
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic_book import (draw_synthetic_illustration, draw_synthetic_page,
+                            draw_synthetic_window)
+
+
+def make_synthetic_pages(image_dir, count, size=(1600, 2400)):
+    """ベンチマーク用の合成ページ画像（PNG）を作成"""
+    image_dir = Path(image_dir)
+    for page_num in range(1, count + 1):
+        draw_synthetic_page(page_num, size).save(image_dir / f"page_{page_num:04d}.png")
+    return sorted(image_dir.glob("page_*.png"))
+
+
+def _peak_rss_mb():
+    """現在のプロセスのピークRSS（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト単位、Linuxはキロバイト単位
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def _legacy_images_to_pdf(image_files, output_path):
+    """比較用: 全ページをメモリに読み込んでから保存する従来の方式"""
+    from PIL import Image
+
+    images = []
+    for img_path in image_files:
+        img = Image.open(img_path)
+        if img.mode == 'RGBA':
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            rgb_img.paste(img, mask=img.split()[3])
+            images.append(rgb_img)
+        else:
+            images.append(img.convert('RGB'))
+
+    if images:
+        images[0].save(
+            output_path,
+            save_all=True,
+            append_images=images[1:],
+            resolution=100.0
+        )
+
+
+def _run_pdf_case(method, image_dir, output_path, result_queue):
+    """子プロセスでPDF作成を1回実行し、時間とピークメモリを返す"""
+    from pdf_writer import write_pdf
+
+    image_files = sorted(Path(image_dir).glob("page_*.png"))
+    start = time.perf_counter()
+    if method == 'legacy':
+        _legacy_images_to_pdf(image_files, output_path)
+    else:
+        write_pdf(image_files, output_path)
+    elapsed = time.perf_counter() - start
+    result_queue.put((elapsed, _peak_rss_mb()))
+
+
+def run_isolated(target, *args):
+    """計測対象を別プロセスで実行し、結果を受け取る"""
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=target, args=args + (result_queue,))
+    proc.start()
+    result = result_queue.get()
+    proc.join()
+    return result
+
+
+def bench_pdf(args):
+    """従来方式とストリーミング方式のPDF作成を比較"""
+    print(f"{'ページ数':>8} {'方式':>10} {'時間(秒)':>10} {'ピークRSS(MB)':>14} {'サイズ(MB)':>11}")
+    for count in args.pages:
+        with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+            image_dir = Path(temp_dir)
+            make_synthetic_pages(image_dir, count, size=tuple(args.size))
+            for method in args.methods:
+                output_path = image_dir / f"{method}.pdf"
+                elapsed, peak = run_isolated(
+                    _run_pdf_case, method, str(image_dir), str(output_path))
+                size_mb = output_path.stat().st_size / (1024 * 1024)
+                print(f"{count:>8} {method:>10} {elapsed:>10.2f} {peak:>14.1f} {size_mb:>11.2f}")
+
+
+def bench_pipeline(args):
+    """逐次処理とパイプライン処理のキャプチャループを比較"""
+    import hashlib
+
+    from capture_pipeline import CapturePipeline
+    from frame import Frame
+
+    frames = [Frame.from_image(draw_synthetic_page(n, tuple(args.size))) for n in range(1, 4)]
+    print(f"{'方式':>10} {'ページ数':>8} {'合計(秒)':>10} {'1ページ(秒)':>12}")
+    for method in ('sequential', 'pipelined'):
+        with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+            image_dir = Path(temp_dir)
+            start = time.perf_counter()
+            if method == 'sequential':
+                for page_num in range(1, args.pages + 1):
+                    img = frames[page_num % len(frames)].to_image()
+                    img.save(image_dir / f"page_{page_num:04d}.png", 'PNG')
+                    hashlib.md5(img.tobytes()).hexdigest()
+                    time.sleep(args.delay)
+            else:
+                with CapturePipeline(workers=args.workers) as pipeline:
+                    for page_num in range(1, args.pages + 1):
+                        pipeline.submit(page_num, frames[page_num % len(frames)])
+                        pipeline.completed()
+                        time.sleep(args.delay)
+                    pipeline.drain()
+            elapsed = time.perf_counter() - start
+            print(f"{method:>10} {args.pages:>8} {elapsed:>10.2f} {elapsed / args.pages:>12.3f}")
+
+
+def bench_settle(args):
+    """固定待機と描画完了検出のページ送りを、描画遅延を再現したシミュレーターで比較"""
+    from page_settle import PageSettler
+    from simulated_kindle import SimulatedKindle, random_latency
+
+    pages = [draw_synthetic_page(n, tuple(args.size)) for n in range(1, args.pages + 1)]
+    print(f"{'方式':>10} {'合計(秒)':>10} {'撮影数':>8} {'欠落':>6} {'重複':>6} {'描きかけ':>8} {'再送':>6}")
+    for method in ('fixed', 'adaptive'):
+        kindle = SimulatedKindle(pages, render_latency=random_latency(
+            mean=args.latency, slow_rate=args.slow_rate, seed=args.seed))
+        captured = []
+        retries = 0
+        start = time.perf_counter()
+        if method == 'fixed':
+            # 自動検出モードと同じく、同じページが3回続くまで撮影して重複分を除く
+            same_count = 0
+            while same_count < 3:
+                captured.append(kindle.page_of(kindle.grab()))
+                if len(captured) > 1 and captured[-1] == captured[-2]:
+                    same_count += 1
+                else:
+                    same_count = 0
+                kindle.turn_page()
+                time.sleep(args.delay)
+            del captured[-same_count:]
+        else:
+            settler = PageSettler(sample=kindle.grab, turn_page=kindle.turn_page,
+                                  max_wait=args.max_wait)
+            settler.reset()
+            while True:
+                captured.append(kindle.page_of(kindle.grab()))
+                if not settler.next_page():
+                    break
+            retries = settler.turn_retries
+        elapsed = time.perf_counter() - start
+        pages_seen = [index for index in captured if index is not None]
+        missed = args.pages - len(set(pages_seen))
+        duplicated = len(pages_seen) - len(set(pages_seen))
+        partial = len(captured) - len(pages_seen)
+        print(f"{method:>10} {elapsed:>10.2f} {len(captured):>8} {missed:>6} {duplicated:>6} {partial:>8} {retries:>6}")
+
+
+def bench_turner(args):
+    """ページ送りドライバーごとの1回あたりの遅延とスループットを計測"""
+    from page_turner import StandInPageTurner
+
+    print(f"{'方式':>12} {'回数':>6} {'平均(ミリ秒)':>12} {'回/秒':>8}")
+    for label, persistent in (('spawn', False), ('persistent', True)):
+        with StandInPageTurner(persistent=persistent) as turner:
+            turner.activate()
+            start = time.perf_counter()
+            for _ in range(args.count):
+                turner.next_page()
+            elapsed = time.perf_counter() - start
+        print(f"{label:>12} {args.count:>6} {elapsed / args.count * 1000:>12.2f} {args.count / elapsed:>8.1f}")
+
+
+def bench_fingerprint(args):
+    """ページの同一判定にかかる時間を、従来のPNG再読み込み+MD5と比較"""
+    import hashlib
+
+    from PIL import Image
+
+    from fingerprint import fingerprint_frame
+    from frame import Frame
+
+    frame = Frame.from_image(draw_synthetic_page(1, tuple(args.size)))
+
+    def legacy_hash(path):
+        # 従来の get_image_hash: 保存したPNGを読み直してフル解像度のMD5を取る
+        with Image.open(path) as img:
+            return hashlib.md5(img.tobytes()).hexdigest()
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        path = Path(temp_dir) / "page_0001.png"
+        frame.to_image().save(path, 'PNG')
+        cases = (
+            ('png+md5', lambda: legacy_hash(path)),
+            ('md5', lambda: hashlib.md5(frame.to_image().tobytes()).hexdigest()),
+            ('fingerprint', lambda: fingerprint_frame(frame)),
+        )
+        print(f"{'方式':>12} {'1回(ミリ秒)':>12}")
+        for label, func in cases:
+            start = time.perf_counter()
+            for _ in range(args.count):
+                func()
+            elapsed = time.perf_counter() - start
+            print(f"{label:>12} {elapsed / args.count * 1000:>12.2f}")
+
+
+def bench_trim(args):
+    """ツールバー・余白の自動トリミングによるPDFサイズと作成時間の変化を計測"""
+    from pdf_writer import PdfWriter, add_image_files
+    from trim import trim_box_for_images
+
+    print(f"{'トリミング':>10} {'解析(秒)':>10} {'PDF作成(秒)':>12} {'サイズ(MB)':>11}")
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        image_dir = Path(temp_dir)
+        for page_num in range(1, args.pages + 1):
+            draw_synthetic_window(page_num, tuple(args.size)).save(image_dir / f"page_{page_num:04d}.png")
+        image_files = sorted(image_dir.glob("page_*.png"))
+        for trim in (False, True):
+            output_path = image_dir / f"trim_{trim}.pdf"
+            start = time.perf_counter()
+            box = trim_box_for_images(image_files) if trim else None
+            analyzed = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                add_image_files(writer, image_files, box=box)
+            finished = time.perf_counter()
+            size_mb = output_path.stat().st_size / (1024 * 1024)
+            print(f"{'あり' if trim else 'なし':>10} {analyzed - start:>10.2f} "
+                  f"{finished - analyzed:>12.2f} {size_mb:>11.2f}")
+
+
+def bench_encode(args):
+    """全ページJPEGとページごとのエンコード方式選択（--encoding auto）を比較"""
+    from page_encoder import PageEncoder
+    from pdf_writer import PdfWriter
+
+    # 本文4ページごとにグレーとカラーの挿絵を1ページずつ混ぜる
+    size = tuple(args.size)
+    pages = []
+    for page_num in range(1, args.pages + 1):
+        kind = page_num % 6
+        if kind == 4:
+            pages.append(draw_synthetic_illustration(page_num, size, color=False))
+        elif kind == 5:
+            pages.append(draw_synthetic_illustration(page_num, size, color=True))
+        else:
+            pages.append(draw_synthetic_page(page_num, size))
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        for mode in ('jpeg', 'auto'):
+            encoder = PageEncoder(mode, args.quality)
+            output_path = Path(temp_dir) / f"{mode}.pdf"
+            start = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                for img in pages:
+                    writer.add_encoded_page(encoder.encode(img))
+            elapsed = time.perf_counter() - start
+            size_mb = output_path.stat().st_size / (1024 * 1024)
+            print(f"\n{mode}: {size_mb:.2f} MB, {elapsed:.2f} 秒")
+            for line in encoder.report():
+                print(f"  {line}")
+
+
+def bench_jobs(args):
+    """保存済みページからのPDF作成を、エンコードプロセス数ごとに計測"""
+    from page_encoder import PageEncoder
+    from pdf_writer import write_pdf
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        image_dir = Path(temp_dir)
+        image_files = make_synthetic_pages(image_dir, args.pages, size=tuple(args.size))
+        print(f"{'プロセス数':>10} {'時間(秒)':>10} {'ページ/秒':>10} {'速度比':>8}")
+        baseline = None
+        for jobs in args.jobs:
+            output_path = image_dir / f"jobs_{jobs}.pdf"
+            start = time.perf_counter()
+            write_pdf(image_files, output_path, encoder=PageEncoder(args.encoding), jobs=jobs)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{jobs:>10} {elapsed:>10.2f} {args.pages / elapsed:>10.1f} "
+                  f"{baseline / elapsed:>8.2f}")
+
+
+def bench_append(args):
+    """既存のPDFに末尾のページを追加する場合の、作り直しと増分更新の時間を比較"""
+    from pdf_writer import PdfWriter, encode_image
+
+    size = tuple(args.size)
+    # 同じ内容のページを使い回す
+    images = [draw_synthetic_page(page_num, size) for page_num in range(1, 11)]
+    encoded = [encode_image(img) for img in images]
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        output_path = Path(temp_dir) / "book.pdf"
+        with PdfWriter(output_path) as writer:
+            for index in range(args.pages):
+                writer.add_encoded_page(encoded[index % len(encoded)])
+        base_mb = output_path.stat().st_size / (1024 * 1024)
+
+        # 従来: 全ページを再エンコードして書き直す（PNGの読み込み時間は含まない）
+        start = time.perf_counter()
+        with PdfWriter(Path(temp_dir) / "rebuilt.pdf") as writer:
+            for index in range(args.pages + args.tail):
+                writer.add_image(images[index % len(images)])
+        rebuilt = time.perf_counter() - start
+
+        # 増分更新: 末尾のページだけをエンコードして追記する
+        start = time.perf_counter()
+        with PdfWriter(output_path, append=True) as writer:
+            for index in range(args.tail):
+                writer.add_image(images[index % len(images)])
+        appended = time.perf_counter() - start
+
+        print(f"既存のPDF: {args.pages}ページ（{base_mb:.1f} MB）、追加: {args.tail}ページ")
+        print(f"{'方式':>8} {'時間(秒)':>10}")
+        print(f"{'作り直し':>8} {rebuilt:>10.2f}")
+        print(f"{'増分更新':>8} {appended:>10.2f}")
+
+
+def _run_cli_case(pages, latency, delay, settle, workers, encoding, work_dir, result_queue):
+    """子プロセスでCLI版のキャプチャを合成した本で実行し、計測結果を返す"""
+    import contextlib
+    import io
+    import os
+
+    import kindle_to_pdf
+
+    os.chdir(work_dir)
+    argv = ["-o", "book.pdf", "--backend", "synthetic", "--synthetic-pages", str(pages),
+            "--synthetic-latency", str(latency), "--delay", str(delay), "--settle", settle,
+            "--workers", str(workers), "--encoding", encoding]
+    with contextlib.redirect_stdout(io.StringIO()):
+        timer = kindle_to_pdf.main(argv)
+    size = os.path.getsize("book.pdf")
+    result_queue.put((timer.report(), timer.elapsed, timer.pages, size, None, _peak_rss_mb()))
+
+
+def _run_gui_case(pages, latency, delay, work_dir, result_queue):
+    """子プロセスでGUI版のキャプチャ処理を画面なしで実行し、計測結果を返す
+
+    Tkのウィンドウは作らず、入力欄・表示の値とメインループへのコールバック登録だけを置き換える。
+    """
+    import os
+    import threading
+
+    from capture_engine import EventThrottle
+    from kindle_to_pdf_gui import KindleToPdfApp
+
+    class Value:
+        def __init__(self, value):
+            self.value = value
+
+        def get(self):
+            return self.value
+
+        def set(self, value):
+            self.value = value
+
+    class HeadlessRoot:
+        """after() で登録されたコールバックを数え、指定の時間後に別スレッドで実行するルート"""
+
+        def __init__(self):
+            self.callbacks = 0
+
+        def after(self, ms, func):
+            self.callbacks += 1
+            threading.Timer(ms / 1000.0, func).start()
+
+    output_path = os.path.join(work_dir, "book.pdf")
+    app = KindleToPdfApp.__new__(KindleToPdfApp)
+    app.root = HeadlessRoot()
+    app.backend_name = "synthetic"
+    app.backend_options = {"pages": pages, "latency": latency}
+    app.trace_path = None
+    app.events = EventThrottle(app.root.after, app._handle_event)
+    app.output_var = Value(output_path)
+    app.page_mode = Value("auto")
+    app.page_count_var = Value(str(pages))
+    app.delay_var = Value(str(delay))
+    app.resume_var = Value(False)
+    app.start_page_var = Value("1")
+    app.keep_images_var = Value(False)
+    app.profile_var = Value("archive")
+    app.classify_var = Value(False)
+    app.status_var = Value("")
+    app.progress_var = Value(0)
+    messages = []
+    app._capture_complete = lambda success, message, stats="": messages.append((success, message))
+    app.engine = app._create_engine()
+    app._capture_process()
+    if not messages or not messages[-1][0]:
+        raise RuntimeError(messages[-1][1] if messages else "GUI版のキャプチャが完了しませんでした")
+
+    timer = app.engine.timer
+    size = os.path.getsize(output_path)
+    result_queue.put((timer.report(), timer.elapsed, timer.pages, size,
+                      app.root.callbacks, _peak_rss_mb()))
+
+
+def bench_suite(args):
+    """合成した本でCLI版・GUI版のキャプチャ全体を実行し、段階ごとの時間・速度・メモリ・サイズを計測"""
+    cases = (
+        ('CLI', _run_cli_case, (args.pages, args.latency, args.delay, args.settle,
+                                args.workers, args.encoding)),
+        ('GUI', _run_gui_case, (args.pages, args.latency, args.delay)),
+    )
+    for label, target, options in cases:
+        with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+            report, elapsed, captured, size, callbacks, peak = run_isolated(
+                target, *options, temp_dir)
+        print(f"\n[{label}] {args.pages}ページの本: 撮影 {captured}回, 合計 {elapsed:.2f} 秒, "
+              f"{args.pages * 60.0 / elapsed:.1f} ページ/分")
+        print(f"  ピークRSS: {peak:.1f} MB, PDFサイズ: {size / (1024 * 1024):.2f} MB"
+              + (f", Tkへのコールバック: {callbacks}回" if callbacks is not None else ""))
+        for line in report[:-1]:
+            print(f"  {line}")
+
+
+def bench_trace(args):
+    """段階の計測1回あたりの負荷を比較（計測なし / 集計のみ / トレース出力あり）"""
+    from stage_timer import StageTimer
+
+    def measure(timer):
+        start = time.perf_counter()
+        for _ in range(args.count):
+            if timer is None:
+                pass
+            else:
+                with timer.stage('capture'):
+                    pass
+        return (time.perf_counter() - start) / args.count
+
+    baseline = measure(None)
+    print(f"{args.count}回の計測1回あたりの時間:")
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        for label, trace_path in (("集計のみ", None), ("トレース出力", Path(temp_dir) / "trace.json")):
+            timer = StageTimer(trace_path=trace_path)
+            per_call = measure(timer)
+            timer.close()
+            print(f"  {label:<8}: {(per_call - baseline) * 1e6:.2f} マイクロ秒")
+
+
+def bench_dedup(args):
+    """重複ページを含む本で、重複ページの扱い（off / share / drop）ごとのサイズと時間を比較"""
+    from PIL import Image
+
+    from capture_pipeline import CapturePipeline, PageAssembler
+    from frame import Frame
+    from page_store import PageStore
+    from pdf_writer import PdfWriter
+
+    # 10ページごとに白紙の区切りページを入れ、7ページごとに描画の遅れで同じページを2回撮影する
+    size = tuple(args.size)
+    blank = Frame.from_image(Image.new('RGB', size, (255, 255, 255)))
+    frames = []
+    for page_num in range(1, args.pages + 1):
+        if page_num % 10 == 0:
+            frames.append(blank)
+            continue
+        frame = Frame.from_image(draw_synthetic_page(page_num, size))
+        frames.append(frame)
+        if page_num % 7 == 0:
+            frames.append(frame)
+
+    print(f"{len(frames)}フレーム（白紙 {args.pages // 10}ページ, 重複撮影 {args.pages // 7}回）")
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        for mode in ('off', 'share', 'drop'):
+            store = PageStore() if mode != 'off' else None
+            output_path = Path(temp_dir) / f"{mode}.pdf"
+            encode_seconds = 0.0
+            start = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                assembler = PageAssembler(writer, drop_duplicates=mode == 'drop')
+                with CapturePipeline(workers=2, store=store) as pipeline:
+                    for page_num, frame in enumerate(frames, 1):
+                        pipeline.submit(page_num, frame)
+                    results = pipeline.drain()
+                for result in results:
+                    encode_seconds += result.timings.get('encode', 0.0)
+                assembler.update(results)
+            elapsed = time.perf_counter() - start
+            size_mb = output_path.stat().st_size / (1024 * 1024)
+            print(f"\n{mode}: {writer.page_count}ページ, {size_mb:.2f} MB, {elapsed:.2f} 秒"
+                  f"（エンコード合計 {encode_seconds:.2f} 秒）")
+            if store is not None:
+                for line in store.report(writer.shared_pages, writer.shared_bytes, assembler.dropped):
+                    print(f"  {line}")
+
+
+def bench_profile(args):
+    """出力プロファイルごとのPDFサイズとエンコード時間を比較"""
+    from PIL import Image
+
+    from frame import Frame
+    from page_encoder import PROFILES, PageEncoder, output_size, resample_page
+    from pdf_writer import PdfWriter
+
+    # Retinaで撮影したウィンドウ（見開き）のフレーム
+    frames = [Frame.from_image(draw_synthetic_window(page_num, tuple(args.size)))
+              for page_num in range(1, args.pages + 1)]
+    print(f"{args.pages}ページ（{args.size[0]}x{args.size[1]}）, エンコード方式: {args.encoding}")
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        for profile, max_width in PROFILES.items():
+            encoder = PageEncoder(args.encoding, args.quality, max_width=max_width)
+            output_path = Path(temp_dir) / f"{profile}.pdf"
+            start = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                for frame in frames:
+                    encoded = encoder.encode(frame.to_image())
+                    writer.add_encoded_page(encoded)
+            elapsed = time.perf_counter() - start
+            size_mb = output_path.stat().st_size / (1024 * 1024)
+            width, height = encoded.size
+            print(f"\n{profile}: {width}x{height}, {size_mb:.2f} MB, {elapsed:.2f} 秒"
+                  f"（1ページ {elapsed / args.pages * 1000:.1f} ミリ秒）")
+
+            size = output_size(frames[0].size, max_width)
+            if size is None:
+                continue
+            # 縮小だけの時間（整数分の1への縮小を先に行う経路 / フル解像度のまま補間）
+            images = [frame.to_image() for frame in frames[:5]]
+            start = time.perf_counter()
+            for img in images:
+                resample_page(img, size)
+            fast = (time.perf_counter() - start) / len(images)
+            start = time.perf_counter()
+            for img in images:
+                img.resize(size, Image.Resampling.LANCZOS)
+            full = (time.perf_counter() - start) / len(images)
+            print(f"  縮小1ページ: {fast * 1000:.1f} ミリ秒（フル解像度のまま補間: {full * 1000:.1f} ミリ秒）")
+
+
+def bench_classify(args):
+    """白紙・見開きを含む本で、ページの分類の有無によるPDFのページ数・サイズ・時間を比較"""
+    from capture_pipeline import CapturePipeline, PageAssembler
+    from fingerprint import fingerprint_frame
+    from frame import Frame
+    from page_classifier import SAMPLE_SIZE, PageClassifier, page_features
+    from pdf_writer import PdfWriter, add_image_files
+    from synthetic_book import SyntheticBook
+
+    book = SyntheticBook(args.pages, tuple(args.size), window=True,
+                         blank_every=args.blank_every, spread_every=args.spread_every)
+    frames = [Frame.from_image(book[index]) for index in range(args.pages)]
+    print(f"{args.pages}フレーム（白紙 {args.pages // args.blank_every}ページ, "
+          f"見開き {args.pages // args.spread_every}ページ）")
+
+    # 特徴量の計算時間（1ページずつ / まとめて）と、指紋の計算時間
+    samples = [frame.sample(SAMPLE_SIZE, SAMPLE_SIZE) for frame in frames]
+    sizes = [frame.size for frame in frames]
+    start = time.perf_counter()
+    for sample, size in zip(samples, sizes):
+        page_features([sample], [size])
+    single = (time.perf_counter() - start) / len(frames)
+    start = time.perf_counter()
+    for index in range(0, len(frames), 16):
+        page_features(samples[index:index + 16], sizes[index:index + 16])
+    batched = (time.perf_counter() - start) / len(frames)
+    start = time.perf_counter()
+    for frame in frames:
+        fingerprint_frame(frame)
+    fingerprint = (time.perf_counter() - start) / len(frames)
+    print(f"特徴量の計算: 1ページずつ {single * 1000:.2f} ミリ秒, 16ページずつ {batched * 1000:.2f} ミリ秒"
+          f"（参考: 指紋 {fingerprint * 1000:.2f} ミリ秒）")
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        for classify in (False, True):
+            classifier = PageClassifier() if classify else None
+            output_path = Path(temp_dir) / f"classify_{classify}.pdf"
+            encode_seconds = 0.0
+            start = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                assembler = PageAssembler(writer)
+                with CapturePipeline(workers=2, classifier=classifier) as pipeline:
+                    for page_num, frame in enumerate(frames, 1):
+                        pipeline.submit(page_num, frame)
+                    results = pipeline.drain()
+                for result in results:
+                    encode_seconds += result.timings.get('encode', 0.0)
+                assembler.update(results)
+            elapsed = time.perf_counter() - start
+            size_mb = output_path.stat().st_size / (1024 * 1024)
+            print(f"\n分類{'あり' if classify else 'なし'}: {writer.page_count}ページ, {size_mb:.2f} MB, "
+                  f"{elapsed:.2f} 秒（エンコード合計 {encode_seconds:.2f} 秒）")
+            if classifier is not None:
+                for line in classifier.report(assembler.page_classes):
+                    print(f"  {line}")
+
+        # 保存した画像からの作り直し（特徴量を計算し直す / キャプチャ時に記録した特徴量を使う）
+        image_dir = Path(temp_dir) / "images"
+        image_dir.mkdir()
+        features = {}
+        for result, frame in zip(results, frames):
+            path = image_dir / f"page_{result.page_num:04d}.png"
+            frame.to_image().save(path, 'PNG')
+            features[path.name] = result.features
+        image_files = sorted(image_dir.glob("page_*.png"))
+        for cached in (False, True):
+            classifier = PageClassifier()
+            if cached:
+                classifier.cache.update(features)
+            output_path = Path(temp_dir) / f"rebuild_{cached}.pdf"
+            start = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                add_image_files(writer, image_files, classifier=classifier)
+            elapsed = time.perf_counter() - start
+            print(f"\n画像から作り直し（{'記録済みの特徴量' if cached else '特徴量を計算'}）: "
+                  f"{writer.page_count}ページ, {elapsed:.2f} 秒（特徴量の計算 {classifier.seconds:.2f} 秒）")
+
+
+def bench_queue(args):
+    """合成した本を複数冊、PDFの作成を次の本のキャプチャと重ねる場合と重ねない場合で比較"""
+    from job_queue import Job, JobQueue, no_switch
+
+    engine_options = {
+        "backend": "synthetic",
+        "backend_options": {"pages": args.pages, "latency": args.latency},
+        "encoding": args.encoding,
+        "workers": args.workers,
+    }
+    print(f"{args.books}冊 × {args.pages}ページ, PDF作成のプロセス数 {args.jobs}")
+    print(f"{'方式':<12} {'全体(秒)':>10} {'キャプチャ(秒)':>14} {'PDF作成(秒)':>12}")
+    baseline = None
+    for overlap in (False, True):
+        with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+            temp_dir = Path(temp_dir)
+            jobs = [Job(str(temp_dir / f"book_{index + 1}.pdf"), args.pages, args.delay)
+                    for index in range(args.books)]
+            queue = JobQueue(jobs, temp_dir / "jobs.state.json", temp_dir / "queue",
+                             switch_book=no_switch, engine_options=engine_options,
+                             build_jobs=args.jobs, overlap=overlap)
+            records = queue.run()
+            capture = sum(record.get("capture_seconds", 0.0) for record in records)
+            build = sum(record.get("build_seconds", 0.0) for record in records)
+            baseline = baseline or queue.elapsed
+            label = "重ねる" if overlap else "順番に"
+            print(f"{label:<12} {queue.elapsed:>10.2f} {capture:>14.2f} {build:>12.2f}"
+                  f"  （速度比 {baseline / queue.elapsed:.2f}）")
+
+
+def bench_spool(args):
+    """キャプチャ中のページ画像の保存（PNG / スプール）の時間・サイズと、保存した画像からのPDF作成時間を比較"""
+    from capture_pipeline import CapturePipeline
+    from frame import Frame
+    from frame_spool import SPOOL_FILE, FrameSpool, saved_pages
+    from page_encoder import PageEncoder
+    from pdf_writer import PdfWriter, add_image_files
+    from synthetic_book import SyntheticBook
+
+    book = SyntheticBook(args.pages, tuple(args.size), window=True)
+    frames = [Frame.from_image(book[index]) for index in range(args.pages)]
+    print(f"{args.pages}ページ（{args.size[0]}x{args.size[1]}）, ワーカー数 {args.workers}, "
+          f"PDF作成のプロセス数 {args.jobs}")
+    print(f"{'保存方式':<10} {'保存(ms/ページ)':>16} {'全体(秒)':>10} {'サイズ(MB)':>11} "
+          f"{'一覧(ms)':>9} {'PDF作成(秒)':>12}")
+    for method in ("png", "zlib", "raw"):
+        with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+            image_dir = Path(temp_dir) / "images"
+            image_dir.mkdir()
+            spool = None
+            if method != "png":
+                spool = FrameSpool(image_dir / SPOOL_FILE, compression=method)
+            start = time.perf_counter()
+            with CapturePipeline(None if spool else image_dir, workers=args.workers,
+                                 encode=False, spool=spool) as pipeline:
+                for page_num, frame in enumerate(frames, 1):
+                    pipeline.submit(page_num, frame)
+                results = pipeline.drain()
+            if spool is not None:
+                spool.close()
+            elapsed = time.perf_counter() - start
+            save = sum(result.timings.get("save", result.timings.get("spool", 0.0))
+                       for result in results) / len(results)
+            size_mb = sum(path.stat().st_size for path in image_dir.iterdir()) / (1024 * 1024)
+
+            start = time.perf_counter()
+            sources = saved_pages(image_dir)
+            listing = time.perf_counter() - start
+            start = time.perf_counter()
+            with PdfWriter(Path(temp_dir) / "out.pdf") as writer:
+                add_image_files(writer, sources, encoder=PageEncoder(), jobs=args.jobs)
+            build = time.perf_counter() - start
+            print(f"{method:<10} {save * 1000:>16.1f} {elapsed:>10.2f} {size_mb:>11.2f} "
+                  f"{listing * 1000:>9.2f} {build:>12.2f}")
+
+
+def check_linearization(path):
+    """線形化したPDFをqpdf（pikepdf、なければqpdfコマンド）で検査し、警告のリストを返す
+
+    どちらもない場合はNoneを返す。
+    """
+    try:
+        import pikepdf
+    except ImportError:
+        import shutil
+        import subprocess
+
+        if shutil.which("qpdf") is None:
+            return None
+        # 終了コードは 0: 問題なし, 2: エラー, 3: 警告
+        result = subprocess.run(["qpdf", "--check-linearization", str(path)],
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            return []
+        return [line for line in (result.stdout + result.stderr).splitlines() if line.strip()]
+    with pikepdf.open(path) as pdf:
+        valid = pdf.check_linearization()
+        warnings = list(pdf.get_warnings())
+    if not valid and not warnings:
+        warnings.append(f"{path}: 線形化が正しくありません")
+    return warnings
+
+
+def bench_linearize(args):
+    """線形化（Fast Web View）とサムネイルの時間・サイズ、最初のページを表示するまでに読むバイト数を計測
+
+    線形化したPDFはqpdfの check_linearization で検査し、警告があれば失敗する。
+    """
+    import re
+
+    from frame import Frame
+    from page_classifier import SAMPLE_SIZE
+    from page_encoder import encode_thumbnail
+    from pdf_writer import PdfWriter, encode_image
+    from synthetic_book import SyntheticBook
+
+    size = tuple(args.size)
+    book = SyntheticBook(10, size, window=True)
+    frames = [Frame.from_image(book[index]) for index in range(10)]
+
+    # サムネイル: 指紋用の縮小画像から作る場合と、フル解像度の画像から作る場合
+    start = time.perf_counter()
+    thumbs = [encode_thumbnail(frame.sample(SAMPLE_SIZE, SAMPLE_SIZE), frame.size)
+              for frame in frames]
+    from_sample = (time.perf_counter() - start) / len(frames)
+    start = time.perf_counter()
+    for frame in frames:
+        encode_thumbnail(frame.to_image())
+    from_image = (time.perf_counter() - start) / len(frames)
+    thumb_kb = sum(len(thumb.data) for thumb in thumbs) / len(thumbs) / 1024
+    print(f"サムネイル（{thumbs[0].size[0]}x{thumbs[0].size[1]}, {thumb_kb:.1f} KB/ページ）: "
+          f"縮小画像から {from_sample * 1000:.2f} ms/ページ, "
+          f"フル解像度から {from_image * 1000:.2f} ms/ページ")
+
+    # 同じ内容のページを使い回す（共有はしない）
+    encoded = [encode_image(frame.to_image()) for frame in frames]
+    print(f"\n{args.pages}ページ（{size[0]}x{size[1]}）")
+    print(f"{'方式':<14} {'書き出し(秒)':>13} {'線形化(秒)':>11} {'サイズ(MB)':>11} "
+          f"{'最初のページまで(KB)':>21} {'検証':>6}")
+    failures = []
+    unchecked = False
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        for label, linearize, thumbnails, shared in (
+                ("通常", False, False, False), ("サムネイル", False, True, False),
+                ("線形化", True, False, False), ("線形化+サムネイル", True, True, False),
+                ("線形化+共有", True, False, True), ("線形化+サムネイル+共有", True, True, True)):
+            output_path = Path(temp_dir) / "book.pdf"
+            start = time.perf_counter()
+            with PdfWriter(output_path) as writer:
+                for index in range(args.pages):
+                    page = encoded[index % len(encoded)]
+                    page.thumb = thumbs[index % len(thumbs)] if thumbnails else None
+                    # 共有する場合は、同じ内容のページの画像（とサムネイル）を1つだけ埋め込む
+                    key = f"page-{index % len(encoded)}" if shared else None
+                    if key is not None and writer.has_image(key):
+                        writer.add_shared_page(key)
+                    else:
+                        writer.add_encoded_page(page, key)
+            written = time.perf_counter() - start
+            linearized = 0.0
+            if linearize:
+                from pdf_writer import linearize_pdf
+
+                start = time.perf_counter()
+                linearize_pdf(output_path)
+                linearized = time.perf_counter() - start
+            file_size = output_path.stat().st_size
+            # 線形化していないPDFは、末尾のxrefを読むまでページの位置が分からない
+            first_page = file_size
+            with open(output_path, 'rb') as fp:
+                match = re.search(rb'/Linearized 1 .*?/E (\d+)', fp.read(1024))
+            if match:
+                first_page = int(match.group(1))
+            status = "-"
+            if linearize:
+                warnings = check_linearization(output_path)
+                if warnings is None:
+                    unchecked = True
+                else:
+                    status = "OK" if not warnings else "NG"
+                    failures.extend(f"{label}: {warning}" for warning in warnings)
+            print(f"{label:<14} {written:>13.2f} {linearized:>11.2f} "
+                  f"{file_size / (1024 * 1024):>11.2f} {first_page / 1024:>21.1f} {status:>6}")
+    if unchecked:
+        print("\npikepdfもqpdfもないため、線形化の検査はしていません（pip install pikepdf）。")
+    if failures:
+        print("\n線形化の検査で警告がありました:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+
+def bench_rebuild(args):
+    """保存したページ画像からの作り直しの時間を、キャッシュの有無・出力設定の変更ごとに計測"""
+    from page_encoder import PROFILES, PageEncoder
+    from rebuild import rebuild_pdf
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        image_dir = Path(temp_dir) / "images"
+        image_dir.mkdir()
+        make_synthetic_pages(image_dir, args.pages, tuple(args.size))
+        print(f"{args.pages}ページ（{args.size[0]}x{args.size[1]}）, エンコードプロセス数 {args.jobs}")
+        print(f"{'条件':<28} {'時間(秒)':>9} {'再利用':>7} {'エンコード':>10}")
+        cases = (
+            ("キャッシュなし", "archive", False),
+            ("初回（キャッシュに追加）", "archive", True),
+            ("同じ設定で作り直し", "archive", True),
+            ("プロファイルを変更（tablet）", "tablet", True),
+            ("元の設定に戻す", "archive", True),
+        )
+        for label, profile, use_cache in cases:
+            encoder = PageEncoder("auto", max_width=PROFILES[profile])
+            start = time.perf_counter()
+            result = rebuild_pdf(image_dir, Path(temp_dir) / "out.pdf", encoder, args.jobs,
+                                 use_cache=use_cache)
+            elapsed = time.perf_counter() - start
+            print(f"{label:<28} {elapsed:>9.2f} {result.cached:>7} {result.encoded:>10}")
+
+
+def _record_synthetic_session(path, pages, latency, slow_rate, seed, max_wait):
+    """合成した本を描画完了検出でキャプチャしたセッションを記録（実際の記録がない場合）"""
+    from capture_backend import RecordingBackend, SyntheticBackend
+    from page_settle import PageSettler
+
+    backend = RecordingBackend(SyntheticBackend(pages, size=(1440, 900), latency=latency,
+                                                slow_rate=slow_rate, seed=seed), path)
+    with backend:
+        settler = PageSettler(sample=backend.sample, turn_page=backend.next_page,
+                              max_wait=max_wait)
+        settler.reset()
+        while True:
+            backend.grab()
+            if not settler.next_page():
+                break
+
+
+def bench_replay(args):
+    """記録したセッションを再生し、固定待機と描画完了検出の時間と正確さを比較"""
+    from capture_backend import ReplayBackend
+    from fingerprint import fingerprint_frame
+    from page_settle import PageSettler
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        session_path = args.session
+        if session_path is None:
+            session_path = Path(temp_dir) / "session.zip"
+            print(f"合成した本（{args.pages}ページ）のキャプチャを記録中...")
+            _record_synthetic_session(session_path, args.pages, args.latency, args.slow_rate,
+                                      args.seed, args.max_wait)
+
+        with ReplayBackend(session_path) as backend:
+            recorded = backend.session
+            print(f"記録: {recorded.session.get('backend')}, ページ送り {recorded.turns}回, "
+                  f"撮影したページ {len(recorded.pages)}, フレーム {len(recorded.frames)}")
+        print(f"{'方式':>10} {'合計(秒)':>10} {'撮影数':>8} {'欠落':>6} {'重複':>6} {'描きかけ':>8} {'再送':>6}")
+        for method in ('fixed', 'adaptive'):
+            with ReplayBackend(session_path, speed=args.speed) as backend:
+                captured = []
+                retries = 0
+                start = time.perf_counter()
+                if method == 'fixed':
+                    # 自動検出モードと同じく、同じ画像が3回続くまで撮影して重複分を除く
+                    same_count = 0
+                    previous = None
+                    while same_count < 3:
+                        frame = backend.grab()
+                        captured.append(backend.page_of(frame))
+                        fingerprint = fingerprint_frame(frame)
+                        if fingerprint.matches(previous):
+                            same_count += 1
+                        else:
+                            same_count = 0
+                        previous = fingerprint
+                        backend.next_page()
+                        time.sleep(args.delay / args.speed)
+                    del captured[-same_count:]
+                else:
+                    settler = PageSettler(sample=backend.sample, turn_page=backend.next_page,
+                                          max_wait=args.max_wait / args.speed,
+                                          interval=0.05 / args.speed)
+                    settler.reset()
+                    while True:
+                        captured.append(backend.page_of(backend.grab()))
+                        if not settler.next_page():
+                            break
+                    retries = settler.turn_retries
+                elapsed = time.perf_counter() - start
+            pages_seen = [index for index in captured if index is not None]
+            missed = len(recorded.pages) - len(set(pages_seen))
+            duplicated = len(pages_seen) - len(set(pages_seen))
+            partial = len(captured) - len(pages_seen)
+            print(f"{method:>10} {elapsed:>10.2f} {len(captured):>8} {missed:>6} {duplicated:>6} {partial:>8} {retries:>6}")
+
+
+def bench_formats(args):
+    """保存したページ画像からの書き出しの時間とサイズを、出力形式（PDF / CBZ / TIFF / WebP）ごとに比較"""
+    from archive_writer import EXTENSIONS, FORMATS, create_writer
+    from page_encoder import PageEncoder
+    from pdf_writer import add_image_files
+
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        image_dir = Path(temp_dir) / "images"
+        image_dir.mkdir()
+        image_files = make_synthetic_pages(image_dir, args.pages, tuple(args.size))
+        print(f"{args.pages}ページ（{args.size[0]}x{args.size[1]}）, エンコード方式 {args.encoding}, "
+              f"エンコードプロセス数 {args.jobs}")
+        print(f"{'形式':>6} {'時間(秒)':>9} {'サイズ(MB)':>11} {'1ページ(KB)':>12} {'変換したページ':>14}")
+        for output_format in FORMATS:
+            output_path = Path(temp_dir) / f"out{EXTENSIONS[output_format]}"
+            encoder = PageEncoder(args.encoding, args.quality, webp=output_format == "webp")
+            start = time.perf_counter()
+            with create_writer(output_path, output_format) as writer:
+                add_image_files(writer, image_files, encoder=encoder, jobs=args.jobs)
+            elapsed = time.perf_counter() - start
+            size = output_path.stat().st_size
+            # CBZに入れられない白黒のページだけは、書き出すときにPNGに変換する
+            converted = 0
+            if output_format == "cbz":
+                converted = encoder.stats.get('bilevel', (0,))[0]
+            print(f"{output_format:>6} {elapsed:>9.2f} {size / (1024 * 1024):>11.2f} "
+                  f"{size / args.pages / 1024:>12.1f} {converted:>14}")
+
+
+def _run_png_case(method, image_dir, output_path, result_queue):
+    """子プロセスで保存済みPNGからのPDF作成を1回実行し、時間・CPU時間・ピークメモリを返す"""
+    from page_encoder import PageEncoder
+    from pdf_writer import write_pdf
+
+    image_files = sorted(Path(image_dir).glob("page_*.png"))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    if method == 'legacy':
+        _legacy_images_to_pdf(image_files, output_path)
+    else:
+        write_pdf(image_files, output_path, encoder=PageEncoder(method))
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+    result_queue.put((elapsed, cpu, _peak_rss_mb()))
+
+
+def bench_png(args):
+    """保存済みPNGからのPDF作成を、従来の images_to_pdf（Pillowで保存）・JPEG・PNGのそのまま埋め込みで比較"""
+    labels = {'legacy': 'Pillow', 'jpeg': 'JPEG', 'png': 'PNGそのまま'}
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        image_dir = Path(temp_dir)
+        make_synthetic_pages(image_dir, args.pages, size=tuple(args.size))
+        input_mb = sum(path.stat().st_size for path in image_dir.glob("page_*.png")) / (1024 * 1024)
+        print(f"{args.pages}ページ（{args.size[0]}x{args.size[1]}、PNG合計 {input_mb:.1f} MB）")
+        print(f"{'方式':<12} {'時間(秒)':>9} {'CPU(秒)':>9} {'CPU率':>7} {'ピークRSS(MB)':>14} {'サイズ(MB)':>11}")
+        for method in ('legacy', 'jpeg', 'png'):
+            output_path = image_dir / f"{method}.pdf"
+            elapsed, cpu, peak = run_isolated(_run_png_case, method, str(image_dir), str(output_path))
+            size_mb = output_path.stat().st_size / (1024 * 1024)
+            print(f"{labels[method]:<12} {elapsed:>9.2f} {cpu:>9.2f} {cpu / elapsed:>7.0%} "
+                  f"{peak:>14.1f} {size_mb:>11.2f}")
+
+
+def bench_target(args):
+    """--target-size の設定の選択を、サンプルの見積もりと実際のサイズ・全体の時間で確かめる"""
+    from page_encoder import PageEncoder
+    from rebuild import rebuild_pdf, rebuild_to_size
+    from target_size import describe, format_size, parse_size
+
+    budget = parse_size(args.target_size)
+    with tempfile.TemporaryDirectory(prefix="kindle_bench_") as temp_dir:
+        image_dir = Path(temp_dir) / "images"
+        image_dir.mkdir()
+        make_synthetic_pages(image_dir, args.pages, tuple(args.size))
+        output_path = Path(temp_dir) / "out.pdf"
+        print(f"{args.pages}ページ（{args.size[0]}x{args.size[1]}）, 目標 {format_size(budget)}, "
+              f"エンコードプロセス数 {args.jobs}, サンプル {args.samples}ページ")
+
+        start = time.perf_counter()
+        rebuild_pdf(image_dir, output_path, PageEncoder(), args.jobs, use_cache=False)
+        baseline = time.perf_counter() - start
+        print(f"設定を変えずに作成: {format_size(output_path.stat().st_size)}, {baseline:.2f} 秒")
+
+        start = time.perf_counter()
+        result = rebuild_to_size(image_dir, output_path, budget, PageEncoder(), args.jobs,
+                                 use_cache=False, samples=args.samples)
+        elapsed = time.perf_counter() - start
+        search = result.target
+        print(f"目標サイズで作成: {elapsed:.2f} 秒（見積もり {search.seconds:.2f} 秒, "
+              f"{len(search.estimates)}候補 × {search.sample_pages}ページ）")
+        print(f"{'候補':<22} {'見積もり(MB)':>13} {'誤差(MB)':>9} {'実際(MB)':>9}")
+        actual = {id(estimate): size for estimate, size in search.attempts}
+        for estimate in sorted(search.estimates, key=lambda estimate: -estimate.total):
+            size = actual.get(id(estimate))
+            mark = " ←" if estimate is search.chosen else ""
+            print(f"{describe(estimate.encoder):<22} {estimate.total / 1e6:>13.2f} "
+                  f"{estimate.error / 1e6:>9.2f} "
+                  f"{'-' if size is None else f'{size / 1e6:.2f}':>9}{mark}")
+        print(f"作成 {len(search.attempts)}回, 上限以下: {'はい' if search.met else 'いいえ'}, "
+              f"キャッシュから再利用 {result.cached}ページ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kindle to PDF ベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pdf_parser = subparsers.add_parser("pdf", help="PDF作成のメモリ使用量と時間を計測")
+    pdf_parser.add_argument("--pages", type=int, nargs="+", default=[10, 50, 100],
+                            help="計測するページ数（複数指定可）")
+    pdf_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                            metavar=("WIDTH", "HEIGHT"), help="合成ページのサイズ")
+    pdf_parser.add_argument("--methods", nargs="+", default=["legacy", "streaming"],
+                            choices=["legacy", "streaming"], help="比較する方式")
+    pdf_parser.set_defaults(func=bench_pdf)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="キャプチャループの1ページあたりの時間を計測")
+    pipeline_parser.add_argument("--pages", type=int, default=20, help="ページ数")
+    pipeline_parser.add_argument("--delay", type=float, default=0.2, help="ページ送り後の待機秒数")
+    pipeline_parser.add_argument("--workers", type=int, default=2, help="ワーカー数")
+    pipeline_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                                 metavar=("WIDTH", "HEIGHT"), help="合成ページのサイズ")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    settle_parser = subparsers.add_parser("settle", help="固定待機と描画完了検出を比較")
+    settle_parser.add_argument("--pages", type=int, default=30, help="ページ数")
+    settle_parser.add_argument("--delay", type=float, default=1.0, help="固定待機の秒数")
+    settle_parser.add_argument("--latency", type=float, default=0.3, help="平均描画遅延（秒）")
+    settle_parser.add_argument("--slow-rate", type=float, default=0.05, help="描画が遅いページの割合")
+    settle_parser.add_argument("--max-wait", type=float, default=3.0, help="描画完了を待つ最大秒数")
+    settle_parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    settle_parser.add_argument("--size", type=int, nargs=2, default=[800, 1200],
+                               metavar=("WIDTH", "HEIGHT"), help="合成ページのサイズ")
+    settle_parser.set_defaults(func=bench_settle)
+
+    turner_parser = subparsers.add_parser("turner", help="ページ送りドライバーの遅延を計測")
+    turner_parser.add_argument("--count", type=int, default=50, help="ページ送りの回数")
+    turner_parser.set_defaults(func=bench_turner)
+
+    fingerprint_parser = subparsers.add_parser("fingerprint", help="ページの同一判定の速度を計測")
+    fingerprint_parser.add_argument("--count", type=int, default=20, help="繰り返し回数")
+    fingerprint_parser.add_argument("--size", type=int, nargs=2, default=[2880, 1800],
+                                    metavar=("WIDTH", "HEIGHT"), help="フレームのサイズ")
+    fingerprint_parser.set_defaults(func=bench_fingerprint)
+
+    trim_parser = subparsers.add_parser("trim", help="自動トリミングの効果を計測")
+    trim_parser.add_argument("--pages", type=int, default=20, help="ページ数")
+    trim_parser.add_argument("--size", type=int, nargs=2, default=[2880, 1800],
+                             metavar=("WIDTH", "HEIGHT"), help="ウィンドウのサイズ")
+    trim_parser.set_defaults(func=bench_trim)
+
+    encode_parser = subparsers.add_parser("encode", help="ページごとのエンコード方式選択の効果を計測")
+    encode_parser.add_argument("--pages", type=int, default=24, help="ページ数")
+    encode_parser.add_argument("--quality", type=int, default=75, help="JPEGの品質")
+    encode_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                               metavar=("WIDTH", "HEIGHT"), help="合成ページのサイズ")
+    encode_parser.set_defaults(func=bench_encode)
+
+    jobs_parser = subparsers.add_parser("jobs", help="エンコードプロセス数ごとのPDF作成時間を計測")
+    jobs_parser.add_argument("--pages", type=int, default=48, help="ページ数")
+    jobs_parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8],
+                             help="計測するプロセス数（複数指定可）")
+    jobs_parser.add_argument("--encoding", choices=["jpeg", "auto"], default="jpeg",
+                             help="エンコード方式")
+    jobs_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                             metavar=("WIDTH", "HEIGHT"), help="合成ページのサイズ")
+    jobs_parser.set_defaults(func=bench_jobs)
+
+    append_parser = subparsers.add_parser("append", help="既存のPDFへのページ追加の時間を計測")
+    append_parser.add_argument("--pages", type=int, default=700, help="既存のPDFのページ数")
+    append_parser.add_argument("--tail", type=int, default=30, help="追加するページ数")
+    append_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                               metavar=("WIDTH", "HEIGHT"), help="合成ページのサイズ")
+    append_parser.set_defaults(func=bench_append)
+
+    suite_parser = subparsers.add_parser("suite", help="合成した本でCLI版・GUI版のキャプチャ全体を計測")
+    suite_parser.add_argument("--pages", type=int, default=30, help="本のページ数")
+    suite_parser.add_argument("--latency", type=float, default=0.3, help="平均描画遅延（秒）")
+    suite_parser.add_argument("--delay", type=float, default=1.0, help="固定待機の秒数")
+    suite_parser.add_argument("--settle", choices=["fixed", "adaptive"], default="adaptive",
+                              help="CLI版の待ち方")
+    suite_parser.add_argument("--workers", type=int, default=2, help="CLI版のワーカー数")
+    suite_parser.add_argument("--encoding", choices=["jpeg", "auto"], default="jpeg",
+                              help="CLI版のエンコード方式")
+    suite_parser.set_defaults(func=bench_suite)
+
+    trace_parser = subparsers.add_parser("trace", help="段階ごとの時間計測の負荷を計測")
+    trace_parser.add_argument("--count", type=int, default=100000, help="計測回数")
+    trace_parser.set_defaults(func=bench_trace)
+
+    dedup_parser = subparsers.add_parser("dedup", help="重複ページの扱いごとのサイズと時間を比較")
+    dedup_parser.add_argument("--pages", type=int, default=40, help="ページ数")
+    dedup_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                              metavar=("WIDTH", "HEIGHT"), help="ページの大きさ")
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    profile_parser = subparsers.add_parser("profile", help="出力プロファイルごとのサイズと時間を比較")
+    profile_parser.add_argument("--pages", type=int, default=20, help="ページ数")
+    profile_parser.add_argument("--size", type=int, nargs=2, default=[2880, 1800],
+                                metavar=("WIDTH", "HEIGHT"), help="撮影したウィンドウの大きさ")
+    profile_parser.add_argument("--encoding", choices=["jpeg", "auto"], default="jpeg",
+                                help="エンコード方式")
+    profile_parser.add_argument("--quality", type=int, default=75, help="JPEGの品質")
+    profile_parser.set_defaults(func=bench_profile)
+
+    classify_parser = subparsers.add_parser("classify", help="ページの分類の有無によるページ数・サイズ・時間を比較")
+    classify_parser.add_argument("--pages", type=int, default=40, help="フレーム数")
+    classify_parser.add_argument("--size", type=int, nargs=2, default=[2880, 1800],
+                                 metavar=("WIDTH", "HEIGHT"), help="撮影したウィンドウの大きさ")
+    classify_parser.add_argument("--blank-every", type=int, default=10, help="白紙ページの間隔")
+    classify_parser.add_argument("--spread-every", type=int, default=7, help="見開きの間隔")
+    classify_parser.set_defaults(func=bench_classify)
+
+    queue_parser = subparsers.add_parser("queue", help="複数冊のジョブキューで、PDF作成を重ねる効果を計測")
+    queue_parser.add_argument("--books", type=int, default=3, help="冊数")
+    queue_parser.add_argument("--pages", type=int, default=20, help="1冊のページ数")
+    queue_parser.add_argument("--latency", type=float, default=0.05, help="平均描画遅延（秒）")
+    queue_parser.add_argument("--delay", type=float, default=0.1, help="ページ送り後の待機秒数")
+    queue_parser.add_argument("--workers", type=int, default=2, help="キャプチャのワーカー数")
+    queue_parser.add_argument("--jobs", type=int, default=2, help="PDF作成のエンコードプロセス数")
+    queue_parser.add_argument("--encoding", choices=["jpeg", "auto"], default="jpeg",
+                              help="エンコード方式")
+    queue_parser.set_defaults(func=bench_queue)
+
+    spool_parser = subparsers.add_parser("spool", help="ページ画像の保存（PNG / スプール）の時間・サイズを比較")
+    spool_parser.add_argument("--pages", type=int, default=30, help="ページ数")
+    spool_parser.add_argument("--size", type=int, nargs=2, default=[2880, 1800],
+                              metavar=("WIDTH", "HEIGHT"), help="撮影したウィンドウの大きさ")
+    spool_parser.add_argument("--workers", type=int, default=2, help="キャプチャのワーカー数")
+    spool_parser.add_argument("--jobs", type=int, default=1, help="PDF作成のエンコードプロセス数")
+    spool_parser.set_defaults(func=bench_spool)
+
+    linearize_parser = subparsers.add_parser("linearize", help="PDFの線形化とサムネイルの時間・サイズを計測")
+    linearize_parser.add_argument("--pages", type=int, default=300, help="ページ数")
+    linearize_parser.add_argument("--size", type=int, nargs=2, default=[2880, 1800],
+                                  metavar=("WIDTH", "HEIGHT"), help="撮影したウィンドウの大きさ")
+    linearize_parser.set_defaults(func=bench_linearize)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="保存したページ画像からの作り直しの時間を、キャッシュの有無ごとに計測")
+    rebuild_parser.add_argument("--pages", type=int, default=60, help="ページ数")
+    rebuild_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                                metavar=("WIDTH", "HEIGHT"), help="ページ画像の大きさ")
+    rebuild_parser.add_argument("--jobs", type=int, default=4, help="エンコードプロセス数")
+    rebuild_parser.set_defaults(func=bench_rebuild)
+
+    replay_parser = subparsers.add_parser("replay", help="記録したセッションを再生し、固定待機と描画完了検出を比較")
+    replay_parser.add_argument("--session", default=None,
+                               help="--record-session で記録したファイル（省略時は合成した本を記録して使う）")
+    replay_parser.add_argument("--pages", type=int, default=20, help="記録する合成した本のページ数")
+    replay_parser.add_argument("--latency", type=float, default=0.3, help="合成した本の平均描画遅延（秒）")
+    replay_parser.add_argument("--slow-rate", type=float, default=0.1, help="合成した本の遅いページの割合")
+    replay_parser.add_argument("--seed", type=int, default=0, help="描画遅延の乱数シード")
+    replay_parser.add_argument("--delay", type=float, default=0.5, help="固定待機の秒数")
+    replay_parser.add_argument("--max-wait", type=float, default=3.0, help="描画完了検出の最大待機秒数")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="再生速度（倍）")
+    replay_parser.set_defaults(func=bench_replay)
+
+    formats_parser = subparsers.add_parser("formats", help="出力形式（PDF / CBZ / TIFF / WebP）ごとの書き出しの時間とサイズを比較")
+    formats_parser.add_argument("--pages", type=int, default=30, help="ページ数")
+    formats_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                                metavar=("WIDTH", "HEIGHT"), help="ページ画像の大きさ")
+    formats_parser.add_argument("--encoding", choices=["jpeg", "auto"], default="auto",
+                                help="エンコード方式")
+    formats_parser.add_argument("--quality", type=int, default=75, help="JPEG・WebPの品質")
+    formats_parser.add_argument("--jobs", type=int, default=4, help="エンコードプロセス数")
+    formats_parser.set_defaults(func=bench_formats)
+
+    png_parser = subparsers.add_parser("png", help="保存済みPNGからのPDF作成を、Pillow・JPEG・PNGのそのまま埋め込みで比較")
+    png_parser.add_argument("--pages", type=int, default=50, help="ページ数")
+    png_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                            metavar=("WIDTH", "HEIGHT"), help="ページ画像の大きさ")
+    png_parser.set_defaults(func=bench_png)
+
+    target_parser = subparsers.add_parser("target", help="--target-size の見積もりと実際のサイズ・時間を比較")
+    target_parser.add_argument("--pages", type=int, default=60, help="ページ数")
+    target_parser.add_argument("--size", type=int, nargs=2, default=[1600, 2400],
+                               metavar=("WIDTH", "HEIGHT"), help="ページ画像の大きさ")
+    target_parser.add_argument("--target-size", default="3MB", help="目標サイズ（例: 3MB）")
+    target_parser.add_argument("--samples", type=int, default=12, help="見積もりに使うページ数")
+    target_parser.add_argument("--jobs", type=int, default=4, help="エンコードプロセス数")
+    target_parser.set_defaults(func=bench_target)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
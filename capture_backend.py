@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+キャプチャバックエンド
+ウィンドウの撮影とページ送りをまとめたインターフェース。
+CLI版・GUI版のキャプチャループはこのインターフェースだけを使うので、
+合成した本を表示するバックエンドに差し替えれば、macOSやKindleアプリがなくても
+キャプチャ全体（ページ送り・待機・指紋・エンコード・PDF作成）を実行・計測できる。
+
+- kindle:    Kindle for Macのウィンドウを撮影し、ページ送りドライバーでページを送る
+- synthetic: 描画遅延を再現したシミュレーターで合成した本を表示する
+- replay:    session_archive で記録した実際のキャプチャを、元のタイミングのまま再生する
+
+RecordingBackend で任意のバックエンドを包むと、撮影・サンプル・ページ送りを記録できる。
+"""
+
+import time
+
+
+class CaptureBackend:
+    """キャプチャバックエンドの基底クラス"""
+
+    name = "base"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def grab(self):
+        """表示中のページをフル解像度で撮影し、Frameを返す"""
+        raise NotImplementedError
+
+    def sample(self):
+        """描画の完了を判定するための軽いフレームを返す"""
+        return self.grab()
+
+    def next_page(self):
+        """次のページへ移動"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class KindleBackend(CaptureBackend):
+    """Kindle for Macのウィンドウを撮影するバックエンド"""
+
+    name = "kindle"
+
+    def __init__(self, turner="helper", on_warning=None):
+        from page_turner import create_page_turner
+
+        # ページ送りドライバーをosascriptに切り替えた場合などの警告の通知先（省略時は通知しない）
+        self.on_warning = on_warning
+        # 最後に撮影したフレーム（ページ送りが失敗したとき、ページが変わったかを確かめるのに使う）
+        self.last_frame = None
+        # Kindleをアクティブ化してからウィンドウを探す
+        self.turner = create_page_turner(turner)
+        if self.turner.fallback_reason:
+            self._warn(self.turner.fallback_reason)
+        try:
+            time.sleep(0.5)
+            self.window_id = find_kindle_window_id()
+            if self.window_id is None:
+                raise RuntimeError("Kindleウィンドウが見つかりません。Kindleアプリを起動して本を開いてください。")
+        except BaseException:
+            self.turner.close()
+            raise
+
+    def grab(self):
+        from capture_pipeline import grab_window
+
+        self.last_frame = grab_window(self.window_id)
+        return self.last_frame
+
+    def sample(self):
+        from capture_pipeline import grab_window
+
+        self.last_frame = grab_window(self.window_id, nominal_resolution=True)
+        return self.last_frame
+
+    def _warn(self, message):
+        if self.on_warning is not None:
+            self.on_warning(message)
+
+    def next_page(self):
+        from page_turner import PageTurnerError, SubprocessPageTurner
+
+        try:
+            self.turner.next_page()
+        except PageTurnerError as e:
+            if isinstance(self.turner, SubprocessPageTurner):
+                raise
+            # 常駐型のドライバーが止まった場合は、osascriptに切り替える
+            self._warn(f"{e}。osascriptを使用します。")
+            self.turner.close()
+            self.turner = SubprocessPageTurner()
+            if self._page_changed():
+                # キー入力は届いていて応答だけが止まった場合、送り直すと1ページ飛ばしてしまう
+                self._warn("ページ送りは完了していたため、送り直しません。")
+                return
+            self.turner.next_page()
+
+    def _page_changed(self):
+        """ページ送りの前に撮影したフレームと今の表示を比べて、ページが変わったか"""
+        from fingerprint import fingerprint_frame
+
+        if self.last_frame is None:
+            return False
+        before = fingerprint_frame(self.last_frame)
+        return not before.matches(fingerprint_frame(self.sample()))
+
+    def close(self):
+        self.turner.close()
+
+
+class SyntheticBackend(CaptureBackend):
+    """合成した本を表示するバックエンド（ベンチマーク・動作確認用）
+
+    ページの描画には平均 latency 秒（まれに遅いページを含む）かかり、
+    最後のページでページ送りしても表示は変わらない（自動検出モードで終了を判定できる）。
+    """
+
+    name = "synthetic"
+
+    def __init__(self, pages=50, size=(2880, 1800), latency=0.3, slow_rate=0.05, seed=0,
+                 window=True, blank_every=0, spread_every=0):
+        from simulated_kindle import SimulatedKindle, random_latency
+        from synthetic_book import SyntheticBook
+
+        self.book = SyntheticBook(pages, size, window=window, blank_every=blank_every,
+                                  spread_every=spread_every)
+        self.kindle = SimulatedKindle(self.book, render_latency=random_latency(
+            mean=latency, spread=latency * 2 / 3, slow_rate=slow_rate, seed=seed))
+
+    def grab(self):
+        return self.kindle.grab()
+
+    def next_page(self):
+        self.kindle.turn_page()
+
+
+class RecordingBackend(CaptureBackend):
+    """別のバックエンドの撮影・サンプル・ページ送りを、タイミングと一緒にアーカイブに記録する"""
+
+    def __init__(self, backend, path):
+        from session_archive import SessionRecorder
+
+        self.backend = backend
+        self.name = backend.name
+        self.recorder = SessionRecorder(path, backend.name)
+
+    def __getattr__(self, name):
+        # window_id など、包んだバックエンドの属性はそのまま見せる
+        return getattr(self.backend, name)
+
+    def _observe(self, kind, capture):
+        started = self.recorder.now()
+        frame = capture()
+        self.recorder.observe(kind, frame, started, self.recorder.now() - started)
+        return frame
+
+    def grab(self):
+        return self._observe('grab', self.backend.grab)
+
+    def sample(self):
+        return self._observe('sample', self.backend.sample)
+
+    def next_page(self):
+        started = self.recorder.now()
+        self.backend.next_page()
+        self.recorder.turn(started, self.recorder.now() - started)
+
+    def close(self):
+        try:
+            self.backend.close()
+        finally:
+            self.recorder.close()
+
+
+class ReplayBackend(CaptureBackend):
+    """記録したセッションを元のタイミングで再生するバックエンド
+
+    n 回目のページ送りからの経過時間に応じて、記録時にその時刻に見えていたフレームを返し、
+    撮影とページ送りには記録時と同じ時間をかける（speed 倍速で再生する）。
+    記録したページ送りの回数を超えてページ送りしても、表示は最後のフレームのまま変わらない。
+    ページ送りは回数で対応させるため、記録時と違う方式（固定待機 / 描画完了検出）で再生すると、
+    ページ送りの取りこぼしを再送した回は次のページ送りの記録とずれることがある。
+    """
+
+    name = "replay"
+
+    def __init__(self, archive, speed=1.0, clock=time.monotonic, sleep=time.sleep):
+        from session_archive import RecordedSession
+
+        self.session = RecordedSession(archive)
+        self.speed = speed
+        self._clock = clock
+        self._sleep = sleep
+        self.turn = 0
+        self.turn_count = 0
+        self._turned_at = clock()
+        # 表示される可能性のあるフレーム（フレーム番号, 拡大縮小したか） -> Frame
+        self._cache = {}
+        self._load_turn()
+        durations = sorted(self.session.turn_durations.values())
+        # 記録を超えたページ送りにかける時間
+        self._extra_turn = durations[len(durations) // 2] if durations else 0.0
+
+    def _load_turn(self):
+        """現在のページ送りの後に見える可能性のあるフレームを読み込み、それ以外を捨てる"""
+        frame_ids = self.session.frames_of(self.turn)
+        for key in list(self._cache):
+            if key[0] not in frame_ids:
+                del self._cache[key]
+        for elapsed, grab_id, sample_id, duration in self.session.timeline[self.turn]:
+            self._frame(grab_id, True)
+            self._frame(sample_id, False)
+
+    def _frame(self, frame_id, for_grab):
+        # 撮影の代わりにするフレームは、撮影と大きさが違えば拡大縮小する
+        resize = for_grab and self.session.frame_size(frame_id) != self.session.grab_size
+        key = (frame_id, resize)
+        if key not in self._cache:
+            self._cache[key] = self.session.load_frame(
+                frame_id, self.session.grab_size if resize else None)
+        return self._cache[key]
+
+    def _visible(self, for_grab):
+        entry = self.session.visible(self.turn, (self._clock() - self._turned_at) * self.speed)
+        if entry is None:
+            raise RuntimeError(f"{self.session.path} には記録したフレームがありません")
+        elapsed, grab_id, sample_id, duration = entry
+        frame = self._frame(grab_id if for_grab else sample_id, for_grab)
+        self._sleep(duration / self.speed)
+        return frame
+
+    def grab(self):
+        return self._visible(True)
+
+    def sample(self):
+        return self._visible(False)
+
+    def next_page(self):
+        started = self._clock()
+        self.turn_count += 1
+        if self.turn < self.session.turns:
+            self.turn += 1
+            self._load_turn()
+            duration = self.session.turn_durations.get(self.turn, 0.0)
+        else:
+            duration = self._extra_turn
+        self._turned_at = started
+        remaining = duration / self.speed - (self._clock() - started)
+        if remaining > 0:
+            self._sleep(remaining)
+
+    def page_of(self, frame):
+        """フレームが記録時に撮影した何番目のページ（0から）か（描きかけ・不明ならNone）
+
+        直前に grab() したフレームに対して使う。
+        """
+        for (frame_id, resized), cached in self._cache.items():
+            if frame is cached and frame_id in self.session.pages:
+                return self.session.pages.index(frame_id)
+        return None
+
+    def close(self):
+        self.session.close()
+
+
+def find_kindle_window_id():
+    """KindleアプリのウィンドウID（CGWindowID）を取得（見つからなければNone）"""
+    import Quartz
+
+    # ウィンドウ一覧を取得
+    window_list = Quartz.CGWindowListCopyWindowInfo(
+        Quartz.kCGWindowListOptionOnScreenOnly,
+        Quartz.kCGNullWindowID
+    )
+
+    kindle_windows = []
+    for window in window_list:
+        owner_name = window.get('kCGWindowOwnerName', '')
+
+        # Kindleアプリのウィンドウを探す
+        if owner_name == 'Kindle':
+            window_id = window.get('kCGWindowNumber')
+            bounds = window.get('kCGWindowBounds', {})
+            width = bounds.get('Width', 0)
+            height = bounds.get('Height', 0)
+            # サイズが十分なウィンドウのみ（メインウィンドウ）
+            if width > 100 and height > 100:
+                kindle_windows.append((window_id, width * height))
+
+    if kindle_windows:
+        # 最も大きいウィンドウを選択
+        kindle_windows.sort(key=lambda x: x[1], reverse=True)
+        return kindle_windows[0][0]
+    return None
+
+
+BACKENDS = {
+    "kindle": KindleBackend,
+    "synthetic": SyntheticBackend,
+    "replay": ReplayBackend,
+}
+
+
+def create_backend(name="kindle", **options):
+    """キャプチャバックエンドを作成"""
+    return BACKENDS[name](**options)
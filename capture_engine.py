@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""
+キャプチャエンジン
+CLI版・GUI版で共通のキャプチャ処理（バックエンドの準備・撮影・ページ送り・待機・
+指紋計算・エンコード・PDF書き出し・ジャーナル記録）を行う。
+
+進行状況は StatusEvent / ProgressEvent として listener に通知する。
+GUI版では EventThrottle を通して、同じ種類のイベントをまとめてからTkのメインループに渡す。
+cancel() はイベントで通知するため、ページ送り後の待機中でもすぐにキャンセルされる。
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+
+from archive_writer import create_writer
+from capture_backend import create_backend
+from capture_pipeline import (CapturePipeline, EndOfBookDetector, PageAssembler,
+                              remove_pages_after)
+from fingerprint import DEFAULT_THRESHOLD, Fingerprint, fingerprint_frame
+from frame_spool import DEFAULT_LIMIT, SPOOL_FILE, FrameSpool, SpoolFull, page_number, saved_pages
+from journal import CaptureJournal, load_features
+from page_classifier import PageClassifier
+from page_encoder import PageEncoder
+from page_settle import PageSettler
+from page_store import PageStore
+from page_turner import PageTurnerError
+from pdf_writer import add_image_files
+from stage_timer import StageTimer
+from trim import AutoTrimmer, trim_box_for_images
+
+COUNTDOWN_SECONDS = 3
+
+
+class CaptureError(Exception):
+    """キャプチャを開始できない（メッセージはそのまま利用者に表示する）"""
+
+
+class CaptureCancelled(Exception):
+    """キャプチャがキャンセルされた"""
+
+
+class StatusEvent:
+    """状態の変化を表すメッセージ"""
+
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+
+class ProgressEvent:
+    """ページを撮影した
+
+    total はページ数を指定した場合のみ（自動検出モードではNone）、
+    eta はここまでの速度から見積もった残り秒数（total がない場合はNone）。
+    """
+
+    __slots__ = ('page_num', 'total', 'pages_per_minute', 'eta')
+
+    def __init__(self, page_num, total, pages_per_minute, eta):
+        self.page_num = page_num
+        self.total = total
+        self.pages_per_minute = pages_per_minute
+        self.eta = eta
+
+
+class CaptureResult:
+    """キャプチャの結果"""
+
+    __slots__ = ('output_path', 'page_count', 'last_page', 'cancelled', 'image_dir',
+                 'shared_pages', 'shared_bytes', 'dropped_pages', 'page_classes')
+
+    def __init__(self, output_path, page_count, last_page, cancelled, image_dir,
+                 shared_pages=0, shared_bytes=0, dropped_pages=0, page_classes=None):
+        self.output_path = output_path
+        # PDFのページ数
+        self.page_count = page_count
+        # 自動検出した最後のページ（検出していなければNone）
+        self.last_page = last_page
+        self.cancelled = cancelled
+        # ページ画像を保存したディレクトリ（保存しない場合はNone）
+        self.image_dir = image_dir
+        # 画像を共有したページ数と削減したバイト数、削除した連続する重複ページ数
+        self.shared_pages = shared_pages
+        self.shared_bytes = shared_bytes
+        self.dropped_pages = dropped_pages
+        # 分類ごとのページ数（分類しない場合は空）
+        self.page_classes = page_classes or {}
+
+
+class EventThrottle:
+    """別スレッドのイベントを種類ごとにまとめ、一定間隔でメインループに渡す
+
+    post: Tkの root.after のように (ミリ秒, 関数) を受け取り、メインループで関数を実行するもの
+    handler: メインループで各イベントを受け取る関数
+    同じ種類のイベントは最新のものだけを残すため、ページ数に関係なく
+    メインループへのコールバックは interval 秒に1回までになる。
+    """
+
+    def __init__(self, post, handler, interval=0.1, clock=time.monotonic):
+        self._post = post
+        self._handler = handler
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._scheduled = False
+        self._last_flush = None
+
+    def __call__(self, event):
+        with self._lock:
+            self._pending[type(event)] = event
+            if self._scheduled:
+                return
+            self._scheduled = True
+            delay = 0.0
+            if self._last_flush is not None:
+                delay = max(0.0, self.interval - (self._clock() - self._last_flush))
+        self._post(int(delay * 1000), self.flush)
+
+    def flush(self):
+        """溜まっているイベントを渡す（メインループで実行）"""
+        with self._lock:
+            events = list(self._pending.values())
+            self._pending.clear()
+            self._scheduled = False
+            self._last_flush = self._clock()
+        for event in events:
+            self._handler(event)
+
+
+class CaptureEngine:
+    """キャプチャ処理を行うエンジン（run() は1回だけ呼ぶ）
+
+    output_path: 出力ファイル
+    output_format: 出力形式（'pdf' / 'cbz' / 'tiff' / 'webp'、archive_writer）
+    pages: キャプチャするページ数（Noneなら最後のページを自動検出）
+    work_dir: ジャーナル（と keep_images=True の場合のページ画像）を記録するディレクトリ
+    build_pdf=False の場合はエンコードせずにページ画像とジャーナルだけを work_dir に保存し、
+    PDFは保存した画像から後で作る（job_queue で次の本のキャプチャと並行して作る場合）。
+    spool（'zlib' / 'raw'）を指定した場合、ページ画像はPNGの代わりに work_dir のスプールファイル
+    （frame_spool）に spool_limit バイトまで保存する。
+    thumbnails=True の場合はページのサムネイルを埋め込み、linearize=True の場合は
+    閉じるときにPDFを線形化（Fast Web View）する。
+    record_session を指定した場合は、撮影したフレームとページ送りのタイミングをそのファイルに記録する
+    （session_archive、backend="replay" で再生できる）。
+    その他の引数はCLI版のオプションと同じ。
+    """
+
+    def __init__(self, output_path, backend="kindle", backend_options=None, pages=None,
+                 delay=1.0, settle="fixed", max_wait=3.0, match_threshold=DEFAULT_THRESHOLD,
+                 start_page=1, resume=False, append=False, keep_images=False, trim=False,
+                 encoding="jpeg", quality=75, max_width=None, dpi=None, workers=2, jobs=1,
+                 dedup="share", classify=False, build_pdf=True, spool=None,
+                 spool_limit=DEFAULT_LIMIT, thumbnails=False, linearize=False, output_format="pdf",
+                 trace_path=None, record_session=None, work_dir=None, listener=None):
+        self.output_path = output_path
+        self.output_format = output_format
+        self.backend_name = backend
+        self.backend_options = backend_options or {}
+        self.pages = pages
+        self.delay = delay
+        self.settle = settle
+        self.max_wait = max_wait
+        self.match_threshold = match_threshold
+        self.start_page = start_page
+        self.resume = resume
+        self.append = append
+        self.keep_images = keep_images
+        self.trim = trim
+        self.workers = workers
+        self.jobs = jobs
+        # 内容が同じページ（off: そのまま / share: 画像を共有 / drop: 連続する重複を削除）
+        self.dedup = dedup
+        self.store = PageStore() if dedup != "off" else None
+        # ページを分類し、白紙を削除・見開きを左右の2ページに分ける
+        self.classifier = PageClassifier() if classify else None
+        self.build_pdf = build_pdf
+        self.spool = spool
+        self.spool_limit = spool_limit
+        self.linearize = linearize
+        self.record_session = record_session
+        self.work_dir = Path(work_dir) if work_dir is not None else Path("kindle_screenshots")
+        self.image_dir = self.work_dir if keep_images or not build_pdf else None
+        self._listener = listener or (lambda event: None)
+        self._cancel = threading.Event()
+        self.encoder = PageEncoder(encoding, quality, max_width, dpi, thumbnails,
+                                   webp=output_format == "webp")
+        self.timer = StageTimer(trace_path=trace_path)
+
+    def cancel(self):
+        """キャプチャをキャンセル（待機中でもすぐに止まる）"""
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def _status(self, message):
+        self._listener(StatusEvent(message))
+
+    def _sleep(self, seconds):
+        """キャンセルされるまで待つ（キャンセルされたら CaptureCancelled）"""
+        if self._cancel.wait(seconds):
+            raise CaptureCancelled()
+
+    def _check(self):
+        """オプションの組み合わせと入力ファイルを確認"""
+        if sum((self.resume, self.append, self.start_page > 1)) > 1:
+            raise CaptureError("再開・追加・開始ページの指定は同時に使えません。")
+        if not self.build_pdf and (self.append or self.start_page > 1):
+            raise CaptureError("画像だけを保存する場合は、追加・開始ページの指定は使えません。")
+        if not self.build_pdf and self.resume and not (
+                self.spool and (self.work_dir / SPOOL_FILE).exists()):
+            raise CaptureError("画像だけを保存したキャプチャは、スプールに保存した場合のみ再開できます。")
+        if self.output_format != "pdf" and self.append:
+            raise CaptureError("ページを追加できるのはPDFのみです。")
+        if self.append and self.linearize:
+            # 追加は既存のPDFに増分更新で書き足すためのもので、ファイル全体を並べ替える線形化とは両立しない
+            raise CaptureError("ページの追加と線形化は同時に使えません。")
+        if self.append and not os.path.exists(self.output_path):
+            raise CaptureError(f"追加先のPDFがありません: {self.output_path}")
+        if self.resume and not (self.work_dir / "journal.jsonl").exists():
+            raise CaptureError(
+                f"再開できるキャプチャがありません（{self.work_dir} にジャーナルがありません）。")
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise CaptureError("Pillowがインストールされていません。\n"
+                               "インストール: pip install Pillow")
+        if self.output_format == "webp":
+            from PIL import features
+            if not features.check('webp'):
+                raise CaptureError("このPillowはWebPに対応していません。")
+        if self.classifier is not None:
+            try:
+                import numpy  # noqa: F401
+            except ImportError:
+                raise CaptureError("ページの分類にはNumPyが必要です。\n"
+                                   "インストール: pip install numpy")
+
+    def _open_backend(self):
+        """キャプチャバックエンドを開く（Kindleの場合はアプリをアクティブ化してウィンドウを探す）"""
+        if self.backend_name == "synthetic":
+            self._status(f"合成した本（{self.backend_options.get('pages', 50)}ページ）を使用します。")
+            return create_backend("synthetic", **self.backend_options)
+        if self.backend_name == "replay":
+            try:
+                backend = create_backend("replay", **self.backend_options)
+            except (OSError, ValueError) as e:
+                raise CaptureError(f"記録したセッションを開けません: {e}")
+            self._status(f"記録したセッション（{backend.session.turns}回のページ送り）を再生します。")
+            return backend
+
+        self._status("Kindleアプリをアクティブ化中...")
+        try:
+            backend = create_backend(self.backend_name,
+                                     on_warning=lambda message: self._status(f"警告: {message}"),
+                                     **self.backend_options)
+        except ImportError:
+            raise CaptureError("PyObjCがインストールされていません。\n"
+                               "インストール: pip install pyobjc-framework-Quartz")
+        except RuntimeError as e:
+            raise CaptureError(str(e))
+        self._status(f"ウィンドウID: {backend.window_id}")
+        return backend
+
+    def _countdown(self):
+        """Kindleで開始ページを表示する時間をとる"""
+        if self.resume:
+            self._status("Kindleアプリで前回最後に記録したページ、またはその次のページを表示してください。")
+        else:
+            self._status("Kindleアプリで最初のページを表示していることを確認してください。")
+        for i in range(COUNTDOWN_SECONDS, 0, -1):
+            self._status(f"{i}秒後にキャプチャを開始...")
+            self._sleep(1)
+
+    def _open_pdf(self, append=False):
+        """出力ファイルを開く（追記できない場合はNone）"""
+        if append:
+            try:
+                return create_writer(self.output_path, self.output_format, resolution=100.0,
+                                     append=True, linearize=self.linearize)
+            except (OSError, ValueError) as e:
+                self._status(f"警告: {e}")
+                return None
+        return create_writer(self.output_path, self.output_format, resolution=100.0,
+                             linearize=self.linearize)
+
+    def _open_writer(self, journal):
+        """出力PDFを開き、(writer, 書き出し済みのページ数, 次のページ番号) を返す
+
+        再開・追加の場合は既存のPDFに追記し、書き出し済みのページは書き直さない
+        （PDF以外は追記できないため、再開時はジャーナルの全ページから書き直す）。
+        """
+        writer = None
+        skip_pages = 0
+        page_num = self.start_page
+        if self.append:
+            writer = self._open_pdf(append=True)
+            if writer is None:
+                raise CaptureError(f"{self.output_path} にはページを追加できません。")
+            page_num = writer.page_count + 1
+        elif self.resume and self.output_format == "pdf" and os.path.exists(self.output_path):
+            writer = self._open_pdf(append=True)
+            if writer is not None and writer.page_count > journal.page_count:
+                # ジャーナルより多くのページがある場合は別のPDFとみなして作り直す
+                writer.abort()
+                writer = None
+            if writer is not None:
+                skip_pages = writer.page_count
+        if writer is None:
+            writer = self._open_pdf()
+        return writer, skip_pages, page_num
+
+    def _add_saved_pages(self, writer):
+        """開始ページより前に保存したページ画像をPDFの先頭に追加"""
+        image_files = [
+            path for path in saved_pages(self.image_dir)
+            if page_number(path) < self.start_page
+        ]
+        if image_files:
+            self._status(f"保存済みの{len(image_files)}ページをPDFに追加中...")
+            box = trim_box_for_images(image_files) if self.trim else None
+            add_image_files(writer, image_files, box=box, encoder=self.encoder, jobs=self.jobs,
+                            store=self.store, classifier=self.classifier,
+                            on_warning=lambda message: self._status(f"警告: {message}"))
+
+    def run(self):
+        """キャプチャしてPDFを作成し、CaptureResultを返す
+
+        開始できない場合は CaptureError。キャンセル・Ctrl+Cの場合は、確定したページまでで
+        PDFを閉じ、ジャーナルを残して cancelled=True の結果を返す（resume=True で再開できる）。
+        """
+        try:
+            self._check()
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            backend = self._open_backend()
+            if self.record_session:
+                from capture_backend import RecordingBackend
+
+                try:
+                    backend = RecordingBackend(backend, self.record_session)
+                except BaseException:
+                    backend.close()
+                    raise
+                self._status(f"キャプチャを {self.record_session} に記録します。")
+            try:
+                return self._run(backend)
+            finally:
+                backend.close()
+        finally:
+            self.timer.close()
+
+    def _run(self, backend):
+        timer = self.timer
+        if self.backend_name == "kindle":
+            try:
+                self._countdown()
+            except (CaptureCancelled, KeyboardInterrupt):
+                return CaptureResult(self.output_path, 0, None, True, self.image_dir)
+
+        # キャプチャループ
+        # 撮影とページ送りはこのスレッドで行い、指紋計算・エンコードはワーカーで行う
+        auto_detect = self.pages is None
+        max_pages = self.pages if self.pages else 99999
+        last_page = None
+
+        settler = None
+        if self.settle == "adaptive":
+            # 縮小フレームを監視し、描画が落ち着いたら次のページを撮影する
+            settler = PageSettler(
+                sample=backend.sample,
+                turn_page=backend.next_page,
+                max_wait=self.max_wait,
+                threshold=self.match_threshold,
+                sleep=self._sleep
+            )
+            settler.reset()
+
+        if self.classifier is not None and self.start_page > 1 and self.image_dir is not None:
+            # 保存済みのページ画像の特徴量は、新しいジャーナルを始める前に前回の記録から読む
+            self.classifier.cache.update(load_features(self.work_dir))
+        journal = CaptureJournal(self.work_dir, resume=self.resume, output=self.output_path,
+                                 encoding=self.encoder.mode, quality=self.encoder.quality,
+                                 deferred=not self.build_pdf)
+        writer, skip_pages, page_num = None, 0, self.start_page
+        if self.build_pdf:
+            try:
+                writer, skip_pages, page_num = self._open_writer(journal)
+            except BaseException:
+                journal.close()
+                raise
+        detector = EndOfBookDetector(threshold=self.match_threshold) if auto_detect else None
+        assembler = PageAssembler(writer, detector, skip_pages,
+                                  drop_duplicates=self.dedup == "drop")
+        # 画像だけを保存する場合は、PDFを作るときに全ページから切り抜き範囲を求める
+        trimmer = AutoTrimmer() if self.trim and self.build_pdf else None
+
+        pipeline = None
+        spool = None
+        try:
+            if self.resume:
+                # 記録済みのページをPDFに書き出し、最後のページの判定状態を復元する
+                if journal.session.get('output') != self.output_path:
+                    self._status(f"警告: ジャーナルは {journal.session.get('output')} の作成時のものです。")
+                if journal.entries:
+                    if skip_pages:
+                        self._status(f"PDFに書き出し済みの{skip_pages}ページに追記します。")
+                    if writer is None:
+                        self._status(f"記録済みの{len(journal.entries)}ページの状態を復元中...")
+                    else:
+                        self._status(f"記録済みの{journal.page_count - skip_pages}ページをPDFに追加中...")
+                    last_page = assembler.update(journal.replay(skip_pages))
+                    page_num = journal.last_page + 1
+                if journal.end_page is not None:
+                    last_page = journal.end_page
+                elif journal.entries and fingerprint_frame(backend.grab()).matches(
+                        Fingerprint.from_hex(journal.entries[-1]['fingerprint']),
+                        self.match_threshold):
+                    # 前回最後に記録したページが表示されている場合は次のページへ進める
+                    backend.next_page()
+                    self._sleep(self.delay)
+            elif self.start_page > 1 and self.image_dir is not None:
+                self._add_saved_pages(writer)
+
+            if self.spool and self.image_dir is not None:
+                spool = FrameSpool(self.work_dir / SPOOL_FILE, self.spool_limit, self.spool,
+                                   append=self.resume or self.start_page > 1)
+                # 前回ジャーナルに記録する前に終了したページ（と開始ページ以降）は撮影し直す
+                spool.discard_after(page_num - 1)
+
+            with CapturePipeline(None if spool else self.image_dir, workers=self.workers,
+                                 encoder=self.encoder,
+                                 store=self.store if self.build_pdf else None,
+                                 classifier=self.classifier, encode=self.build_pdf,
+                                 spool=spool) as pipeline:
+                try:
+                    while last_page is None and page_num <= max_pages:
+                        if self.cancelled:
+                            raise CaptureCancelled()
+
+                        # スクリーンショット撮影（エンコードはワーカーで実行）
+                        timer.pages += 1
+                        with timer.stage('capture'):
+                            frame = backend.grab()
+                        # ワーカーが追いつかない場合はここで待つ
+                        with timer.stage('queue'):
+                            if trimmer is None:
+                                pipeline.submit(page_num, frame)
+                            else:
+                                # 共通の切り抜き範囲が決まるまで最初の数ページは保留される
+                                for item in trimmer.add(page_num, frame):
+                                    pipeline.submit(*item)
+
+                        # 自動検出モード: 同じ画像が3回続いたら終了
+                        results = pipeline.completed()
+                        timer.add_results(results)
+                        with timer.stage('write'):
+                            journal.record(results)
+                            last_page = assembler.update(results)
+                        if last_page is not None:
+                            break
+
+                        eta = None if auto_detect else timer.eta(max_pages - page_num)
+                        self._listener(ProgressEvent(
+                            page_num, None if auto_detect else max_pages,
+                            timer.pages_per_minute(), eta))
+
+                        # ページ送り（待機中もワーカーはエンコードを続ける）
+                        if settler is None:
+                            with timer.stage('turn'):
+                                backend.next_page()
+                            with timer.stage('wait'):
+                                self._sleep(self.delay)
+                        else:
+                            with timer.stage('settle'):
+                                changed = settler.next_page()
+                            if not changed:
+                                # ページ送りをやり直しても変化しない場合は最後のページ
+                                break
+                        page_num += 1
+                finally:
+                    # トリミング範囲の決定待ちで保留しているフレームも処理する
+                    if trimmer is not None:
+                        for item in trimmer.flush():
+                            pipeline.submit(*item)
+
+                # 残りのフレームの処理を待つ
+                with timer.stage('drain'):
+                    results = pipeline.drain()
+                timer.add_results(results)
+                with timer.stage('write'):
+                    journal.record(results)
+                    detected = assembler.update(results)
+                if last_page is None:
+                    last_page = detected
+                assembler.finish()
+
+        except (CaptureCancelled, KeyboardInterrupt, SpoolFull, PageTurnerError) as e:
+            if isinstance(e, (SpoolFull, PageTurnerError)):
+                self._status(f"{e}。キャプチャを中断します。")
+            # 確定したページまででPDFを閉じ、再開時はその後ろに追記する
+            if writer is not None:
+                writer.close()
+            # 撮影済みのフレームは処理が終わっているので、ジャーナルに記録してから閉じる
+            # （スプールに書き込めなかったページがあれば、その前のページまで）
+            if pipeline is not None:
+                journal.record(pipeline.completed(raise_error=False))
+            journal.close()
+            if spool is not None:
+                spool.close()
+            return CaptureResult(self.output_path, assembler.pages if writer is None
+                                 else writer.page_count, None, True, self.image_dir)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            journal.close()
+            if spool is not None:
+                spool.close()
+            raise
+
+        if last_page is not None:
+            if journal.end_page is None:
+                journal.mark_end(last_page)
+            # 重複した画像を削除
+            if spool is not None:
+                spool.discard_after(last_page)
+            elif self.image_dir is not None:
+                remove_pages_after(self.image_dir, last_page)
+            self._status(f"最後のページを検出しました（{last_page}ページ）")
+
+        if spool is not None:
+            spool.close()
+        # 画像を保持する場合はジャーナルも残し、後からPDFを作り直せるようにする
+        if writer is None:
+            journal.close()
+            return CaptureResult(self.output_path, assembler.pages, last_page, False,
+                                 self.image_dir, page_classes=assembler.page_classes)
+
+        # PDFを閉じる
+        self._status("PDFを作成中...")
+        with timer.stage('close'):
+            writer.close()
+
+        if self.image_dir is not None:
+            journal.close()
+        else:
+            journal.remove()
+        return CaptureResult(self.output_path, writer.page_count, last_page, False, self.image_dir,
+                             writer.shared_pages, writer.shared_bytes, assembler.dropped,
+                             assembler.page_classes)
+
+    def duplicate_report(self, result):
+        """重複ページの内訳（表示用の行のリスト、重複がなければ空）"""
+        if self.store is None:
+            return []
+        return self.store.report(result.shared_pages, result.shared_bytes, result.dropped_pages)
+
+    def classify_report(self, result):
+        """ページの分類の内訳（表示用の行のリスト、分類しない場合は空）"""
+        if self.classifier is None:
+            return []
+        return self.classifier.report(result.page_classes)
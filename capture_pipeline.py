@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+キャプチャパイプライン
+キャプチャスレッドは生のフレームを取得してキューに渡すだけにし、
+指紋計算・PDF用のエンコードはワーカースレッドで行う。
+ページ送り後の待機時間とエンコード処理を重ねることで、1ページあたりの時間を短縮する。
+フレームはPNGファイルを経由せずにPDFへ書き出し、PNGは画像を保持する場合のみ保存する
+（スプールを指定した場合はPNGの代わりにスプールファイルに追記する）。
+"""
+
+import queue
+import threading
+import time
+
+from fingerprint import DEFAULT_THRESHOLD, fingerprint_frame, fingerprint_image
+from frame import Frame
+from page_classifier import SAMPLE_SIZE
+from page_store import frame_key, part_key
+from pdf_writer import encode_image
+
+
+def grab_window(window_id, nominal_resolution=False):
+    """指定ウィンドウを撮影し、エンコードせずに生のフレームを返す
+
+    nominal_resolution=True の場合はRetinaの等倍解像度で撮影する（比較用の軽いサンプル向け）
+    """
+    from Quartz import (CGDataProviderCopyData, CGImageGetBytesPerRow,
+                        CGImageGetDataProvider, CGImageGetHeight,
+                        CGImageGetWidth, CGRectNull, CGWindowListCreateImage,
+                        kCGWindowImageDefault,
+                        kCGWindowImageNominalResolution,
+                        kCGWindowListOptionIncludingWindow)
+
+    image_option = kCGWindowImageDefault
+    if nominal_resolution:
+        image_option |= kCGWindowImageNominalResolution
+
+    image = CGWindowListCreateImage(
+        CGRectNull,
+        kCGWindowListOptionIncludingWindow,
+        int(window_id),
+        image_option
+    )
+
+    if image is None:
+        raise RuntimeError(f"ウィンドウ {window_id} のキャプチャに失敗しました")
+
+    # CFDataのバッファをコピーせずにそのまま保持する（macOSのキャプチャはBGRA形式）
+    data = CGDataProviderCopyData(CGImageGetDataProvider(image))
+    return Frame(
+        data,
+        CGImageGetWidth(image),
+        CGImageGetHeight(image),
+        CGImageGetBytesPerRow(image),
+        'BGRA'
+    )
+
+
+class PageResult:
+    """ワーカーで処理が終わったページの情報"""
+
+    __slots__ = ('page_num', 'fingerprint', 'encoded', 'path', 'timings', 'started', 'worker',
+                 'key', 'page_class', 'features', 'right')
+
+    def __init__(self, page_num, fingerprint, encoded, path=None, timings=None, started=None,
+                 worker=None, key=None, page_class=None, features=None, right=None):
+        self.page_num = page_num
+        self.fingerprint = fingerprint
+        self.encoded = encoded
+        self.path = path
+        # 処理段階ごとの所要時間（秒）
+        self.timings = timings or {}
+        # 処理を始めた時刻（time.perf_counter）と処理したワーカー名（トレース出力用）
+        self.started = started
+        self.worker = worker
+        # ページの内容を表すキー（page_store.frame_key、重複ページを共有しない場合はNone）
+        self.key = key
+        # ページの分類と特徴量（page_classifier、分類しない場合はNone）
+        # 白紙のページは encoded がNone、見開きは encoded が左・right が右のページ
+        self.page_class = page_class
+        self.features = features
+        self.right = right
+
+    def pages(self):
+        """PDFに書き出す (EncodedImage, キー) のリスト（白紙は空、見開きは左右の2ページ）"""
+        if self.page_class == 'blank':
+            return []
+        if self.page_class == 'spread':
+            return [(self.encoded, part_key(self.key, 0)), (self.right, part_key(self.key, 1))]
+        return [(self.encoded, self.key)]
+
+
+class CapturePipeline:
+    """フレームの指紋計算・エンコードを並行して行うパイプライン
+
+    キューの長さに上限があるため、ワーカーが追いつかない場合は
+    submit() がブロックし、メモリ上に保持するフレーム数は一定に保たれる。
+    image_dir を指定した場合のみ、各ページをPNGとしても保存する。
+    encoder（page_encoder.PageEncoder）を指定した場合はページごとにエンコード方式を選ぶ
+    （サムネイルを作るエンコーダーには、指紋の計算に使った縮小画像を渡す）。
+    store（page_store.PageStore）を指定した場合は、内容が同じページのエンコードを省略する。
+    classifier（page_classifier.PageClassifier）を指定した場合は、白紙のページをエンコードせず、
+    見開きは左右の2ページに分けてエンコードする。
+    encode=False の場合はエンコードせずにPNGだけを保存する（PDFは保存した画像から後で作る）。
+    spool（frame_spool.FrameSpool）を指定した場合は、PNGの代わりにフレームをスプールに追記する
+    （容量は submit() で予約し、足りなければ frame_spool.SpoolFull を送出する）。
+    """
+
+    def __init__(self, image_dir=None, workers=2, max_pending=4, encoder=None, store=None,
+                 classifier=None, encode=True, spool=None):
+        self.image_dir = image_dir
+        self._spool = spool
+        self._encode = encoder.encode if encoder is not None else encode_image
+        self._thumbnails = encoder is not None and encoder.thumbnails
+        self._encode_pages = encode
+        self._store = store
+        self._classifier = classifier
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._results = {}
+        self._results_lock = threading.Lock()
+        self._error = None
+        self._next_result = None
+        self._threads = []
+        for index in range(max(workers, 1)):
+            thread = threading.Thread(target=self._worker, name=f"worker-{index + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def page_path(self, page_num):
+        return self.image_dir / f"page_{page_num:04d}.png"
+
+    def submit(self, page_num, frame, box=None):
+        """フレームをキューに追加（キューが満杯の場合はブロック）
+
+        box を指定した場合は、その範囲を切り抜いてからエンコードする。
+        """
+        self._raise_error()
+        reserved = self._spool.reserve(frame) if self._spool is not None else 0
+        if self._next_result is None:
+            self._next_result = page_num
+        self._queue.put((page_num, frame, box, reserved))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            page_num, frame, box, reserved = item
+            try:
+                result = self._process(page_num, frame, box, reserved)
+            except Exception as e:
+                with self._results_lock:
+                    if self._error is None:
+                        self._error = e
+            else:
+                with self._results_lock:
+                    self._results[page_num] = result
+            finally:
+                self._queue.task_done()
+
+    def _process(self, page_num, frame, box, reserved=0):
+        # 指紋は切り抜き前のフレームで計算し、トリミングの有無に左右されないようにする
+        start = time.perf_counter()
+        sample = None
+        if self._classifier is None and not (self._thumbnails and self._encode_pages):
+            page_fingerprint = fingerprint_frame(frame)
+        else:
+            # 分類とサムネイルには指紋と同じ縮小画像を使う
+            sample = frame.sample(SAMPLE_SIZE, SAMPLE_SIZE)
+            page_fingerprint = fingerprint_image(sample)
+        fingerprinted = time.perf_counter()
+        timings = {'fingerprint': fingerprinted - start}
+        page_class = features = None
+        parts = [box]
+        if self._classifier is not None:
+            page_class, features, parts = self._classifier.classify_sample(sample, frame.size, box)
+            timings['classify'] = time.perf_counter() - fingerprinted
+        key = None
+        if self._store is not None:
+            key_start = time.perf_counter()
+            key = frame_key(frame, page_fingerprint, box)
+            timings['dedup'] = time.perf_counter() - key_start
+        # 切り抜き前の画像はPNGに保存する場合だけ作る
+        img = frame.to_image() if self.image_dir is not None else None
+        if self._encode_pages:
+            encoded = [
+                self._encode_part(frame, part, key if len(parts) == 1 else part_key(key, index),
+                                  img, timings, sample)
+                for index, part in enumerate(parts)
+            ]
+        else:
+            encoded = [None] * len(parts)
+        encoded_at = time.perf_counter()
+        path = None
+        if self.image_dir is not None:
+            # 保存する画像は切り抜き前のもの（後で別の設定でPDFを作り直せるように）
+            path = self.page_path(page_num)
+            img.save(path, 'PNG')
+            timings['save'] = time.perf_counter() - encoded_at
+        elif self._spool is not None:
+            path = self._spool.append(page_num, frame, reserved)
+            timings['spool'] = time.perf_counter() - encoded_at
+        return PageResult(page_num, page_fingerprint, encoded[0] if encoded else None, path,
+                          timings, start, threading.current_thread().name, key,
+                          page_class, features, encoded[1] if len(encoded) > 1 else None)
+
+    def _encode_part(self, frame, box, key, img, timings, sample=None):
+        """フレームの box の範囲をエンコード（内容が同じページがあれば再利用する）"""
+        if key is not None:
+            dedup_start = time.perf_counter()
+            encoded = self._store.get(key)
+            timings['dedup'] += time.perf_counter() - dedup_start
+            if encoded is not None:
+                return encoded
+        encode_start = time.perf_counter()
+        try:
+            # 縮小はエンコーダーが行う
+            if box:
+                page_img = frame.crop(box).to_image()
+            else:
+                page_img = img if img is not None else frame.to_image()
+            if self._thumbnails:
+                encoded = self._encode(page_img, (sample, frame.size, box))
+            else:
+                encoded = self._encode(page_img)
+        except BaseException:
+            if key is not None:
+                self._store.release(key)
+            raise
+        seconds = time.perf_counter() - encode_start
+        timings['encode'] = timings.get('encode', 0.0) + seconds
+        if key is not None:
+            self._store.put(key, encoded, seconds)
+        return encoded
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def completed(self, raise_error=True):
+        """処理が終わったページをページ順に返す（ブロックしない）
+
+        raise_error=False の場合は、ワーカーでエラーが起きていてもその前のページまでを返す。
+        """
+        finished = []
+        with self._results_lock:
+            if raise_error:
+                self._raise_error()
+            while self._next_result in self._results:
+                finished.append(self._results.pop(self._next_result))
+                self._next_result += 1
+        return finished
+
+    def drain(self):
+        """キュー内の全フレームの処理が終わるまで待ち、残りの結果をページ順に返す"""
+        self._queue.join()
+        return self.completed()
+
+    def close(self):
+        """ワーカースレッドを終了"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class EndOfBookDetector:
+    """同じページが続いたら最後のページと判断する（自動検出モード）
+
+    指紋のハミング距離が threshold 以下なら同じページとみなす。
+    """
+
+    def __init__(self, repeats=3, threshold=DEFAULT_THRESHOLD):
+        self.repeats = repeats
+        self.threshold = threshold
+        self.last_fingerprint = None
+        self.same_count = 0
+
+    def update(self, results):
+        """ページ順の結果を受け取り、最後のページを検出したらそのページ番号を返す"""
+        for result in results:
+            if result.fingerprint.matches(self.last_fingerprint, self.threshold):
+                self.same_count += 1
+                if self.same_count >= self.repeats:
+                    return result.page_num - self.same_count
+            else:
+                self.same_count = 0
+            self.last_fingerprint = result.fingerprint
+        return None
+
+
+class PageAssembler:
+    """ページ順の結果を受け取り、最後のページを検出しながらPDFへ書き出す
+
+    自動検出モードでは、同じページが続いている間はPDFへの書き出しを保留し、
+    最後のページと判断した場合は重複分を書き出さずに捨てる。
+    skip_pages を指定すると、最初のその数のページはPDFに書き出し済みとみなして書き出さない
+    （途中再開時にジャーナルを再生して判定状態だけを復元する場合）。
+    drop_duplicates=True の場合は、直前のページと内容（キー）が同じページを書き出さない。
+    分類したページのうち、白紙は書き出さず、見開きは左右の2ページとして書き出す
+    （skip_pages はPDFのページ数で数える）。
+    writer がNoneの場合は書き出さずに、PDFにするページを数えるだけにする。
+    """
+
+    def __init__(self, writer, detector=None, skip_pages=0, drop_duplicates=False):
+        self.writer = writer
+        self.detector = detector
+        self.last_page = None
+        self.drop_duplicates = drop_duplicates
+        self.dropped = 0
+        # PDFに書き出した（writer がNoneの場合は書き出す予定の）ページ数
+        self.pages = 0
+        # 分類 -> 書き出したフレーム数（白紙は削除した数、見開きは分割した数）
+        self.page_classes = {}
+        self._last_key = None
+        self._pending = []
+        self._skip_pages = skip_pages
+
+    def update(self, results):
+        """結果を処理し、最後のページを検出したらそのページ番号を返す
+
+        最後のページを検出した後に届いた結果は書き出さない。
+        """
+        for result in results:
+            if self.last_page is not None:
+                break
+            if self.detector is None:
+                self._write(result)
+                continue
+
+            last_page = self.detector.update([result])
+            if last_page is not None:
+                # 同じページが続いた最初の1枚だけを書き出す
+                self._flush(last_page)
+                self.last_page = last_page
+                return last_page
+            if self.detector.same_count == 0:
+                self._flush()
+            self._pending.append(result)
+        return None
+
+    def _flush(self, last_page=None):
+        for result in self._pending:
+            if last_page is None or result.page_num <= last_page:
+                self._write(result)
+        self._pending = []
+
+    def _write(self, result):
+        # 削除した重複ページは書き出し済みのページ数に含まれないので、先に判定する
+        if self.drop_duplicates and result.key is not None and result.key == self._last_key:
+            self.dropped += 1
+            return
+        self._last_key = result.key
+        if result.page_class is not None:
+            self.page_classes[result.page_class] = self.page_classes.get(result.page_class, 0) + 1
+        for encoded, key in result.pages():
+            if self._skip_pages > 0:
+                self._skip_pages -= 1
+                continue
+            self.pages += 1
+            if self.writer is not None:
+                self.writer.add_encoded_page(encoded, key)
+
+    def finish(self):
+        """保留中のページをすべて書き出す"""
+        self._flush()
+
+
+def remove_pages_after(image_dir, last_page):
+    """最後のページより後に撮影した重複画像を削除"""
+    for path in image_dir.glob("page_*.png"):
+        if int(path.stem.split('_')[1]) > last_page:
+            path.unlink()
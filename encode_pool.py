@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+プロセスプールによるページの並列エンコード
+保存済みのページ画像の読み込み・変換・圧縮を複数のプロセスで行い、
+PDFへの書き出しはメインプロセスがページ順に行う。
+同時に処理中のページ数に上限を設けるため、ページ数が多くてもメモリ使用量は一定。
+"""
+
+import time
+from collections import deque
+from pathlib import Path
+
+
+def encode_file(path, box=None, mode='jpeg', quality=75, max_width=None, dpi=None,
+                thumbnails=False, webp=False):
+    """ワーカープロセスで画像ファイルを1枚エンコードし、(EncodedImage, 分類, 秒数) を返す
+
+    path はスプールのページ（frame_spool.SpoolPage）でもよい（各プロセスでメモリマップして読む）。
+    thumbnails=True の場合はサムネイルも作る。webp=True の場合はWebPにエンコードする。
+    mode='png' の場合、PNGファイルはデコードせずにIDATをそのまま使う。
+    """
+    from frame_spool import SpoolPage, open_page
+    from page_encoder import encode_page, encode_thumbnail, png_passthrough
+    from trim import crop_to_box
+
+    start = time.perf_counter()
+    if mode == 'png' and not box and not webp and not isinstance(path, SpoolPage):
+        # 可逆圧縮ではPNGのIDATをデコードせずに使う（サムネイルを作る場合だけはデコードする）
+        result = png_passthrough(Path(path).read_bytes(), max_width, dpi)
+        if result is not None:
+            encoded, page_class = result
+            if thumbnails:
+                with open_page(path) as img:
+                    encoded.thumb = encode_thumbnail(img, gray=page_class == 'gray')
+            return encoded, page_class, time.perf_counter() - start
+    with open_page(path) as img:
+        img = crop_to_box(img, box)
+        encoded, page_class = encode_page(img, mode, quality, max_width, dpi, webp)
+        if thumbnails:
+            encoded.thumb = encode_thumbnail(img, gray=encoded.colorspace == 'DeviceGray')
+    return encoded, page_class, time.perf_counter() - start
+
+
+def encode_files(image_files, jobs, box=None, mode='jpeg', quality=75, max_in_flight=None,
+                 max_width=None, dpi=None, boxes=None, thumbnails=False, webp=False):
+    """画像ファイルを jobs 個のプロセスでエンコードし、ページ順に結果を返すジェネレーター
+
+    処理中のページは max_in_flight（省略時は jobs の2倍）までに抑え、
+    先頭のページが終わるたびに次のページを投入する。
+    boxes を指定した場合は、ファイルごとにその範囲を切り抜く（box の代わりに使う）。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_in_flight = max_in_flight or jobs * 2
+    files = iter(zip(image_files, boxes if boxes is not None else [box] * len(image_files)))
+    in_flight = deque()
+
+    # fork は呼び出し元のスレッドの状態を引き継いでしまうため、macOSと同じ spawn に揃える
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        try:
+            for path, file_box in files:
+                in_flight.append(executor.submit(encode_file, path, file_box, mode, quality,
+                                                 max_width, dpi, thumbnails, webp))
+                if len(in_flight) >= max_in_flight:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+ページの指紋（縮小画像による知覚ハッシュ）
+キャプチャしたフレームを縮小し、各画素が平均より暗いかどうかのビット列（aHash）で表して
+ハミング距離で比較する。
+PNGを読み直してフル解像度のMD5を取る方式と比べて計算が軽く、
+アンチエイリアスの揺らぎやカーソルの点滅程度の差は同じページとみなせる。
+"""
+
+# 縮小画像の一辺のサイズ（HASH_SIZE * HASH_SIZE ビット）
+HASH_SIZE = 64
+
+# 同じページとみなすハミング距離の上限（ビット数）
+DEFAULT_THRESHOLD = 8
+
+
+class Fingerprint:
+    """ページの指紋"""
+
+    __slots__ = ('bits', 'size')
+
+    def __init__(self, bits, size=HASH_SIZE):
+        self.bits = bits
+        self.size = size
+
+    def distance(self, other):
+        """ハミング距離（異なるビットの数）"""
+        return bin(self.bits ^ other.bits).count('1')
+
+    def matches(self, other, threshold=DEFAULT_THRESHOLD):
+        """同じページとみなせるか"""
+        return other is not None and self.distance(other) <= threshold
+
+    def hex(self):
+        return format(self.bits, '0%dx' % (self.size * self.size // 4))
+
+    @classmethod
+    def from_hex(cls, text, size=HASH_SIZE):
+        return cls(int(text, 16), size)
+
+    def __eq__(self, other):
+        return isinstance(other, Fingerprint) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return f"Fingerprint({self.hex()[:16]}...)"
+
+
+def fingerprint_image(img, size=HASH_SIZE):
+    """PIL画像の指紋を計算"""
+    from PIL import Image
+
+    # 最近傍法で間引いてから平均化すると、フル解像度のBOX縮小より一桁速い
+    if img.width > size * 4 and img.height > size * 4:
+        img = img.resize((size * 4, size * 4), Image.NEAREST)
+    small = img.resize((size, size), Image.BOX).convert('L')
+    pixels = small.tobytes()
+    mean = sum(pixels) / len(pixels)
+    bits = int(''.join('1' if value < mean else '0' for value in pixels), 2)
+    return Fingerprint(bits, size)
+
+
+def fingerprint_frame(frame, size=HASH_SIZE):
+    """キャプチャしたフレームの指紋を計算（PNGを経由しない）"""
+    return fingerprint_image(frame.sample(size * 4, size * 4), size)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+キャプチャしたフレーム
+生のピクセルバッファ（幅・高さ・1行のバイト数・ピクセル形式）をコピーせずに保持し、
+キャプチャから指紋計算・PDFエンコードまでPNGファイルを経由せずに受け渡す。
+合成したバッファからも作れるため、macOS以外でも処理全体を確認できる。
+"""
+
+# ピクセル形式ごとの (1画素のバイト数, PILのrawmode)
+PIXEL_FORMATS = {
+    'BGRA': (4, 'BGRX'),
+    'RGBA': (4, 'RGBX'),
+    'RGB': (3, 'RGB'),
+    'L': (1, 'L'),
+}
+
+
+class Frame:
+    """キャプチャした1フレーム分の生ピクセルデータ"""
+
+    __slots__ = ('buffer', 'width', 'height', 'stride', 'pixel_format')
+
+    def __init__(self, buffer, width, height, stride=None, pixel_format='BGRA'):
+        if pixel_format not in PIXEL_FORMATS:
+            raise ValueError(f"未対応のピクセル形式です: {pixel_format}")
+        bytes_per_pixel = PIXEL_FORMATS[pixel_format][0]
+        self.buffer = memoryview(buffer)
+        self.width = width
+        self.height = height
+        self.stride = stride or width * bytes_per_pixel
+        self.pixel_format = pixel_format
+        if len(self.buffer) < self.stride * (height - 1) + width * bytes_per_pixel:
+            raise ValueError("バッファがフレームのサイズより小さいです")
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def mode(self):
+        """PIL画像に変換したときのモード"""
+        return 'L' if self.pixel_format == 'L' else 'RGB'
+
+    def crop(self, box):
+        """指定範囲 (left, top, right, bottom) を切り抜いたフレーム（バッファは共有する）"""
+        left, top, right, bottom = box
+        bytes_per_pixel = PIXEL_FORMATS[self.pixel_format][0]
+        start = top * self.stride + left * bytes_per_pixel
+        end = (bottom - 1) * self.stride + right * bytes_per_pixel
+        return Frame(self.buffer[start:end], right - left, bottom - top,
+                     self.stride, self.pixel_format)
+
+    def to_image(self):
+        """PIL画像に変換（RGB/Lへの並べ替えのみ行い、元のバッファは変更しない）"""
+        from PIL import Image
+
+        rawmode = PIXEL_FORMATS[self.pixel_format][1]
+        return Image.frombuffer(self.mode, self.size, self.buffer,
+                                'raw', rawmode, self.stride, 1)
+
+    def sample(self, width, height):
+        """最近傍法で間引いた小さなPIL画像を返す（全画素の変換を行わない）"""
+        from PIL import Image
+
+        if self.pixel_format in ('BGRA', 'RGBA'):
+            # 4バイト形式はそのままRGBAとして読み込み、間引いてから色の順序を直す
+            img = Image.frombuffer('RGBA', self.size, self.buffer,
+                                   'raw', 'RGBA', self.stride, 1)
+            c0, c1, c2, _ = img.resize((width, height), Image.NEAREST).split()
+            if self.pixel_format == 'BGRA':
+                return Image.merge('RGB', (c2, c1, c0))
+            return Image.merge('RGB', (c0, c1, c2))
+        return self.to_image().resize((width, height), Image.NEAREST)
+
+    @classmethod
+    def from_image(cls, img, pixel_format='BGRA'):
+        """PIL画像からフレームを作成（合成フレームやテスト用）"""
+        from PIL import Image
+
+        img = img.convert('RGB')
+        if pixel_format == 'BGRA':
+            r, g, b = img.split()
+            data = Image.merge('RGBA', (b, g, r, Image.new('L', img.size, 255))).tobytes()
+        elif pixel_format == 'RGBA':
+            data = img.convert('RGBA').tobytes()
+        elif pixel_format == 'L':
+            data = img.convert('L').tobytes()
+        else:
+            data = img.tobytes()
+        return cls(data, img.width, img.height, pixel_format=pixel_format)
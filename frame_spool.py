@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+フレームのスプールファイル
+キャプチャしたフレームを1ページ1つのPNGとして保存する代わりに、生のピクセル（または
+zlibのレベル1で軽く圧縮したもの）を1つのファイルに追記する。PNGの圧縮をキャプチャ中に
+行わず、重いエンコードはPDFを作るときにまとめて行う。読み込みはファイルをメモリマップし、
+生のフレームはコピーせずに Frame として扱う。
+
+ファイル形式（数値はすべてリトルエンディアン）:
+    ヘッダー（64バイト）
+        magic "KSPOOL01"（8バイト）, version（u32）, 索引の件数の上限（u32）,
+        記録済みの件数（u32）, 予約（u32）, スプールID（u64）, データ領域の開始位置（u64）,
+        データ領域の終わり（u64、次に書き込む位置）
+    索引（件数の上限 × 64バイト、作成時に確保して大きさは変わらない）
+        ページ番号（u32）, 幅（u32）, 高さ（u32）, 1行のバイト数（u32）,
+        ピクセル形式（u8、PIXEL_CODES の位置）, 圧縮（u8、0: なし / 1: zlib）, 予約（u16）,
+        データの位置（u64）, データの長さ（u64）, 圧縮前の長さ（u64）, データのCRC32（u32）
+    データ領域（索引の後ろの4096バイト境界から）
+        フレームのデータを、それぞれ4096バイト境界に揃えて並べる
+
+ワーカーはデータを書いてから索引の項目を書き、最後に記録済みの件数を増やすため、
+途中で終了した場合も件数までの項目は完全に書かれている。同じページ番号の項目が複数ある場合は
+後の項目が有効（途中再開で撮影し直したページ）。
+作成時にファイルを容量の上限（max_bytes）の大きさまで広げ（実際のディスク領域は書き込んだ分だけ
+使う）、書き込む前に GROW_BYTES ずつディスク領域を確保する。上限または空き容量が足りなくなると
+reserve()（まれに、圧縮した結果が予約より大きい場合は append()）が SpoolFull を送出する。
+正常に閉じるとデータ領域の終わりで切り詰める。
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+from frame import PIXEL_FORMATS, Frame
+
+SPOOL_FILE = "frames.spool"
+SPOOL_MAGIC = b"KSPOOL01"
+SPOOL_VERSION = 1
+SPOOL_FORMATS = ('zlib', 'raw')
+
+HEADER_SIZE = 64
+ENTRY_SIZE = 64
+ALIGNMENT = 4096
+GROW_BYTES = 64 * 1024 * 1024
+
+DEFAULT_INDEX_CAPACITY = 16384
+DEFAULT_LIMIT = 16 * 1024 * 1024 * 1024
+
+PIXEL_CODES = tuple(PIXEL_FORMATS)
+COMPRESSIONS = ('raw', 'zlib')
+
+_HEADER = struct.Struct('<8sIIIIQQQ')
+_ENTRY = struct.Struct('<IIIIBBHQQQI')
+
+# プロセスごとに、読み込み用にメモリマップしたスプール（パス -> (スプールID, mmap)）
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+class SpoolFull(Exception):
+    """スプールの容量の上限・索引の上限・ディスクの空き容量に達した"""
+
+
+def _align(value):
+    return (value + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _bound(length):
+    """長さ length のデータを圧縮・整列して書き込むのに必要な最大のバイト数"""
+    return _align(length + length // 1000 + 64)
+
+
+class SpoolPage:
+    """スプールに記録した1ページ（プロセス間で受け渡せる）
+
+    保存済みのページ画像のファイル（Path）と同じように、PDFの作成・分類・トリミングに使える。
+    """
+
+    __slots__ = ('spool_path', 'spool_id', 'page_num', 'width', 'height', 'stride',
+                 'pixel_format', 'compression', 'offset', 'length', 'raw_length', 'crc')
+
+    def __init__(self, spool_path, spool_id, page_num, width, height, stride, pixel_format,
+                 compression, offset, length, raw_length, crc):
+        self.spool_path = spool_path
+        self.spool_id = spool_id
+        self.page_num = page_num
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.pixel_format = pixel_format
+        self.compression = compression
+        self.offset = offset
+        self.length = length
+        self.raw_length = raw_length
+        self.crc = crc
+
+    @property
+    def name(self):
+        """ジャーナルに記録する名前（PNGのファイル名から拡張子を除いた形）"""
+        return f"page_{self.page_num:04d}"
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def frame(self):
+        """記録したフレーム（圧縮していなければスプールのメモリマップをそのまま参照する）"""
+        view = memoryview(_reader(self))[self.offset:self.offset + self.length]
+        if self.compression == 'zlib':
+            view = zlib.decompress(view)
+        return Frame(view, self.width, self.height, self.stride, self.pixel_format)
+
+    def open(self):
+        """PIL画像として開く（Image.open と同じく with 文で使える）"""
+        return self.frame().to_image()
+
+    def key(self, box=None):
+        """内容が同じページを見つけるためのキー（page_store.file_key に相当）"""
+        key = f"spool-{self.raw_length}-{self.length}-{self.crc:08x}"
+        if box:
+            key += "-" + "-".join(str(value) for value in box)
+        return key
+
+
+def _reader(page):
+    """ページを読むためのメモリマップ（別のスプールに置き換わっていれば開き直す）"""
+    with _readers_lock:
+        cached = _readers.get(page.spool_path)
+        if cached is not None:
+            spool_id, mapped = cached
+            if spool_id == page.spool_id and len(mapped) >= page.offset + page.length:
+                return mapped
+        with open(page.spool_path, 'rb') as fp:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        _readers[page.spool_path] = (_HEADER.unpack_from(mapped)[5], mapped)
+        return mapped
+
+
+def open_page(source):
+    """ページ画像のファイルまたはスプールのページをPIL画像として開く"""
+    if isinstance(source, SpoolPage):
+        return source.open()
+    from PIL import Image
+
+    return Image.open(source)
+
+
+def page_name(source):
+    """ページ画像のファイル名（スプールのページはジャーナルに記録する名前）"""
+    if isinstance(source, SpoolPage):
+        return source.name
+    return Path(source).name
+
+
+def page_number(source):
+    """ページ画像のファイル（page_0001.png）またはスプールのページのページ番号"""
+    if isinstance(source, SpoolPage):
+        return source.page_num
+    return int(Path(source).stem.split('_')[1])
+
+
+def source_key(source, box=None):
+    """ページ画像のファイルまたはスプールのページの内容を表すキー"""
+    if isinstance(source, SpoolPage):
+        return source.key(box)
+    from page_store import file_key
+
+    return file_key(Path(source).read_bytes(), box)
+
+
+def saved_pages(directory):
+    """保存したページ（スプールがあればそのページ、なければPNGファイル）をページ順に返す"""
+    directory = Path(directory)
+    spool_path = directory / SPOOL_FILE
+    if spool_path.exists():
+        return read_spool(spool_path)
+    return sorted(directory.glob("page_*.png"))
+
+
+def read_spool(path):
+    """スプールに記録したページをページ順に返す（同じページ番号は後の項目）"""
+    with open(path, 'rb') as fp:
+        header = fp.read(HEADER_SIZE)
+        magic, version, capacity, count, _, spool_id, _, _ = _HEADER.unpack_from(header)
+        if magic != SPOOL_MAGIC or version != SPOOL_VERSION:
+            raise ValueError(f"スプールファイルではありません: {path}")
+        index = fp.read(count * ENTRY_SIZE)
+    pages = {}
+    for position in range(count):
+        page = _unpack_entry(str(path), spool_id, index, position * ENTRY_SIZE)
+        pages[page.page_num] = page
+    return [pages[page_num] for page_num in sorted(pages)]
+
+
+def _unpack_entry(path, spool_id, buffer, offset):
+    (page_num, width, height, stride, pixel_code, compression, _,
+     data_offset, length, raw_length, crc) = _ENTRY.unpack_from(buffer, offset)
+    return SpoolPage(path, spool_id, page_num, width, height, stride, PIXEL_CODES[pixel_code],
+                     COMPRESSIONS[compression], data_offset, length, raw_length, crc)
+
+
+class FrameSpool:
+    """フレームを追記するスプールファイル（ワーカースレッドから同時に append() してよい）
+
+    append=True の場合は既存のスプールに追記する（なければ作成する）。
+    compression: 'zlib'（レベル1で圧縮）または 'raw'（圧縮しない）
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_LIMIT, compression='zlib', append=False,
+                 index_capacity=DEFAULT_INDEX_CAPACITY):
+        if compression not in SPOOL_FORMATS:
+            raise ValueError(f"未対応のスプールの形式です: {compression}")
+        self.path = Path(path)
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._reserved_entries = 0
+        self._largest = 0
+
+        if append and self.path.exists():
+            self._fd = os.open(self.path, os.O_RDWR)
+            header = os.pread(self._fd, HEADER_SIZE, 0)
+            (magic, version, self.capacity, self.count, _, self.spool_id,
+             self.data_start, self.data_end) = _HEADER.unpack_from(header)
+            if magic != SPOOL_MAGIC or version != SPOOL_VERSION:
+                os.close(self._fd)
+                raise ValueError(f"スプールファイルではありません: {self.path}")
+            # 前回の終了時に切り詰めたファイルを、新しい容量の上限まで広げ直す
+            self._allocated = os.fstat(self._fd).st_size
+            os.ftruncate(self._fd, max(self._allocated, max_bytes))
+        else:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.capacity = index_capacity
+            self.count = 0
+            self.spool_id = int.from_bytes(os.urandom(8), 'little')
+            self.data_start = _align(HEADER_SIZE + index_capacity * ENTRY_SIZE)
+            self.data_end = self.data_start
+            self._allocated = 0
+            os.ftruncate(self._fd, max(max_bytes, self.data_start))
+        self._map = mmap.mmap(self._fd, 0)
+        self._ensure_allocated(self.data_end)
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, SPOOL_MAGIC, SPOOL_VERSION, self.capacity, self.count, 0,
+                          self.spool_id, self.data_start, self.data_end)
+
+    def _ensure_allocated(self, end):
+        """end までのディスク領域を GROW_BYTES 単位で確保する（確保できなければ SpoolFull）"""
+        if end <= self._allocated:
+            return
+        target = min(max(_align(end), self._allocated + GROW_BYTES), len(self._map))
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, self._allocated, target - self._allocated)
+            except OSError as e:
+                raise SpoolFull(f"スプールの領域を確保できません: {e}")
+        elif shutil.disk_usage(self.path.parent).free < target - self._allocated:
+            raise SpoolFull("ディスクの空き容量が足りません")
+        self._allocated = target
+
+    def _estimate(self, raw_length):
+        """フレームを1枚書き込むのに予約するバイト数
+
+        圧縮しない場合は正確な大きさ、zlibの場合はこれまでに書き込んだ最大の大きさの2倍
+        （まだ書き込んでいなければ圧縮しない場合の大きさ）。
+        """
+        bound = _bound(raw_length)
+        if self.compression == 'raw' or not self._largest:
+            return bound
+        return min(bound, _align(self._largest * 2 + 65536))
+
+    def reserve(self, frame):
+        """フレームを1枚追記する領域を予約し、予約したバイト数を返す（キャプチャスレッドで呼ぶ）
+
+        書き込みはワーカーで行うため、キューに入っているフレームの分も含めて
+        容量の上限を超えないことを先に確かめる（超える場合は SpoolFull）。
+        """
+        with self._lock:
+            length = self._estimate(len(frame.buffer))
+            if self.count + self._reserved_entries >= self.capacity:
+                raise SpoolFull(f"スプールの索引が上限（{self.capacity}ページ）に達しました")
+            end = self.data_end + self._reserved + length
+            if end > self.max_bytes:
+                raise SpoolFull(self._limit_message())
+            self._ensure_allocated(end)
+            self._reserved += length
+            self._reserved_entries += 1
+        return length
+
+    def _limit_message(self):
+        return f"スプールの容量の上限（{self.max_bytes // (1024 * 1024)} MB）に達しました"
+
+    def append(self, page_num, frame, reserved=0):
+        """フレームを追記し、記録したページ（SpoolPage）を返す
+
+        reserved は reserve() の戻り値（予約せずに呼ぶ場合は0）。
+        圧縮した結果が予約より大きく、上限を超える場合は SpoolFull を送出する。
+        """
+        data = frame.buffer
+        if self.compression == 'zlib':
+            data = zlib.compress(data, 1)
+        crc = zlib.crc32(data)
+        length = len(data)
+        with self._lock:
+            if reserved:
+                self._reserved -= reserved
+                self._reserved_entries -= 1
+            elif self.count + self._reserved_entries >= self.capacity:
+                raise SpoolFull(f"スプールの索引が上限（{self.capacity}ページ）に達しました")
+            end = self.data_end + self._reserved + _align(length)
+            if end > self.max_bytes:
+                raise SpoolFull(self._limit_message())
+            self._ensure_allocated(end)
+            self._largest = max(self._largest, length)
+            offset = self.data_end
+            self.data_end += _align(length)
+        # データの書き込みはロックの外で行う（他のワーカーは別の位置に書く）
+        self._map[offset:offset + length] = data
+        page = SpoolPage(str(self.path), self.spool_id, page_num, frame.width, frame.height,
+                         frame.stride, frame.pixel_format, self.compression, offset, length,
+                         len(frame.buffer), crc)
+        with self._lock:
+            _ENTRY.pack_into(self._map, HEADER_SIZE + self.count * ENTRY_SIZE, page_num,
+                             frame.width, frame.height, frame.stride,
+                             PIXEL_CODES.index(frame.pixel_format),
+                             COMPRESSIONS.index(self.compression), 0,
+                             offset, length, len(frame.buffer), crc)
+            self.count += 1
+            self._write_header()
+        return page
+
+    def discard_after(self, last_page):
+        """last_page より後のページの項目を索引から除く（データ領域はそのまま残る）"""
+        with self._lock:
+            kept = []
+            for position in range(self.count):
+                start = HEADER_SIZE + position * ENTRY_SIZE
+                entry = bytes(self._map[start:start + ENTRY_SIZE])
+                if _ENTRY.unpack_from(entry)[0] <= last_page:
+                    kept.append(entry)
+            for position, entry in enumerate(kept):
+                start = HEADER_SIZE + position * ENTRY_SIZE
+                self._map[start:start + ENTRY_SIZE] = entry
+            self.count = len(kept)
+            self._write_header()
+
+    def pages(self):
+        """記録したページをページ順に返す"""
+        return read_spool(self.path)
+
+    @property
+    def used_bytes(self):
+        return self.data_end
+
+    def close(self):
+        """書き込んだ内容をディスクに書き出し、データ領域の終わりでファイルを切り詰める"""
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        os.ftruncate(self._fd, self.data_end)
+        os.close(self._fd)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+複数の本をまとめてPDF化するジョブキュー
+ジョブの一覧を順に処理し、ある本をキャプチャしている間に、前の本のPDFを
+バックグラウンドで作る（保存したページ画像を複数のプロセスでエンコードする）。
+キャプチャは画面とKindleアプリを占有するので1冊ずつ、PDFの作成はCPUを使うので重ねて行う。
+
+ジョブファイル（1行1ジョブのJSON、空行と # で始まる行は無視する）:
+    {"output": "book1.pdf", "pages": 200, "delay": 1.0, "profile": "tablet"}
+    {"output": "book2.pdf"}
+    output 以外は省略でき、pages を省略（null）すると最後のページを自動検出する。
+    output に出力形式（--format）の拡張子がなければ付ける（book1 → book1.cbz など）。
+
+状態ファイル（ジョブファイルと同じ名前の .state.json）には各ジョブの状態を記録し、
+状態が変わるたびに書き換える（一時ファイルに書いてから置き換えるので、書きかけで壊れない）。
+途中で終了した場合は同じコマンドを再実行すると、完了したジョブは飛ばし、
+キャプチャが終わったジョブはPDFの作成から、それ以外はキャプチャからやり直す。
+
+次の本に切り替える（Kindleで次の本を開く）のを待つ処理は、フックとして差し替えられる。
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from archive_writer import create_writer, output_path_for
+from capture_engine import CaptureEngine, StatusEvent
+from frame_spool import saved_pages
+from journal import load_features
+from page_classifier import PageClassifier
+from page_encoder import PROFILES, PageEncoder
+from page_store import PageStore
+from pdf_writer import add_image_files
+from stage_timer import format_duration
+from trim import trim_box_for_images
+
+# pending: 未処理 / capturing: キャプチャ中 / captured: キャプチャ済み（PDF作成待ち）
+# building: PDF作成中 / done: 完了 / failed: 失敗（再実行するとやり直す）
+JOB_STATES = ('pending', 'capturing', 'captured', 'building', 'done', 'failed')
+
+
+class Job:
+    """ジョブファイルの1行（出力ファイル・ページ数・待機時間・出力プロファイル・出力形式）"""
+
+    __slots__ = ('output', 'pages', 'delay', 'profile', 'output_format')
+
+    def __init__(self, output, pages=None, delay=1.0, profile='archive', output_format='pdf'):
+        if profile not in PROFILES:
+            raise ValueError(f"未対応の出力プロファイルです: {profile}")
+        self.output = output_path_for(output, output_format)
+        self.pages = pages
+        self.delay = delay
+        self.profile = profile
+        self.output_format = output_format
+
+    @property
+    def label(self):
+        """状態の表示に使う出力ファイルの呼び方"""
+        return 'PDF' if self.output_format == 'pdf' else 'ファイル'
+
+
+def load_jobs(path, delay=1.0, profile='archive', output_format='pdf'):
+    """ジョブファイルを読み込む（delay・profile は省略されたジョブに使う値、output_format は全ジョブ共通）"""
+    jobs = []
+    with open(path, encoding='utf-8') as fp:
+        for line_num, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                record = json.loads(line)
+                jobs.append(Job(record['output'], record.get('pages'),
+                                record.get('delay', delay), record.get('profile', profile),
+                                output_format))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{path} の{line_num}行目を読み込めません: {e}")
+    if not jobs:
+        raise ValueError(f"{path} にジョブがありません")
+    return jobs
+
+
+def prompt_switch(job, index, total):
+    """端末で、利用者がKindleで次の本を開くのを待つ（デフォルトのフック）"""
+    input(f"\n[{index}/{total}] Kindleで {job.output} にする本を開いて最初のページを表示し、"
+          "Enterを押してください: ")
+
+
+def no_switch(job, index, total):
+    """待たずに次の本をキャプチャする（合成した本で試す場合など）"""
+
+
+def command_switch(command):
+    """次の本を開くコマンドを実行するフックを作る（ジョブの情報は環境変数で渡す）"""
+    def switch(job, index, total):
+        env = dict(os.environ, KINDLE_JOB_OUTPUT=job.output, KINDLE_JOB_INDEX=str(index),
+                   KINDLE_JOB_TOTAL=str(total))
+        subprocess.run(command, shell=True, env=env, check=True)
+    return switch
+
+
+def build_from_images(image_dir, output_path, encoder, jobs=1, trim=False, store=None,
+                      classifier=None, linearize=False, output_format='pdf', on_warning=None):
+    """保存したページ画像またはスプール（とジャーナルに記録した特徴量）からPDF（または
+    output_format の画像アーカイブ）を作り、ページ数を返す
+
+    on_warning は切り抜けないページがあった場合などの警告の通知先。
+    """
+    image_files = saved_pages(image_dir)
+    if not image_files:
+        raise ValueError(f"{image_dir} にページ画像がありません")
+    if classifier is not None:
+        classifier.cache.update(load_features(Path(image_dir)))
+    box = trim_box_for_images(image_files) if trim else None
+    with create_writer(output_path, output_format, resolution=100.0,
+                       linearize=linearize) as writer:
+        add_image_files(writer, image_files, box=box, encoder=encoder, jobs=jobs, store=store,
+                        classifier=classifier, on_warning=on_warning)
+    return writer.page_count
+
+
+class QueueState:
+    """各ジョブの状態を記録する状態ファイル（複数のスレッドから更新してよい）
+
+    ジョブファイルの同じ位置のジョブと出力ファイルが一致する記録だけを引き継ぎ、
+    前回の実行が途中で終わった状態はやり直せる状態に戻す。
+    """
+
+    def __init__(self, path, jobs):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        saved = []
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as fp:
+                saved = json.load(fp).get('jobs', [])
+
+        self.records = []
+        for index, job in enumerate(jobs):
+            record = saved[index] if index < len(saved) else None
+            if record is None or record.get('output') != job.output:
+                record = {'output': job.output, 'status': 'pending'}
+            elif record['status'] == 'building' or (record['status'] == 'failed'
+                                                     and record.get('pages') is not None):
+                # キャプチャ済みの画像からPDFを作り直す
+                record['status'] = 'captured'
+            elif record['status'] in ('capturing', 'failed'):
+                record['status'] = 'pending'
+            self.records.append(record)
+        with self._lock:
+            self._save()
+
+    def status(self, index):
+        with self._lock:
+            return self.records[index]['status']
+
+    def update(self, index, **fields):
+        """ジョブの記録を更新して状態ファイルに書き出す"""
+        with self._lock:
+            self.records[index].update(fields, updated=time.time())
+            self._save()
+
+    def _save(self):
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as fp:
+            json.dump({'jobs': self.records}, fp, ensure_ascii=False, indent=1)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, self.path)
+
+
+class JobQueue:
+    """ジョブを順に処理するスケジューラー
+
+    キャプチャはこのスレッドで1冊ずつ行い（PDFは作らずにページ画像だけを保存する）、
+    PDFの作成は1つのバックグラウンドスレッドで本の順に行う（1冊を build_jobs 個のプロセスで
+    エンコードする）。overlap=False の場合は、PDFができるのを待ってから次の本をキャプチャする。
+
+    switch_book: 各ジョブのキャプチャ前に呼ぶフック（job, 何冊目, 全体の冊数）
+    engine_options: CaptureEngine に渡す共通のオプション（バックエンド・待ち方・トリミングなど）
+    max_width: ページ画像の最大幅（省略時はジョブの出力プロファイルの値）
+    """
+
+    def __init__(self, jobs, state_path, work_dir, switch_book=prompt_switch,
+                 engine_options=None, max_width=None, build_jobs=2, keep_images=False,
+                 overlap=True, listener=None):
+        self.jobs = jobs
+        self.state = QueueState(state_path, jobs)
+        self.work_dir = Path(work_dir)
+        self.switch_book = switch_book
+        self.engine_options = engine_options or {}
+        self.max_width = max_width
+        self.build_jobs = build_jobs
+        self.keep_images = keep_images
+        self.overlap = overlap
+        self._listener = listener or (lambda event: None)
+        self.cancelled = False
+        self.elapsed = 0.0
+
+    def _status(self, message):
+        self._listener(StatusEvent(message))
+
+    def job_dir(self, index):
+        """ジョブのページ画像とジャーナルを保存するディレクトリ"""
+        return self.work_dir / f"{index + 1:03d}_{Path(self.jobs[index].output).stem}"
+
+    def run(self):
+        """全ジョブを処理し、各ジョブの記録のリストを返す
+
+        Ctrl+C・キャンセルの場合は、次のキャプチャを始めずに作成中のPDFができるのを待って終わる。
+        """
+        start = time.perf_counter()
+        total = len(self.jobs)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='build') as builder:
+            try:
+                for index, job in enumerate(self.jobs):
+                    status = self.state.status(index)
+                    if status == 'done':
+                        self._status(f"[{index + 1}/{total}] {job.output}: 完了済み")
+                        continue
+                    if status == 'pending' and not self._capture(index):
+                        if self.cancelled:
+                            break
+                        continue
+                    build = builder.submit(self._build, index)
+                    if not self.overlap:
+                        build.result()
+            except KeyboardInterrupt:
+                self.cancelled = True
+            if self.cancelled:
+                self._status("中断しました。作成中のPDFができるまで待っています...")
+        self.elapsed = time.perf_counter() - start
+        return self.state.records
+
+    def _capture(self, index):
+        """ジョブをキャプチャしてページ画像を保存する（成功したらTrue）"""
+        job = self.jobs[index]
+        total = len(self.jobs)
+        work_dir = self.job_dir(index)
+        try:
+            self.switch_book(job, index + 1, total)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.state.update(index, status='failed', error=f"本を切り替えられません: {e}")
+            self._status(f"[{index + 1}/{total}] {job.output}: 本を切り替えられません: {e}")
+            return False
+
+        self._status(f"[{index + 1}/{total}] {job.output} をキャプチャ中...")
+        self.state.update(index, status='capturing', error=None)
+        # 前回途中で終わったキャプチャの画像は使わない
+        if work_dir.exists():
+            shutil.rmtree(work_dir)
+        engine = CaptureEngine(job.output, pages=job.pages, delay=job.delay, build_pdf=False,
+                               work_dir=work_dir, listener=self._listener, **self.engine_options)
+        start = time.perf_counter()
+        try:
+            result = engine.run()
+        except Exception as e:
+            self.state.update(index, status='failed', error=str(e))
+            self._status(f"[{index + 1}/{total}] {job.output}: キャプチャに失敗しました: {e}")
+            return False
+        if result.cancelled:
+            self.state.update(index, status='pending')
+            self.cancelled = True
+            return False
+        self.state.update(index, status='captured', pages=result.page_count,
+                          capture_seconds=round(time.perf_counter() - start, 2))
+        return True
+
+    def _build(self, index):
+        """キャプチャ済みのジョブのPDFを作る（バックグラウンドスレッドで実行）"""
+        job = self.jobs[index]
+        total = len(self.jobs)
+        work_dir = self.job_dir(index)
+        options = self.engine_options
+        self.state.update(index, status='building')
+        encoder = PageEncoder(options.get('encoding', 'jpeg'), options.get('quality', 75),
+                              self.max_width or PROFILES[job.profile], options.get('dpi'),
+                              options.get('thumbnails', False),
+                              webp=job.output_format == 'webp')
+        store = PageStore() if options.get('dedup', 'share') != 'off' else None
+        classifier = PageClassifier() if options.get('classify') else None
+        start = time.perf_counter()
+        try:
+            pages = build_from_images(work_dir, job.output, encoder, self.build_jobs,
+                                      options.get('trim', False), store, classifier,
+                                      options.get('linearize', False),
+                                      job.output_format,
+                                      lambda message: self._status(
+                                          f"[{index + 1}/{total}] {job.output}: 警告: {message}"))
+        except Exception as e:
+            self.state.update(index, status='failed', error=str(e))
+            self._status(f"[{index + 1}/{total}] {job.output}: {job.label}を作成できませんでした: {e}")
+            return
+        seconds = time.perf_counter() - start
+        self.state.update(index, status='done', pdf_pages=pages, build_seconds=round(seconds, 2))
+        if not self.keep_images:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        self._status(f"[{index + 1}/{total}] {job.label}作成完了: {job.output}（{pages}ページ, "
+                     f"{format_duration(seconds)}）")
+
+    def report(self):
+        """ジョブごとの結果と全体の時間（表示用の行のリスト）"""
+        lines = []
+        capture_total = build_total = 0.0
+        for index, record in enumerate(self.state.records):
+            label = self.jobs[index].label
+            labels = {'pending': '未処理', 'capturing': 'キャプチャ中', 'captured': f'{label}作成待ち',
+                      'building': f'{label}作成中', 'done': '完了', 'failed': '失敗'}
+            line = f"[{index + 1}/{len(self.jobs)}] {record['output']}: {labels[record['status']]}"
+            if record['status'] == 'done':
+                capture_total += record.get('capture_seconds', 0.0)
+                build_total += record.get('build_seconds', 0.0)
+                line += (f"（{record.get('pdf_pages')}ページ, "
+                         f"キャプチャ {format_duration(record.get('capture_seconds', 0.0))}, "
+                         f"{label}作成 {format_duration(record.get('build_seconds', 0.0))}）")
+            elif record.get('error'):
+                line += f"（{record['error']}）"
+            lines.append(line)
+        # 合計は完了した全ジョブの記録（前回までの実行で完了したジョブも含む）
+        lines.append(f"今回の実行時間 {format_duration(self.elapsed)}（完了したジョブのキャプチャ合計 "
+                     f"{format_duration(capture_total)}, {self.jobs[0].label if self.jobs else 'PDF'}作成合計 "
+                     f"{format_duration(build_total)}）")
+        return lines
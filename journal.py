@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+キャプチャジャーナル（途中再開用）
+処理が終わったページごとに、ページ番号・指紋・画像ファイル名・処理時間・エンコード設定を
+追記専用のJSONLファイルに記録し、エンコード済みのストリームを別ファイルに追記する。
+中断やクラッシュの後は、ジャーナルから最後のページの判定状態とPDFのページを復元し、
+記録済みのページの次から撮影を再開できる（再エンコードは行わない）。
+
+ファイル形式:
+    journal.jsonl  1行1レコードのJSON。"type" が "session"（実行時の設定）、
+                   "page"（ページ）、"end"（最後のページを検出した）のいずれか
+    streams.bin    エンコード済みストリームを連結したもの。
+                   "page" レコードの offset / length で位置を示す
+                   （内容が同じページ（"key" が一致するページ）は同じストリームを指す）
+                   ページを分類した場合は "class" と "features"（特徴量）も記録し、
+                   白紙のページはストリームを持たず、見開きは右のページを "right" に記録する
+                   画像だけを保存するキャプチャ（"session" の "deferred"）ではストリームを記録しない
+                   サムネイルを作った場合は "thumb" にその位置と形式を記録する
+                   "file" はページ画像のファイル名（スプールに保存した場合は拡張子のない page_0001 の形）
+ストリームを書いてからレコードを書き、両方をfsyncするため、
+途中で書きかけになった末尾は読み込み時に切り捨てる。
+"""
+
+import json
+import os
+import time
+
+from capture_pipeline import PageResult
+from fingerprint import Fingerprint
+from page_store import part_key
+from pdf_writer import EncodedImage
+
+JOURNAL_FILE = "journal.jsonl"
+STREAMS_FILE = "streams.bin"
+
+# "page" レコードのうち、ストリームの位置と形式を表す項目
+STREAM_FIELDS = ('offset', 'length', 'size', 'colorspace', 'bits', 'filter', 'decode_parms', 'scale',
+                 'thumb')
+
+
+def _entry_streams(entry):
+    """"page" レコードが指す (ストリームの位置と形式, キー) のリスト（PDFのページ順）"""
+    page_class = entry.get('class')
+    if page_class == 'blank' or 'offset' not in entry:
+        return []
+    stream = {name: entry.get(name) for name in STREAM_FIELDS}
+    if page_class == 'spread':
+        return [(stream, part_key(entry.get('key'), 0)),
+                (entry['right'], part_key(entry.get('key'), 1))]
+    return [(stream, entry.get('key'))]
+
+
+def load_features(directory):
+    """ジャーナルに記録した特徴量を、ページ画像のファイル名 -> 特徴量 の辞書で返す"""
+    path = directory / JOURNAL_FILE
+    features = {}
+    if not path.exists():
+        return features
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record['type'] == 'page' and record.get('file') and record.get('features'):
+                features[record['file']] = tuple(record['features'])
+    return features
+
+
+class CaptureJournal:
+    """キャプチャの進行状況を記録する追記専用のジャーナル
+
+    resume=False の場合は既存のジャーナルを破棄して新しく記録を始める。
+    """
+
+    def __init__(self, directory, resume=False, output=None, encoding='jpeg', quality=75,
+                 deferred=False):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.journal_path = directory / JOURNAL_FILE
+        self.streams_path = directory / STREAMS_FILE
+        self.encoding = encoding
+        self.quality = quality
+        self.session = None
+        self.entries = []
+        self.end_page = None
+        # ページの内容のキー -> 記録済みのストリームの位置と形式
+        self._streams_by_key = {}
+
+        if resume:
+            self._load()
+        else:
+            for path in (self.journal_path, self.streams_path):
+                if path.exists():
+                    path.unlink()
+
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._streams = open(self.streams_path, 'ab')
+        if self.session is None:
+            self.session = {'type': 'session', 'output': output, 'encoding': encoding,
+                            'quality': quality, 'deferred': deferred, 'started': time.time()}
+            self._append(self.session)
+
+    def _load(self):
+        """記録済みのレコードを読み込み、書きかけの末尾を切り捨てる"""
+        if not self.journal_path.exists():
+            return
+        valid_length = 0
+        with open(self.journal_path, 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                valid_length += len(line)
+                if record['type'] == 'session' and self.session is None:
+                    self.session = record
+                elif record['type'] == 'page':
+                    self.entries.append(record)
+                elif record['type'] == 'end':
+                    self.end_page = record['last_page']
+
+        os.truncate(self.journal_path, valid_length)
+        streams_length = 0
+        for entry in self.entries:
+            for stream, key in _entry_streams(entry):
+                if key:
+                    self._streams_by_key.setdefault(key, stream)
+                streams_length = max(streams_length, stream_end(stream))
+        if self.streams_path.exists():
+            os.truncate(self.streams_path, streams_length)
+
+    @property
+    def last_page(self):
+        """記録済みの最後のページ番号（記録がなければNone）"""
+        return self.entries[-1]['page'] if self.entries else None
+
+    @property
+    def page_count(self):
+        """記録済みのページから作られるPDFのページ数（白紙を除き、見開きは2ページ）"""
+        return sum(len(_entry_streams(entry)) for entry in self.entries)
+
+    def _append(self, record):
+        self._journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def record(self, results):
+        """処理が終わったページ（ページ順のPageResult）を記録"""
+        for result in results:
+            streams = []
+            for encoded, key in result.pages():
+                if encoded is None:
+                    # 画像だけを保存するキャプチャ（PDFは後で作る）
+                    continue
+                # 内容が同じページは記録済みのストリームを指す
+                stream = self._streams_by_key.get(key)
+                if stream is None:
+                    stream = self._write_stream(encoded)
+                    if key is not None:
+                        self._streams_by_key[key] = stream
+                streams.append(stream)
+            record = {
+                'type': 'page',
+                'page': result.page_num,
+                'fingerprint': result.fingerprint.hex(),
+                'key': result.key,
+                'file': result.path.name if result.path else None,
+            }
+            if streams:
+                record.update(streams[0])
+            if result.page_class is not None:
+                record['class'] = result.page_class
+                record['features'] = [round(value, 4) for value in result.features]
+                if len(streams) > 1:
+                    record['right'] = streams[1]
+            record.update({
+                'encoding': self.encoding,
+                'quality': self.quality,
+                'timings': result.timings,
+                'time': time.time(),
+            })
+            self._append(record)
+
+    def _write_stream(self, encoded):
+        """ストリームを追記し、ジャーナルに記録する位置と形式を返す"""
+        stream = write_stream(self._streams, encoded)
+        self._streams.flush()
+        os.fsync(self._streams.fileno())
+        return stream
+
+    def mark_end(self, last_page):
+        """最後のページを検出したことを記録"""
+        self.end_page = last_page
+        self._append({'type': 'end', 'last_page': last_page, 'time': time.time()})
+
+    def replay(self, skip_data=0):
+        """記録済みのページをPageResultとしてページ順に返す（ストリームはファイルから読む）
+
+        PDFの先頭の skip_data ページは書き出し済みとして、それだけでできているレコードは
+        ストリームを読まずに encoded=None で返す。
+        """
+        pages = 0
+        with open(self.streams_path, 'rb') as fp:
+            for entry in self.entries:
+                fingerprint = Fingerprint.from_hex(entry['fingerprint'])
+                path = self.directory / entry['file'] if entry['file'] else None
+                streams = _entry_streams(entry)
+                encoded = [None] * len(streams)
+                if pages + len(streams) > skip_data:
+                    encoded = [read_stream(fp, stream) for stream, _ in streams]
+                pages += len(streams)
+                features = entry.get('features')
+                yield PageResult(entry['page'], fingerprint, encoded[0] if encoded else None,
+                                 path, entry.get('timings'), key=entry.get('key'),
+                                 page_class=entry.get('class'),
+                                 features=tuple(features) if features else None,
+                                 right=encoded[1] if len(encoded) > 1 else None)
+
+    def close(self):
+        if not self._journal.closed:
+            self._journal.close()
+            self._streams.close()
+
+    def remove(self):
+        """ジャーナルを閉じて削除（正常に完了した場合）"""
+        self.close()
+        for path in (self.journal_path, self.streams_path):
+            if path.exists():
+                path.unlink()
+        try:
+            self.directory.rmdir()
+        except OSError:
+            # 保存した画像が残っている場合はディレクトリを残す
+            pass
+
+
+def write_stream(fp, encoded):
+    """ストリーム（とサムネイル）をファイルの末尾に書き、位置と形式を表す辞書を返す
+
+    ジャーナルと stream_cache で共通の形式（fsyncは呼び出し側で行う）。
+    """
+    offset = fp.tell()
+    fp.write(encoded.data)
+    thumb = None
+    if encoded.thumb is not None:
+        # サムネイルはページの画像の直後に置く
+        thumb = {
+            'offset': offset + len(encoded.data),
+            'length': len(encoded.thumb.data),
+            'size': list(encoded.thumb.size),
+            'colorspace': encoded.thumb.colorspace,
+        }
+        fp.write(encoded.thumb.data)
+    return {
+        'offset': offset,
+        'length': len(encoded.data),
+        'size': list(encoded.size),
+        'colorspace': encoded.colorspace,
+        'bits': encoded.bits,
+        'filter': encoded.filter,
+        'decode_parms': encoded.decode_parms.decode('latin-1') if encoded.decode_parms else None,
+        'scale': encoded.scale,
+        'thumb': thumb,
+    }
+
+
+def stream_end(stream):
+    """ストリーム（とサムネイル）の終わりの位置"""
+    thumb = stream.get('thumb')
+    if thumb:
+        return max(stream['offset'] + stream['length'], thumb['offset'] + thumb['length'])
+    return stream['offset'] + stream['length']
+
+
+def read_stream(fp, stream):
+    """記録済みのストリームを読み込んでEncodedImageにする"""
+    fp.seek(stream['offset'])
+    decode_parms = stream['decode_parms']
+    encoded = EncodedImage(
+        tuple(stream['size']), stream['colorspace'], stream['bits'], stream['filter'],
+        fp.read(stream['length']),
+        decode_parms.encode('latin-1') if decode_parms else None,
+        stream.get('scale') or 1.0
+    )
+    thumb = stream.get('thumb')
+    if thumb:
+        fp.seek(thumb['offset'])
+        encoded.thumb = EncodedImage(tuple(thumb['size']), thumb['colorspace'], 8, 'DCTDecode',
+                                     fp.read(thumb['length']))
+    return encoded
@@ -5,152 +5,57 @@ Kindle for Macアプリのスクリーンショットを自動で撮影し、PDF
 """
 
 import argparse
-import os
-import subprocess
 import sys
-import tempfile
-import time
 from pathlib import Path
 
+from archive_writer import FORMATS, output_path_for
+from capture_engine import CaptureEngine, CaptureError, ProgressEvent
+from fingerprint import DEFAULT_THRESHOLD
+from frame_spool import DEFAULT_LIMIT, SPOOL_FILE, SPOOL_FORMATS
+from page_encoder import PROFILES, parse_quality
+from stage_timer import format_duration
 
-def get_kindle_window_id():
-    """KindleアプリのウィンドウID（CGWindowID）を取得"""
-    try:
-        import Quartz
-    except ImportError:
-        print("エラー: PyObjCがインストールされていません。")
-        print("インストール: pip install pyobjc-framework-Quartz")
-        sys.exit(1)
-
-    # ウィンドウ一覧を取得
-    window_list = Quartz.CGWindowListCopyWindowInfo(
-        Quartz.kCGWindowListOptionOnScreenOnly,
-        Quartz.kCGNullWindowID
-    )
-
-    kindle_windows = []
-    for window in window_list:
-        owner_name = window.get('kCGWindowOwnerName', '')
-
-        # Kindleアプリのウィンドウを探す
-        if owner_name == 'Kindle':
-            window_id = window.get('kCGWindowNumber')
-            bounds = window.get('kCGWindowBounds', {})
-            width = bounds.get('Width', 0)
-            height = bounds.get('Height', 0)
-            # サイズが十分なウィンドウのみ（メインウィンドウ）
-            if width > 100 and height > 100:
-                kindle_windows.append((window_id, width * height))
-
-    if kindle_windows:
-        # 最も大きいウィンドウを選択
-        kindle_windows.sort(key=lambda x: x[1], reverse=True)
-        return str(kindle_windows[0][0])
-
-    print("エラー: Kindleウィンドウが見つかりません。Kindleアプリを起動して本を開いてください。")
-    sys.exit(1)
-
-
-def activate_kindle():
-    """Kindleアプリをアクティブ化"""
-    script = '''
-    tell application "Amazon Kindle"
-        activate
-    end tell
-    '''
-    subprocess.run(['osascript', '-e', script], check=True)
-    time.sleep(0.5)
-
-
-def capture_window(window_id, filepath):
-    """指定ウィンドウのスクリーンショットを撮影（PyObjC使用）"""
-    import Quartz
-    from Quartz import CGWindowListCreateImage, CGRectNull, kCGWindowListOptionIncludingWindow, kCGWindowImageDefault
-
-    # ウィンドウをキャプチャ
-    image = CGWindowListCreateImage(
-        CGRectNull,
-        kCGWindowListOptionIncludingWindow,
-        int(window_id),
-        kCGWindowImageDefault
-    )
-
-    if image is None:
-        raise RuntimeError(f"ウィンドウ {window_id} のキャプチャに失敗しました")
-
-    # PNGとして保存
-    from Quartz import CGImageDestinationCreateWithURL, CGImageDestinationAddImage, CGImageDestinationFinalize
-    from Foundation import NSURL
-
-    url = NSURL.fileURLWithPath_(filepath)
-    dest = CGImageDestinationCreateWithURL(url, 'public.png', 1, None)
-    CGImageDestinationAddImage(dest, image, None)
-    CGImageDestinationFinalize(dest)
 
-
-def send_page_turn():
-    """Kindleで次のページへ移動（右矢印キー）"""
-    script = '''
-    tell application "System Events"
-        tell process "Kindle"
-            key code 124
-        end tell
-    end tell
-    '''
-    subprocess.run(['osascript', '-e', script], check=True)
-
-
-def get_image_hash(filepath):
-    """画像ファイルのハッシュ値を取得"""
-    from PIL import Image
-    import hashlib
-
-    with Image.open(filepath) as img:
-        return hashlib.md5(img.tobytes()).hexdigest()
-
-
-def images_to_pdf(image_dir, output_path):
-    """画像ファイルをPDFに結合（Pillowを使用）"""
+def _quality_argument(text):
     try:
-        from PIL import Image
-    except ImportError:
-        print("エラー: Pillowがインストールされていません。")
-        print("インストール: pip install Pillow")
-        sys.exit(1)
+        return parse_quality(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
-    image_files = sorted(Path(image_dir).glob("page_*.png"))
 
-    if not image_files:
-        print("エラー: 画像ファイルが見つかりません。")
-        sys.exit(1)
+class ConsoleProgress:
+    """キャプチャエンジンのイベントを端末に表示する（進捗は同じ行を書き換える）"""
 
-    print(f"\n{len(image_files)}枚の画像をPDFに結合中...")
+    def __init__(self):
+        self._progress_line = False
 
-    # 最初の画像を開く
-    images = []
-    for img_path in image_files:
-        img = Image.open(img_path)
-        # RGBAをRGBに変換（PNGの透過対応）
-        if img.mode == 'RGBA':
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            rgb_img.paste(img, mask=img.split()[3])
-            images.append(rgb_img)
+    def __call__(self, event):
+        if isinstance(event, ProgressEvent):
+            if event.total is None:
+                print(f"\rページ {event.page_num} をキャプチャ中... "
+                      f"({event.pages_per_minute:.1f}ページ/分)", end="", flush=True)
+            else:
+                progress = (event.page_num / event.total) * 100
+                print(f"\rページ {event.page_num}/{event.total} ({progress:.1f}%) "
+                      f"{event.pages_per_minute:.1f}ページ/分 残り約{format_duration(event.eta)}   ",
+                      end="", flush=True)
+            self._progress_line = True
         else:
-            images.append(img.convert('RGB'))
-
-    # PDFとして保存
-    if images:
-        images[0].save(
-            output_path,
-            save_all=True,
-            append_images=images[1:],
-            resolution=100.0
-        )
+            if self._progress_line:
+                print()
+                self._progress_line = False
+            print(event.message)
 
-    print(f"PDF作成完了: {output_path}")
 
+def main(argv=None):
+    """CLIのエントリーポイント（戻り値: 処理段階ごとの時間を集計したStageTimer、--queue の場合はJobQueue）
 
-def main():
+    最初の引数が rebuild の場合は、保存したページ画像からPDFを作り直す（rebuild.main、戻り値はRebuildResult）。
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "rebuild":
+        from rebuild import main as rebuild_main
+        return rebuild_main(argv[1:])
     parser = argparse.ArgumentParser(
         description="Kindle本をPDF化するツール"
     )
@@ -163,8 +68,7 @@ def main():
     parser.add_argument(
         "--output", "-o",
         type=str,
-        required=True,
-        help="出力PDFファイル名"
+        help="出力PDFファイル名（--queue を使わない場合は必須）"
     )
     parser.add_argument(
         "--delay", "-d",
@@ -172,124 +76,397 @@ def main():
         default=1.0,
         help="ページ送り後の待機秒数（デフォルト: 1.0）"
     )
+    parser.add_argument(
+        "--settle",
+        choices=["fixed", "adaptive"],
+        default="fixed",
+        help="ページ送り後の待ち方（fixed: --delay秒待つ, adaptive: 描画完了を検出、デフォルト: fixed）"
+    )
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default=3.0,
+        help="adaptive時にページ描画を待つ最大秒数（デフォルト: 3.0）"
+    )
+    parser.add_argument(
+        "--match-threshold",
+        type=int,
+        default=DEFAULT_THRESHOLD,
+        help=f"同じページとみなす指紋の差（ビット数、デフォルト: {DEFAULT_THRESHOLD}）"
+    )
+    parser.add_argument(
+        "--turner",
+        choices=["helper", "quartz", "osascript"],
+        default="helper",
+        help="ページ送りの方式（helper: 常駐ヘルパー, quartz: キーイベント直接送信, osascript: 毎回起動、デフォルト: helper）"
+    )
     parser.add_argument(
         "--start-page", "-s",
         type=int,
         default=1,
         help="開始ページ番号（途中再開用、デフォルト: 1）"
     )
+    parser.add_argument(
+        "--resume", "-r",
+        action="store_true",
+        help="中断した前回のキャプチャをジャーナルから再開する"
+    )
+    parser.add_argument(
+        "--append", "-a",
+        action="store_true",
+        help="既存の出力PDFの末尾にページを追加する（--linearize とは同時に使えない）"
+    )
     parser.add_argument(
         "--keep-images", "-k",
         action="store_true",
         help="終了後も画像を保持する"
     )
+    parser.add_argument(
+        "--trim", "-t",
+        action="store_true",
+        help="ツールバーや余白を自動で切り抜く（NumPyが必要）"
+    )
+    parser.add_argument(
+        "--encoding",
+        choices=["jpeg", "auto", "png"],
+        default="jpeg",
+        help="ページのエンコード方式（jpeg: 全ページJPEG, auto: 白黒/グレー/カラーをページごとに選択, "
+             "png: 可逆圧縮（保存したPNGはそのまま埋め込む）、デフォルト: jpeg）"
+    )
+    parser.add_argument(
+        "--quality",
+        type=_quality_argument,
+        default=75,
+        help="JPEGの品質（1〜95、デフォルト: 75）"
+    )
+    parser.add_argument(
+        "--workers", "-w",
+        type=int,
+        default=2,
+        help="画像のエンコード・保存を行うワーカー数（デフォルト: 2）"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="保存済みのページ画像からPDFを作る際のエンコードプロセス数（デフォルト: 1）"
+    )
 
-    args = parser.parse_args()
-
-    # 出力ファイル名の処理
-    output_path = args.output
-    if not output_path.endswith(".pdf"):
-        output_path += ".pdf"
+    parser.add_argument(
+        "--backend",
+        choices=["kindle", "synthetic", "replay"],
+        default="kindle",
+        help="キャプチャ元（kindle: Kindleアプリ, synthetic: 合成した本で動作確認・計測, "
+             "replay: --record-session で記録したキャプチャを再生、デフォルト: kindle）"
+    )
+    parser.add_argument(
+        "--synthetic-pages",
+        type=int,
+        default=50,
+        help="synthetic時の本のページ数（デフォルト: 50）"
+    )
+    parser.add_argument(
+        "--synthetic-latency",
+        type=float,
+        default=0.3,
+        help="synthetic時の平均描画遅延秒数（デフォルト: 0.3）"
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="replay時に再生するセッションのファイル"
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="replay時の再生速度（倍、デフォルト: 1.0）"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default="archive",
+        help="出力プロファイル（archive: 撮影した解像度のまま, tablet: 幅2048画素まで, "
+             "ereader: 幅1264画素まで、デフォルト: archive）"
+    )
+    parser.add_argument(
+        "--max-width",
+        type=int,
+        default=None,
+        help="ページ画像の最大幅（画素、--profile より優先）"
+    )
+    parser.add_argument(
+        "--dpi",
+        type=float,
+        default=None,
+        help="ページ画像の解像度の上限（撮影した画像を100dpiとしたページの大きさに対する値）"
+    )
+    parser.add_argument(
+        "--classify",
+        action="store_true",
+        help="ページを分類し、白紙のページを削除・見開きを左右の2ページに分割する（NumPyが必要）"
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=["off", "share", "drop"],
+        default="share",
+        help="内容が同じページの扱い（off: そのまま, share: 画像を1つだけ埋め込んで共有, "
+             "drop: 直前と同じページを削除、デフォルト: share）"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="処理段階ごとの時間をChrome trace形式（JSON）で書き出すファイル"
+    )
+    parser.add_argument(
+        "--record-session",
+        metavar="PATH",
+        help="撮影したフレームとページ送りのタイミングを記録するファイル（--backend replay で再生できる）"
+    )
+    parser.add_argument(
+        "--spool",
+        nargs="?",
+        const="zlib",
+        choices=SPOOL_FORMATS,
+        help="ページ画像をPNGではなく1つのスプールファイルに保存する（zlib: 軽く圧縮, raw: 圧縮しない、"
+             "--keep-images・--queue と使う、省略時: zlib）"
+    )
+    parser.add_argument(
+        "--spool-limit",
+        type=int,
+        default=DEFAULT_LIMIT // (1024 * 1024),
+        metavar="MB",
+        help=f"スプールファイルの容量の上限（MB、デフォルト: {DEFAULT_LIMIT // (1024 * 1024)}）"
+    )
+    parser.add_argument(
+        "--thumbnails",
+        action="store_true",
+        help="ページごとのサムネイル（/Thumb）をPDFに埋め込む（指紋用の縮小画像から作る）"
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(FORMATS),
+        default="pdf",
+        help="出力形式（pdf, cbz: JPEGのページをそのまま入れたCBZ, tiff: マルチページTIFF, "
+             "webp: WebPのページのCBZ、デフォルト: pdf）"
+    )
+    parser.add_argument(
+        "--linearize",
+        action="store_true",
+        help="PDFを線形化（Fast Web View）し、ファイル全体を読まなくても最初のページを表示できるようにする"
+    )
+    parser.add_argument(
+        "--queue",
+        metavar="JOBS",
+        help="ジョブファイル（1行1冊のJSON）の本を順にキャプチャし、前の本のPDFを並行して作る"
+    )
+    parser.add_argument(
+        "--switch-command",
+        metavar="CMD",
+        help="--queue で次の本を開くコマンド（省略時はEnterが押されるのを待つ）"
+    )
 
-    # 一時ディレクトリの作成
-    if args.keep_images:
-        image_dir = Path("kindle_screenshots")
-        image_dir.mkdir(exist_ok=True)
+    args = parser.parse_args(argv)
+    if args.queue:
+        if (args.output or args.resume or args.append or args.start_page != 1 or args.trace
+                or args.record_session):
+            parser.error("--queue は --output・--resume・--append・--start-page・--trace・"
+                         "--record-session と同時に使えません")
+    elif not args.output:
+        parser.error("--output を指定してください")
+    if args.spool and not (args.keep_images or args.queue):
+        parser.error("--spool は --keep-images または --queue と同時に指定してください")
+    if args.format != "pdf" and (args.append or args.linearize or args.thumbnails):
+        parser.error("--append・--linearize・--thumbnails は --format pdf の場合のみ使えます")
+    if args.append and args.linearize:
+        parser.error("--append と --linearize は同時に使えません")
+    if (args.backend == "replay") != bool(args.replay):
+        parser.error("--replay は --backend replay と同時に指定してください")
+
+    if args.backend == "synthetic":
+        backend_options = {"pages": args.synthetic_pages, "latency": args.synthetic_latency}
+    elif args.backend == "replay":
+        backend_options = {"archive": args.replay, "speed": args.replay_speed}
     else:
-        temp_dir = tempfile.mkdtemp(prefix="kindle_pdf_")
-        image_dir = Path(temp_dir)
+        backend_options = {"turner": args.turner}
+    if args.queue:
+        return run_queue(args, backend_options)
 
-    auto_detect = args.pages is None
+    # 出力ファイル名の処理
+    output_path = output_path_for(args.output, args.format)
+
+    # ジャーナルは常に作業ディレクトリに記録し、PNGは画像を保持する場合のみ保存する
+    engine = CaptureEngine(
+        output_path,
+        backend=args.backend,
+        backend_options=backend_options,
+        pages=args.pages,
+        delay=args.delay,
+        settle=args.settle,
+        max_wait=args.max_wait,
+        match_threshold=args.match_threshold,
+        start_page=args.start_page,
+        resume=args.resume,
+        append=args.append,
+        keep_images=args.keep_images,
+        trim=args.trim,
+        encoding=args.encoding,
+        quality=args.quality,
+        max_width=args.max_width if args.max_width is not None else PROFILES[args.profile],
+        dpi=args.dpi,
+        workers=args.workers,
+        jobs=args.jobs,
+        dedup=args.dedup,
+        classify=args.classify,
+        spool=args.spool,
+        spool_limit=args.spool_limit * 1024 * 1024,
+        thumbnails=args.thumbnails,
+        linearize=args.linearize,
+        output_format=args.format,
+        trace_path=args.trace,
+        record_session=args.record_session,
+        work_dir=Path("kindle_screenshots"),
+        listener=ConsoleProgress()
+    )
 
     print("=" * 50)
     print("Kindle PDF化ツール")
     print("=" * 50)
-    print(f"ページ数: {'自動検出' if auto_detect else args.pages}")
+    print(f"ページ数: {'自動検出' if args.pages is None else args.pages}")
     print(f"出力ファイル: {output_path}")
-    print(f"待機時間: {args.delay}秒")
-    print(f"画像保存先: {image_dir}")
-    print("=" * 50)
-
-    # Kindleをアクティブ化
-    print("\nKindleアプリをアクティブ化中...")
-    activate_kindle()
-
-    # ウィンドウIDを取得
-    print("KindleウィンドウIDを取得中...")
-    window_id = get_kindle_window_id()
-    print(f"ウィンドウID: {window_id}")
-
-    # 開始前の確認
-    print("\n" + "=" * 50)
-    print("準備完了！")
-    print("Kindleアプリで最初のページを表示していることを確認してください。")
-    print("3秒後にキャプチャを開始します...")
-    print("=" * 50)
-    time.sleep(3)
+    if args.format != "pdf":
+        print(f"出力形式: {args.format}")
+    if args.settle == "adaptive":
+        print(f"待機時間: 自動（最大{args.max_wait}秒）")
+    else:
+        print(f"待機時間: {args.delay}秒")
+    if engine.image_dir is None:
+        print("画像保存先: 保存しない")
+    elif args.spool:
+        print(f"画像保存先: {engine.image_dir / SPOOL_FILE}（スプール、上限 {args.spool_limit} MB）")
+    else:
+        print(f"画像保存先: {engine.image_dir}")
+    if engine.encoder.max_width or args.dpi:
+        limits = [f"幅{engine.encoder.max_width}画素" if engine.encoder.max_width else None,
+                  f"{args.dpi:g}dpi" if args.dpi else None]
+        print(f"出力解像度: {'・'.join(limit for limit in limits if limit)}まで縮小")
+    if args.linearize or args.thumbnails:
+        options = ["線形化" if args.linearize else None, "サムネイル" if args.thumbnails else None]
+        print(f"PDFの最適化: {'・'.join(option for option in options if option)}")
+    if args.resume:
+        print("モード: 前回のキャプチャを再開")
+    elif args.append:
+        print("モード: 既存のPDFに追加")
+    print("=" * 50 + "\n")
 
-    # キャプチャループ
     try:
-        page_num = args.start_page
-        last_hash = None
-        same_count = 0
-        max_pages = args.pages if args.pages else 99999
+        result = engine.run()
+    except CaptureError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
 
-        while page_num <= max_pages:
-            filepath = image_dir / f"page_{page_num:04d}.png"
+    if result.cancelled:
+        print("\n中断されました。")
+        print(f"ここまでの{result.page_count}ページを {output_path} に保存しました。")
+        if result.image_dir is not None:
+            print(f"画像は {result.image_dir} に保存されています。")
+        print("再開するには: --resume を指定して同じコマンドを実行してください。")
+        sys.exit(1)
 
-            # スクリーンショット撮影
-            capture_window(window_id, str(filepath))
+    print("\nキャプチャ完了！")
+    print(f"{'PDF' if args.format == 'pdf' else 'ファイル'}作成完了: {output_path}（{result.page_count}ページ）")
+    if args.encoding == "auto" or engine.encoder.max_width or args.dpi:
+        print("\nエンコード内訳:")
+        for line in engine.encoder.report():
+            print(f"  {line}")
+    if args.classify:
+        print("\nページの分類:")
+        for line in engine.classify_report(result):
+            print(f"  {line}")
+    duplicates = engine.duplicate_report(result)
+    if duplicates:
+        print("\n重複ページ:")
+        for line in duplicates:
+            print(f"  {line}")
+    print("\n処理時間の内訳:")
+    for line in engine.timer.report():
+        print(f"  {line}")
+    if args.trace:
+        print(f"トレースを {args.trace} に書き出しました。")
+    if args.record_session:
+        print(f"キャプチャを {args.record_session} に記録しました。")
+    if result.image_dir is not None:
+        print(f"画像は {result.image_dir} に保存されています。")
 
-            # 自動検出モード: 同じ画像が3回続いたら終了
-            if auto_detect:
-                current_hash = get_image_hash(str(filepath))
-                if current_hash == last_hash:
-                    same_count += 1
-                    if same_count >= 3:
-                        # 重複した画像を削除
-                        for i in range(same_count):
-                            dup_path = image_dir / f"page_{page_num - i:04d}.png"
-                            if dup_path.exists():
-                                dup_path.unlink()
-                        page_num -= same_count
-                        print(f"\r最後のページを検出しました（{page_num}ページ）")
-                        break
-                else:
-                    same_count = 0
-                last_hash = current_hash
+    print("\n完了！")
+    return engine.timer
 
-            # 進捗表示
-            if auto_detect:
-                print(f"\rページ {page_num} をキャプチャ中...", end="", flush=True)
-            else:
-                progress = (page_num / args.pages) * 100
-                print(f"\rページ {page_num}/{args.pages} ({progress:.1f}%)", end="", flush=True)
 
-            # ページ送り
-            send_page_turn()
-            time.sleep(args.delay)
-            page_num += 1
+def run_queue(args, backend_options):
+    """--queue: ジョブファイルの本を順にキャプチャし、PDFをバックグラウンドで作る"""
+    from job_queue import JobQueue, command_switch, load_jobs, no_switch, prompt_switch
 
-    except KeyboardInterrupt:
-        print("\n\n中断されました。")
-        print(f"画像は {image_dir} に保存されています。")
-        print(f"再開するには: --start-page {page_num} を指定してください。")
+    try:
+        jobs = load_jobs(args.queue, delay=args.delay, profile=args.profile,
+                         output_format=args.format)
+    except (OSError, ValueError) as e:
+        print(f"エラー: {e}")
         sys.exit(1)
-
-    print("\n\nキャプチャ完了！")
-
-    # PDFに結合
-    images_to_pdf(image_dir, output_path)
-
-    # 一時ファイルの削除
-    if not args.keep_images:
-        import shutil
-        shutil.rmtree(image_dir)
-        print("一時ファイルを削除しました。")
+    if args.switch_command:
+        switch_book = command_switch(args.switch_command)
+    elif args.backend in ("synthetic", "replay"):
+        switch_book = no_switch
     else:
-        print(f"画像は {image_dir} に保存されています。")
+        switch_book = prompt_switch
+
+    state_path = Path(args.queue).with_suffix(".state.json")
+    queue = JobQueue(
+        jobs,
+        state_path,
+        Path("kindle_screenshots") / "queue",
+        switch_book=switch_book,
+        engine_options={
+            "backend": args.backend,
+            "backend_options": backend_options,
+            "settle": args.settle,
+            "max_wait": args.max_wait,
+            "match_threshold": args.match_threshold,
+            "trim": args.trim,
+            "encoding": args.encoding,
+            "quality": args.quality,
+            "dpi": args.dpi,
+            "workers": args.workers,
+            "dedup": args.dedup,
+            "classify": args.classify,
+            "spool": args.spool,
+            "spool_limit": args.spool_limit * 1024 * 1024,
+            "thumbnails": args.thumbnails,
+            "linearize": args.linearize,
+            "output_format": args.format,
+        },
+        max_width=args.max_width,
+        build_jobs=args.jobs,
+        keep_images=args.keep_images,
+        listener=ConsoleProgress()
+    )
 
+    print("=" * 50)
+    print("Kindle PDF化ツール（ジョブキュー）")
+    print("=" * 50)
+    print(f"ジョブ: {len(jobs)}冊（{args.queue}）")
+    print(f"状態ファイル: {state_path}")
+    print(f"PDF作成のプロセス数: {args.jobs}")
+    print("=" * 50 + "\n")
+
+    records = queue.run()
+    print("\nジョブの結果:")
+    for line in queue.report():
+        print(f"  {line}")
+    if queue.cancelled or any(record["status"] != "done" for record in records):
+        print("\n完了していないジョブがあります。同じコマンドを実行すると続きから処理します。")
+        sys.exit(1)
     print("\n完了！")
+    return queue
 
 
 if __name__ == "__main__":
@@ -4,29 +4,34 @@ Kindle本をPDF化するツール（GUI版）
 tkinterを使用したGUIアプリケーション
 """
 
-import hashlib
-import os
-import shutil
-import subprocess
-import sys
-import tempfile
 import threading
-import time
 import tkinter as tk
 from pathlib import Path
 from tkinter import filedialog, messagebox, ttk
 
+from capture_engine import (CaptureEngine, CaptureError, EventThrottle, ProgressEvent,
+                            StatusEvent)
+from page_encoder import PROFILES
+from stage_timer import format_duration
+
 
 class KindleToPdfApp:
-    def __init__(self, root):
+    def __init__(self, root, backend="kindle", backend_options=None, trace_path=None):
         self.root = root
+        # キャプチャ元（synthetic にするとKindleアプリなしで動作確認できる）
+        self.backend_name = backend
+        self.backend_options = backend_options or {}
+        # 処理段階ごとの時間（trace_path を指定するとChrome trace形式でも書き出す）
+        self.trace_path = trace_path
         self.root.title("Kindle to PDF")
         self.root.resizable(False, False)
 
         # 状態管理
         self.is_running = False
-        self.should_cancel = False
+        self.engine = None
         self.capture_thread = None
+        # キャプチャスレッドからのイベントはまとめてからメインループに渡す
+        self.events = EventThrottle(self.root.after, self._handle_event)
 
         self._setup_ui()
         self._center_window()
@@ -103,28 +108,76 @@ class KindleToPdfApp:
 
         ttk.Label(delay_frame, text="秒").grid(row=0, column=2)
 
+        # 途中再開
+        self.resume_var = tk.BooleanVar(value=False)
+        self.resume_check = ttk.Checkbutton(
+            delay_frame, text="前回の続きから再開",
+            variable=self.resume_var
+        )
+        self.resume_check.grid(row=0, column=3, padx=(20, 0))
+
+        # 開始ページ・画像の保存
+        option_frame = ttk.Frame(main_frame)
+        option_frame.grid(row=5, column=0, sticky="w", pady=(0, 20))
+
+        ttk.Label(option_frame, text="開始ページ:").grid(row=0, column=0)
+
+        self.start_page_var = tk.StringVar(value="1")
+        self.start_page_entry = ttk.Entry(option_frame, textvariable=self.start_page_var, width=6)
+        self.start_page_entry.grid(row=0, column=1, padx=(10, 0))
+
+        self.keep_images_var = tk.BooleanVar(value=False)
+        self.keep_images_check = ttk.Checkbutton(
+            option_frame, text="ページ画像を保存",
+            variable=self.keep_images_var
+        )
+        self.keep_images_check.grid(row=0, column=2, padx=(20, 0))
+
+        # 出力プロファイル（ページ画像の縮小）
+        ttk.Label(option_frame, text="出力:").grid(row=1, column=0, sticky="w", pady=(10, 0))
+
+        self.profile_var = tk.StringVar(value="archive")
+        self.profile_combo = ttk.Combobox(
+            option_frame, textvariable=self.profile_var,
+            values=list(PROFILES), width=8, state="readonly"
+        )
+        self.profile_combo.grid(row=1, column=1, sticky="w", padx=(10, 0), pady=(10, 0))
+
+        self.classify_var = tk.BooleanVar(value=False)
+        self.classify_check = ttk.Checkbutton(
+            option_frame, text="白紙を削除・見開きを分割",
+            variable=self.classify_var
+        )
+        self.classify_check.grid(row=1, column=2, sticky="w", padx=(20, 0), pady=(10, 0))
+
         # 開始/キャンセルボタン
         self.start_btn = ttk.Button(
             main_frame, text="PDF作成開始",
             command=self._start_capture,
             style="Accent.TButton"
         )
-        self.start_btn.grid(row=5, column=0, pady=(0, 20), sticky="ew")
+        self.start_btn.grid(row=6, column=0, pady=(0, 20), sticky="ew")
 
         # 進捗バー
-        ttk.Label(main_frame, text="進捗:").grid(row=6, column=0, sticky="w", pady=(0, 5))
+        ttk.Label(main_frame, text="進捗:").grid(row=7, column=0, sticky="w", pady=(0, 5))
 
         self.progress_var = tk.DoubleVar(value=0)
         self.progress_bar = ttk.Progressbar(
             main_frame, variable=self.progress_var,
             maximum=100, length=350
         )
-        self.progress_bar.grid(row=7, column=0, sticky="ew", pady=(0, 10))
+        self.progress_bar.grid(row=8, column=0, sticky="ew", pady=(0, 10))
 
         # ステータス表示
         self.status_var = tk.StringVar(value="待機中")
         self.status_label = ttk.Label(main_frame, textvariable=self.status_var, foreground="gray")
-        self.status_label.grid(row=8, column=0, sticky="w")
+        self.status_label.grid(row=9, column=0, sticky="w")
+
+        # 処理時間の内訳（完了後に表示）
+        self.stats_var = tk.StringVar(value="")
+        self.stats_label = ttk.Label(main_frame, textvariable=self.stats_var,
+                                     font="TkFixedFont", justify="left")
+        self.stats_label.grid(row=10, column=0, sticky="w", pady=(10, 0))
 
     def _on_page_mode_change(self):
         """ページ数モード変更時の処理"""
@@ -167,6 +220,17 @@ class KindleToPdfApp:
             messagebox.showerror("エラー", "待機時間は0以上の数値で指定してください。")
             return False
 
+        try:
+            start_page = int(self.start_page_var.get())
+            if start_page <= 0:
+                raise ValueError()
+        except ValueError:
+            messagebox.showerror("エラー", "開始ページは正の整数で指定してください。")
+            return False
+        if start_page > 1 and self.resume_var.get():
+            messagebox.showerror("エラー", "開始ページの指定と前回の続きからの再開は同時に使えません。")
+            return False
+
         return True
 
     def _set_ui_state(self, running):
@@ -174,6 +238,11 @@ class KindleToPdfApp:
         state = "disabled" if running else "normal"
         self.output_entry.config(state=state)
         self.browse_btn.config(state=state)
+        self.resume_check.config(state=state)
+        self.start_page_entry.config(state=state)
+        self.keep_images_check.config(state=state)
+        self.profile_combo.config(state="disabled" if running else "readonly")
+        self.classify_check.config(state=state)
         self.page_count_entry.config(state=state if self.page_mode.get() == "manual" else "disabled")
 
         if running:
@@ -187,33 +256,67 @@ class KindleToPdfApp:
             return
 
         self.is_running = True
-        self.should_cancel = False
+        self.stats_var.set("")
         self._set_ui_state(True)
 
         # 別スレッドでキャプチャ処理を実行
+        self.engine = self._create_engine()
         self.capture_thread = threading.Thread(target=self._capture_process, daemon=True)
         self.capture_thread.start()
 
     def _cancel_capture(self):
-        """キャプチャをキャンセル"""
-        self.should_cancel = True
-        self._update_status("キャンセル中...")
+        """キャプチャをキャンセル（待機中でもすぐに止まる）"""
+        if self.engine is not None:
+            self.engine.cancel()
+        self.status_var.set("キャンセル中...")
 
-    def _update_status(self, message):
-        """ステータスを更新（メインスレッドで実行）"""
-        self.root.after(0, lambda: self.status_var.set(message))
+    def _create_engine(self):
+        """入力値からキャプチャエンジンを作成（メインスレッドで実行）"""
+        output_path = self.output_var.get().strip()
+        if not output_path.endswith(".pdf"):
+            output_path += ".pdf"
+
+        auto_detect = self.page_mode.get() == "auto"
+        # ジャーナル（と保存する画像）は出力ファイルと同じフォルダに記録する
+        return CaptureEngine(
+            output_path,
+            backend=self.backend_name,
+            backend_options=self.backend_options,
+            pages=None if auto_detect else int(self.page_count_var.get()),
+            delay=float(self.delay_var.get()),
+            start_page=int(self.start_page_var.get()),
+            resume=self.resume_var.get(),
+            keep_images=self.keep_images_var.get(),
+            max_width=PROFILES[self.profile_var.get()],
+            classify=self.classify_var.get(),
+            trace_path=self.trace_path,
+            work_dir=Path(output_path).parent / "kindle_screenshots",
+            listener=self.events
+        )
 
-    def _update_progress(self, value):
-        """進捗バーを更新（メインスレッドで実行）"""
-        self.root.after(0, lambda: self.progress_var.set(value))
+    def _handle_event(self, event):
+        """キャプチャエンジンのイベントを表示に反映（メインスレッドで実行）"""
+        if isinstance(event, StatusEvent):
+            self.status_var.set(event.message)
+        elif isinstance(event, ProgressEvent):
+            speed = event.pages_per_minute
+            if event.total is None:
+                self.status_var.set(f"ページ {event.page_num} をキャプチャ中...（{speed:.1f}ページ/分）")
+            else:
+                self.progress_var.set((event.page_num / event.total) * 90)  # 90%までキャプチャ
+                self.status_var.set(f"ページ {event.page_num}/{event.total} をキャプチャ中..."
+                                    f"（{speed:.1f}ページ/分、残り約{format_duration(event.eta)}）")
 
-    def _capture_complete(self, success, message):
+    def _capture_complete(self, success, message, stats=""):
         """キャプチャ完了時の処理（メインスレッドで実行）"""
         def complete():
+            # 溜まっている進捗を先に反映し、完了のメッセージで上書きされないようにする
+            self.events.flush()
             self.is_running = False
             self._set_ui_state(False)
             self.progress_var.set(100 if success else 0)
             self.status_var.set(message)
+            self.stats_var.set(stats)
 
             if success:
                 messagebox.showinfo("完了", message)
@@ -224,218 +327,47 @@ class KindleToPdfApp:
 
     def _capture_process(self):
         """キャプチャ処理（別スレッドで実行）"""
+        engine = self.engine
         try:
-            # 必要なモジュールをインポート
-            try:
-                import Quartz
-                from Foundation import NSURL
-                from PIL import Image
-            except ImportError as e:
-                self._capture_complete(False, f"必要なモジュールがありません: {e}")
-                return
-
-            output_path = self.output_var.get().strip()
-            if not output_path.endswith(".pdf"):
-                output_path += ".pdf"
-
-            auto_detect = self.page_mode.get() == "auto"
-            max_pages = 99999 if auto_detect else int(self.page_count_var.get())
-            delay = float(self.delay_var.get())
-
-            # 一時ディレクトリの作成
-            temp_dir = tempfile.mkdtemp(prefix="kindle_pdf_")
-            image_dir = Path(temp_dir)
-
-            try:
-                # Kindleをアクティブ化
-                self._update_status("Kindleアプリをアクティブ化中...")
-                self._activate_kindle()
-
-                # ウィンドウIDを取得
-                self._update_status("KindleウィンドウIDを取得中...")
-                window_id = self._get_kindle_window_id()
-
-                if window_id is None:
-                    self._capture_complete(False, "Kindleウィンドウが見つかりません。\nKindleアプリを起動して本を開いてください。")
-                    return
-
-                # 開始前待機
-                self._update_status("3秒後にキャプチャを開始...")
-                for i in range(3, 0, -1):
-                    if self.should_cancel:
-                        self._capture_complete(False, "キャンセルされました")
-                        return
-                    self._update_status(f"{i}秒後にキャプチャを開始...")
-                    time.sleep(1)
-
-                # キャプチャループ
-                page_num = 1
-                last_hash = None
-                same_count = 0
-
-                while page_num <= max_pages:
-                    if self.should_cancel:
-                        self._capture_complete(False, "キャンセルされました")
-                        return
-
-                    filepath = image_dir / f"page_{page_num:04d}.png"
-
-                    # スクリーンショット撮影
-                    self._capture_window(window_id, str(filepath))
-
-                    # 自動検出モード: 同じ画像が3回続いたら終了
-                    if auto_detect:
-                        current_hash = self._get_image_hash(str(filepath))
-                        if current_hash == last_hash:
-                            same_count += 1
-                            if same_count >= 3:
-                                # 重複した画像を削除
-                                for i in range(same_count):
-                                    dup_path = image_dir / f"page_{page_num - i:04d}.png"
-                                    if dup_path.exists():
-                                        dup_path.unlink()
-                                page_num -= same_count
-                                self._update_status(f"最後のページを検出（{page_num}ページ）")
-                                break
-                        else:
-                            same_count = 0
-                        last_hash = current_hash
-                        self._update_status(f"ページ {page_num} をキャプチャ中...")
-                    else:
-                        progress = (page_num / max_pages) * 90  # 90%までキャプチャ
-                        self._update_progress(progress)
-                        self._update_status(f"ページ {page_num}/{max_pages} をキャプチャ中...")
-
-                    # ページ送り
-                    self._send_page_turn()
-                    time.sleep(delay)
-                    page_num += 1
-
-                # PDFに結合
-                self._update_status("PDFを作成中...")
-                self._update_progress(95)
-                self._images_to_pdf(image_dir, output_path)
-
-                self._capture_complete(True, f"PDF作成完了: {output_path}")
-
-            finally:
-                # 一時ファイルの削除
-                shutil.rmtree(temp_dir, ignore_errors=True)
-
+            result = engine.run()
+        except CaptureError as e:
+            self._capture_complete(False, str(e))
+            return
         except Exception as e:
             self._capture_complete(False, f"エラーが発生しました: {str(e)}")
+            return
 
-    def _get_kindle_window_id(self):
-        """KindleアプリのウィンドウIDを取得"""
-        import Quartz
-
-        window_list = Quartz.CGWindowListCopyWindowInfo(
-            Quartz.kCGWindowListOptionOnScreenOnly,
-            Quartz.kCGNullWindowID
-        )
-
-        kindle_windows = []
-        for window in window_list:
-            owner_name = window.get('kCGWindowOwnerName', '')
-
-            if owner_name == 'Kindle':
-                window_id = window.get('kCGWindowNumber')
-                bounds = window.get('kCGWindowBounds', {})
-                width = bounds.get('Width', 0)
-                height = bounds.get('Height', 0)
-                if width > 100 and height > 100:
-                    kindle_windows.append((window_id, width * height))
-
-        if kindle_windows:
-            kindle_windows.sort(key=lambda x: x[1], reverse=True)
-            return kindle_windows[0][0]
-
-        return None
-
-    def _activate_kindle(self):
-        """Kindleアプリをアクティブ化"""
-        script = '''
-        tell application "Amazon Kindle"
-            activate
-        end tell
-        '''
-        subprocess.run(['osascript', '-e', script], check=True)
-        time.sleep(0.5)
-
-    def _capture_window(self, window_id, filepath):
-        """指定ウィンドウのスクリーンショットを撮影"""
-        from Foundation import NSURL
-        from Quartz import (CGImageDestinationAddImage,
-                           CGImageDestinationCreateWithURL,
-                           CGImageDestinationFinalize, CGRectNull,
-                           CGWindowListCreateImage,
-                           kCGWindowImageDefault,
-                           kCGWindowListOptionIncludingWindow)
-
-        image = CGWindowListCreateImage(
-            CGRectNull,
-            kCGWindowListOptionIncludingWindow,
-            int(window_id),
-            kCGWindowImageDefault
-        )
-
-        if image is None:
-            raise RuntimeError(f"ウィンドウ {window_id} のキャプチャに失敗しました")
-
-        url = NSURL.fileURLWithPath_(filepath)
-        dest = CGImageDestinationCreateWithURL(url, 'public.png', 1, None)
-        CGImageDestinationAddImage(dest, image, None)
-        CGImageDestinationFinalize(dest)
-
-    def _send_page_turn(self):
-        """Kindleで次のページへ移動"""
-        script = '''
-        tell application "System Events"
-            tell process "Kindle"
-                key code 124
-            end tell
-        end tell
-        '''
-        subprocess.run(['osascript', '-e', script], check=True)
-
-    def _get_image_hash(self, filepath):
-        """画像ファイルのハッシュ値を取得"""
-        from PIL import Image
-
-        with Image.open(filepath) as img:
-            return hashlib.md5(img.tobytes()).hexdigest()
-
-    def _images_to_pdf(self, image_dir, output_path):
-        """画像ファイルをPDFに結合"""
-        from PIL import Image
-
-        image_files = sorted(Path(image_dir).glob("page_*.png"))
-
-        if not image_files:
-            raise RuntimeError("画像ファイルが見つかりません")
-
-        images = []
-        for img_path in image_files:
-            img = Image.open(img_path)
-            if img.mode == 'RGBA':
-                rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                rgb_img.paste(img, mask=img.split()[3])
-                images.append(rgb_img)
-            else:
-                images.append(img.convert('RGB'))
-
-        if images:
-            images[0].save(
-                output_path,
-                save_all=True,
-                append_images=images[1:],
-                resolution=100.0
-            )
+        if result.cancelled:
+            self._capture_complete(False, "キャンセルされました（「前回の続きから再開」で再開できます）")
+            return
+        message = f"PDF作成完了: {result.output_path}（{result.page_count}ページ）"
+        if result.image_dir is not None:
+            message += f"\n画像は {result.image_dir} に保存されています。"
+        stats = (engine.classify_report(result) + engine.duplicate_report(result)
+                 + engine.timer.report())
+        self._capture_complete(True, message, "\n".join(stats))
 
 
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Kindle本をPDF化するツール（GUI版）")
+    parser.add_argument(
+        "--backend",
+        choices=["kindle", "synthetic"],
+        default="kindle",
+        help="キャプチャ元（synthetic: 合成した本で動作確認、デフォルト: kindle）"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="処理段階ごとの時間をChrome trace形式（JSON）で書き出すファイル"
+    )
+    # アプリとして起動した場合にmacOSが付ける引数は無視する
+    args, _ = parser.parse_known_args()
+
     root = tk.Tk()
-    app = KindleToPdfApp(root)
+    app = KindleToPdfApp(root, backend=args.backend, trace_path=args.trace)
     root.mainloop()
 
 
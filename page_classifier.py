@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+ページの分類（白紙・本文・挿絵・見開き）
+指紋の計算に使う縮小画像から、インク（背景色でない画素）の割合・中間調と色の割合・
+本文の範囲の縦横比・中央の縦の余白（見開きの境目）をNumPyでまとめて計算し、ページを分類する。
+白紙のページはPDFに書き出さず、見開きは境目で左右の2ページに分けてからエンコードする。
+
+特徴量はジャーナルに指紋と一緒に記録する。保存済みのページ画像からPDFを作り直すときは
+記録済みの特徴量を使い、記録がない画像だけをまとめて計算する。
+"""
+
+import threading
+import time
+
+from fingerprint import HASH_SIZE
+from page_encoder import COLOR_CHANNEL_DIFF
+from trim import ink_masks
+
+# 分類に使う縮小画像の一辺（指紋の計算で間引いたものと同じ大きさ）
+SAMPLE_SIZE = HASH_SIZE * 4
+
+PAGE_LABELS = ('text', 'illustration', 'spread', 'blank')
+
+# 切り抜き範囲がない場合、ウィンドウの上下端のこの割合はツールバーや位置の表示とみなして除く
+EDGE_RATIO = 0.08
+
+# インクの画素がページ領域のこの割合未満なら白紙
+BLANK_INK_RATIO = 0.002
+
+# 中間調（グレーの範囲）または色付きのインクの画素がページ領域のこの割合を超えるなら挿絵
+MIDTONE_RANGE = (48, 208)
+ILLUSTRATION_TONE_RATIO = 0.12
+
+# 本文の範囲の幅が高さのこの倍以上で、中央付近に縦の余白があれば見開き
+SPREAD_ASPECT = 1.0
+
+# 境目を探す範囲（本文の範囲の幅に対する割合）と、境目とみなす余白の最小幅（縮小画像の列数）
+GUTTER_SEARCH = (0.35, 0.65)
+GUTTER_MIN_COLUMNS = 2
+
+# 見開きの左右それぞれに必要なインクの割合
+SPREAD_SIDE_RATIO = 0.2
+
+
+def _import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("ページの分類にはNumPyが必要です。インストール: pip install numpy")
+    return np
+
+
+def sample_image(img):
+    """PIL画像を分類用の縮小画像にする（フレームは Frame.sample で同じ大きさに間引く）"""
+    from PIL import Image
+
+    return img.resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.NEAREST).convert('RGB')
+
+
+def page_features(samples, sizes, box=None):
+    """縮小画像のバッチからページごとの特徴量を計算する
+
+    samples: 同じ大きさの縮小画像（PIL画像または配列 (高さ, 幅, 3)）のリスト
+    sizes: 元の画像の (幅, 高さ) のリスト
+    box: 切り抜き範囲（元の画像の座標、省略時はウィンドウの上下端を除いた範囲）
+    戻り値: ページごとの (インクの割合, 中間調・色の割合, 本文の縦横比, 境目の位置) のリスト
+            境目の位置は画像の幅に対する割合（見開きの境目がなければ0）
+    """
+    np = _import_numpy()
+
+    arrays = [np.asarray(sample) for sample in samples]
+    masks = ink_masks(arrays)
+    batch = np.stack(arrays)
+    r, g, b = batch[..., 0], batch[..., 1], batch[..., 2]
+    luma = (r.astype(np.uint16) * 77 + g.astype(np.uint16) * 150 + b.astype(np.uint16) * 29) >> 8
+    chroma = np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b)
+    toned = masks & (((luma >= MIDTONE_RANGE[0]) & (luma < MIDTONE_RANGE[1]))
+                     | (chroma > COLOR_CHANNEL_DIFF))
+
+    sample_height, sample_width = masks.shape[1:]
+    features = []
+    for mask, tone_mask, (width, height) in zip(masks, toned, sizes):
+        left, top, right, bottom = _area(box, (width, height), (sample_width, sample_height))
+        region = mask[top:bottom, left:right]
+        if region.size == 0:
+            features.append((0.0, 0.0, 0.0, 0.0))
+            continue
+        ink = float(region.mean())
+        tone = float(tone_mask[top:bottom, left:right].mean())
+        aspect, gutter = _layout(region, width / sample_width, height / sample_height)
+        features.append((ink, tone, aspect, (left + gutter) / sample_width if gutter else 0.0))
+    return features
+
+
+def _area(box, size, sample_size):
+    """特徴量を計算する範囲（縮小画像の座標）"""
+    sample_width, sample_height = sample_size
+    if box is None:
+        edge = int(sample_height * EDGE_RATIO)
+        return (0, edge, sample_width, sample_height - edge)
+    x_scale = sample_width / size[0]
+    y_scale = sample_height / size[1]
+    return (int(box[0] * x_scale), int(box[1] * y_scale),
+            int(box[2] * x_scale), int(box[3] * y_scale))
+
+
+def _layout(region, x_scale, y_scale):
+    """本文の範囲の縦横比（元の画像の画素で）と、中央付近の縦の余白の中心の列（なければ0）"""
+    np = _import_numpy()
+
+    column_ink = region.sum(axis=0)
+    columns = np.flatnonzero(column_ink)
+    rows = np.flatnonzero(region.any(axis=1))
+    if columns.size == 0:
+        return 0.0, 0
+    first, last = int(columns[0]), int(columns[-1]) + 1
+    aspect = (last - first) * x_scale / ((int(rows[-1]) + 1 - int(rows[0])) * y_scale)
+
+    # 探す範囲の中で、インクのない列が最も長く続く部分を境目とする
+    start = first + int((last - first) * GUTTER_SEARCH[0])
+    end = first + int((last - first) * GUTTER_SEARCH[1])
+    empty = (column_ink[start:end] == 0).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], empty, [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    if run_starts.size == 0:
+        return aspect, 0
+    longest = int(np.argmax(run_ends - run_starts))
+    if run_ends[longest] - run_starts[longest] < GUTTER_MIN_COLUMNS:
+        return aspect, 0
+    gutter = start + (int(run_starts[longest]) + int(run_ends[longest])) / 2
+
+    total = column_ink.sum()
+    left_ink = column_ink[:int(gutter)].sum()
+    if min(left_ink, total - left_ink) < total * SPREAD_SIDE_RATIO:
+        return aspect, 0
+    return aspect, gutter
+
+
+def classify_features(features):
+    """特徴量からページを 'blank' / 'spread' / 'illustration' / 'text' に分類"""
+    ink, tone, aspect, gutter = features
+    if ink < BLANK_INK_RATIO:
+        return 'blank'
+    if gutter and aspect >= SPREAD_ASPECT:
+        return 'spread'
+    if tone > ILLUSTRATION_TONE_RATIO:
+        return 'illustration'
+    return 'text'
+
+
+def split_spread(box, size, gutter):
+    """見開きを境目で分けた左右の範囲（境目が範囲の外にある場合はNone）"""
+    left, top, right, bottom = box or (0, 0, size[0], size[1])
+    x = round(gutter * size[0])
+    if not left < x < right:
+        return None
+    return [(left, top, x, bottom), (x, top, right, bottom)]
+
+
+class PageClassifier:
+    """ページを分類し、分類ごとのページ数と計算時間を集計する
+
+    複数のワーカースレッドから同時に呼び出してよい。
+    cache は保存済みのページ画像のファイル名 -> 特徴量（ジャーナルに記録したもの）で、
+    split_files() は cache にない画像の特徴量だけを batch_size 枚ずつまとめて計算する。
+    """
+
+    def __init__(self, batch_size=16):
+        self.batch_size = batch_size
+        self.cache = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.seconds = 0.0
+        self.cached = 0
+
+    def classify_sample(self, sample, size, box=None):
+        """フレームの縮小画像を分類し、(分類, 特徴量, エンコードする範囲のリスト) を返す
+
+        白紙は範囲なし、見開きは左右の2つ、それ以外は box の1つ。
+        キャプチャでは最後のページの後に撮影したフレームも分類するため、
+        ページ数は集計せず、PDFに書き出したページを数えた結果を report() に渡す。
+        """
+        start = time.perf_counter()
+        features = page_features([sample], [size], box)[0]
+        label, boxes = self._parts(features, size, box)
+        with self._lock:
+            self.seconds += time.perf_counter() - start
+        return label, features, boxes
+
+    def split_files(self, image_files, box=None):
+        """保存済みのページ画像（またはスプールのページ）を分類し、PDFに書き出す (ファイル, 範囲) のリストを返す"""
+        from frame_spool import open_page, page_name
+
+        entries = []
+        batch = []
+        cached = 0
+        for path in image_files:
+            with open_page(path) as img:
+                size = img.size
+                features = self.cache.get(page_name(path))
+                if features is None:
+                    batch.append((len(entries), sample_image(img)))
+                else:
+                    cached += 1
+            entries.append([path, size, features])
+            if len(batch) >= self.batch_size:
+                self._analyze(entries, batch, box)
+                batch = []
+        if batch:
+            self._analyze(entries, batch, box)
+
+        items = []
+        with self._lock:
+            for path, size, features in entries:
+                label, boxes = self._parts(features, size, box)
+                self.stats[label] = self.stats.get(label, 0) + 1
+                items.extend((path, part) for part in boxes)
+            self.cached += cached
+        return items
+
+    def _analyze(self, entries, batch, box):
+        """特徴量のないページのバッチを計算して entries に書き込む"""
+        start = time.perf_counter()
+        features = page_features([sample for _, sample in batch],
+                                 [entries[index][1] for index, _ in batch], box)
+        for (index, _), values in zip(batch, features):
+            entries[index][2] = values
+        with self._lock:
+            self.seconds += time.perf_counter() - start
+
+    def _parts(self, features, size, box):
+        label = classify_features(features)
+        if label == 'blank':
+            return label, []
+        if label == 'spread':
+            halves = split_spread(box, size, features[3])
+            if halves is not None:
+                return label, halves
+            # 境目が切り抜き範囲の外にある場合は分けない
+            label = 'text'
+        return label, [box]
+
+    def report(self, page_classes=None):
+        """分類ごとのページ数と、削除・分割したページ数（表示用の行のリスト）
+
+        page_classes: キャプチャで書き出したページの 分類 -> ページ数
+        （保存済みの画像から追加したページ（stats）と合わせて表示する）
+        """
+        counts = dict(self.stats)
+        for label, pages in (page_classes or {}).items():
+            counts[label] = counts.get(label, 0) + pages
+        labels = {'text': '本文', 'illustration': '挿絵', 'spread': '見開き', 'blank': '白紙'}
+        summary = " / ".join(f"{labels[label]} {counts[label]}"
+                             for label in PAGE_LABELS if label in counts)
+        lines = [f"分類: {summary or 'なし'}（特徴量の計算 {self.seconds:.2f} 秒）"]
+        if self.cached:
+            lines.append(f"記録済みの特徴量を使用: {self.cached}ページ")
+        if counts.get('blank'):
+            lines.append(f"削除した白紙ページ: {counts['blank']}ページ")
+        if counts.get('spread'):
+            lines.append(f"分割した見開き: {counts['spread']}ページ（PDFでは{counts['spread'] * 2}ページ）")
+        return lines
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+ページごとのエンコード方式の選択
+ページを「白黒（文字のみ）」「グレースケール」「カラー」に分類し、
+白黒は1ビット（CCITT G4、使えない場合はFlate）、グレーは8ビットグレーのJPEG、
+カラーは指定品質のJPEGでPDFに埋め込む。文字だけのページがカラー写真と同じサイズになるのを防ぐ。
+
+出力プロファイル（または最大幅・解像度）を指定した場合は、エンコードの前にページを縮小する。
+整数分の1への縮小（reduce、JPEGファイルは読み込み時のdraft）を先に行ってから残りを補間するため、
+フル解像度のまま補間するより速い。PDFのページの大きさは縮小前と同じに保つ。
+
+mode='png' は可逆圧縮で、ページをPNGにエンコードしてIDATのzlibストリームをそのまま
+FlateDecode（/DecodeParms の /Predictor 15）として埋め込む。保存済みのPNGファイルは
+デコードせずにIDATをコピーする（png_passthrough、透過・パレット・インターレースのPNGは通常のエンコード）。
+
+WebPのアーカイブ（--format webp）に書き出す場合は、同じ分類で白黒をロスレス、
+グレー・カラーを指定品質の非可逆のWebPにエンコードする（PDFには埋め込めない）。
+
+サムネイル（PDFの /Thumb）を作る場合は、指紋の計算に使う縮小画像（frame.sample）から作り、
+フル解像度の画像をもう一度縮小しない。
+"""
+
+import io
+import struct
+import threading
+import time
+import zlib
+
+from pdf_writer import EncodedImage, flatten_image
+
+# 分類用に縮小する際の縮小率
+SAMPLE_FACTOR = 8
+
+# 彩度（RGBの差）がこの値を超える画素を色付きとみなす
+COLOR_CHANNEL_DIFF = 32
+
+# 色付きの画素がこの割合を超えるページはカラー
+COLOR_PIXEL_RATIO = 0.01
+
+# 中間調の画素がこの割合以下のページは白黒
+MIDTONE_RATIO = 0.06
+
+PAGE_CLASSES = ('bilevel', 'gray', 'color')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# サムネイルの長辺（画素）とJPEGの品質
+THUMB_SIZE = 128
+THUMB_QUALITY = 60
+
+# 指定できるJPEG・WebPの品質の範囲（Pillowは95より上ではファイルが大きくなるだけ）
+QUALITY_RANGE = (1, 95)
+
+# 出力プロファイルごとのページ画像の最大幅（画素、Noneなら縮小しない）
+PROFILES = {
+    'archive': None,
+    'tablet': 2048,
+    'ereader': 1264,
+}
+
+
+def parse_quality(text):
+    """コマンドラインで指定した品質を整数にする（QUALITY_RANGE の外なら ValueError）"""
+    try:
+        quality = int(text)
+    except ValueError:
+        raise ValueError(f"品質は整数で指定してください: {text}")
+    low, high = QUALITY_RANGE
+    if not low <= quality <= high:
+        raise ValueError(f"品質は{low}〜{high}で指定してください: {text}")
+    return quality
+
+
+def output_size(size, max_width=None, dpi=None, resolution=100.0):
+    """縮小後の大きさ（縮小しない場合はNone）
+
+    dpi は撮影した画像を resolution dpiとみなしたときのページの大きさに対する解像度。
+    """
+    width, height = size
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / width)
+    if dpi:
+        scale = min(scale, dpi / resolution)
+    if scale >= 1.0:
+        return None
+    return (max(round(width * scale), 1), max(round(height * scale), 1))
+
+
+def resample_page(img, size):
+    """ページ画像を size に縮小（整数分の1への縮小を先に行う高速な経路を使う）"""
+    from PIL import Image
+
+    # 読み込み前のJPEGはデコード時に縮小する（読み込み済みなら何もしない）
+    if getattr(img, 'format', None) == 'JPEG':
+        img.draft(img.mode, size)
+    if img.size == size:
+        return img
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=1.0)
+
+
+def classify_page(img):
+    """ページを 'bilevel'（白黒）/ 'gray'（グレー）/ 'color'（カラー）に分類"""
+    from PIL import Image, ImageChops
+
+    img = flatten_image(img)
+    sample = img.resize((max(img.width // SAMPLE_FACTOR, 1), max(img.height // SAMPLE_FACTOR, 1)),
+                        Image.NEAREST)
+    total = sample.width * sample.height
+
+    r, g, b = sample.split()
+    chroma = ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b))
+    colored = sum(chroma.histogram()[COLOR_CHANNEL_DIFF + 1:])
+    if colored > total * COLOR_PIXEL_RATIO:
+        return 'color'
+
+    histogram = sample.convert('L').histogram()
+    midtones = sum(histogram[48:208])
+    if midtones <= total * MIDTONE_RATIO:
+        return 'bilevel'
+    return 'gray'
+
+
+def encode_bilevel(img):
+    """1ビット白黒でエンコード（libtiffがあればCCITT G4、なければFlate）"""
+    from PIL import Image, features
+
+    bilevel = img.convert('L').convert('1', dither=Image.Dither.NONE)
+    width, height = bilevel.size
+
+    if features.check('libtiff'):
+        buf = io.BytesIO()
+        # 1つのストリップにまとめ、TIFFの中からG4データだけを取り出す
+        bilevel.save(buf, 'TIFF', compression='group4',
+                     strip_size=(width + 7) // 8 * height)
+        buf.seek(0)
+        with Image.open(buf) as tiff:
+            offset = tiff.tag_v2[273][0]
+            length = tiff.tag_v2[279][0]
+        data = buf.getvalue()[offset:offset + length]
+        parms = b'<< /K -1 /BlackIs1 true /Columns %d /Rows %d >>' % (width, height)
+        return EncodedImage((width, height), 'DeviceGray', 1, 'CCITTFaxDecode', data, parms)
+
+    return EncodedImage((width, height), 'DeviceGray', 1, 'FlateDecode',
+                        zlib.compress(bilevel.tobytes(), 9))
+
+
+def encode_gray(img, quality):
+    """8ビットグレースケールのJPEGでエンコード"""
+    buf = io.BytesIO()
+    gray = img.convert('L')
+    gray.save(buf, 'JPEG', quality=quality)
+    return EncodedImage(gray.size, 'DeviceGray', 8, 'DCTDecode', buf.getvalue())
+
+
+def encode_color(img, quality):
+    """カラーのJPEGでエンコード"""
+    buf = io.BytesIO()
+    rgb = flatten_image(img)
+    rgb.save(buf, 'JPEG', quality=quality)
+    return EncodedImage(rgb.size, 'DeviceRGB', 8, 'DCTDecode', buf.getvalue())
+
+
+def png_passthrough(data, max_width=None, dpi=None):
+    """PNGファイルのIDATをデコードせずにPDFのストリームにし、(EncodedImage, 分類) を返す
+
+    グレー（1/2/4/8ビット）・RGB（8ビット）のインターレースなしのPNGのみ。透過（アルファ・tRNS）・
+    パレット・16ビット・インターレースのPNGや、縮小が必要な場合はNoneを返す（通常のエンコードを使う）。
+    """
+    if data[:8] != PNG_SIGNATURE:
+        return None
+    view = memoryview(data)
+    header = None
+    chunks = []
+    position = 8
+    while position + 12 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', view[position:position + 8])
+        body = view[position + 8:position + 8 + length]
+        crc = struct.unpack('>I', view[position + 8 + length:position + 12 + length])[0]
+        if zlib.crc32(body, zlib.crc32(chunk_type)) != crc:
+            return None
+        if chunk_type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif chunk_type == b'IDAT':
+            chunks.append(body)
+        elif chunk_type == b'tRNS':
+            return None
+        elif chunk_type == b'IEND':
+            break
+        position += 12 + length
+    if header is None or not chunks:
+        return None
+    width, height, depth, color_type, _, _, interlace = header
+    if interlace or not (color_type == 0 and depth <= 8 or color_type == 2 and depth == 8):
+        return None
+    if output_size((width, height), max_width, dpi) is not None:
+        return None
+    colors = 3 if color_type == 2 else 1
+    parms = b'<< /Predictor 15 /Colors %d /BitsPerComponent %d /Columns %d >>' % (
+        colors, depth, width)
+    encoded = EncodedImage((width, height), 'DeviceRGB' if colors == 3 else 'DeviceGray', depth,
+                           'FlateDecode', b''.join(chunks), parms)
+    return encoded, 'color' if colors == 3 else 'gray'
+
+
+def encode_png(img):
+    """PNGにエンコードし、IDATをそのままPDFのストリームにする（可逆）"""
+    if img.mode not in ('1', 'L', 'RGB'):
+        img = img.convert('L') if img.mode == 'LA' else flatten_image(img)
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return png_passthrough(buf.getvalue())[0]
+
+
+def encode_webp(img, quality, page_class, lossless=False):
+    """WebPでエンコード（白黒と lossless=True の場合はロスレス、グレー・カラーは非可逆）"""
+    buf = io.BytesIO()
+    if lossless:
+        page = img if img.mode in ('L', 'RGB') else flatten_image(img)
+        page.save(buf, 'WEBP', lossless=True, quality=100, method=1)
+    elif page_class == 'bilevel':
+        page = img.convert('L').point(lambda value: 255 if value >= 128 else 0)
+        page.save(buf, 'WEBP', lossless=True, quality=100, method=1)
+    else:
+        page = img.convert('L') if page_class == 'gray' else flatten_image(img)
+        page.save(buf, 'WEBP', quality=quality, method=4)
+    return EncodedImage(page.size, 'DeviceGray' if page.mode == 'L' else 'DeviceRGB', 8, 'WebP',
+                        buf.getvalue())
+
+
+def encode_thumbnail(img, size=None, box=None, gray=False):
+    """ページのサムネイル（PDFの /Thumb）をJPEGでエンコード
+
+    img はページ画像、または指紋・分類に使う縮小画像。縮小画像の場合は size に元のフレームの
+    大きさを渡す（サムネイルの縦横比は元の大きさに合わせる）。box はフレーム上の切り抜く範囲。
+    gray=True の場合はグレースケールにする（白黒・グレーのページ）。
+    """
+    from PIL import Image
+
+    width, height = size or img.size
+    if box:
+        x_scale = img.width / width
+        y_scale = img.height / height
+        img = img.crop((int(box[0] * x_scale), int(box[1] * y_scale),
+                        max(round(box[2] * x_scale), int(box[0] * x_scale) + 1),
+                        max(round(box[3] * y_scale), int(box[1] * y_scale) + 1)))
+        width, height = box[2] - box[0], box[3] - box[1]
+    scale = min(THUMB_SIZE / max(width, height), 1.0)
+    thumb_size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    # 大きな画像は最近傍法で間引いてから平均化する（指紋の計算と同じ）
+    if img.width > thumb_size[0] * 4 and img.height > thumb_size[1] * 4:
+        img = img.resize((thumb_size[0] * 4, thumb_size[1] * 4), Image.NEAREST)
+    thumb = flatten_image(img).resize(thumb_size, Image.BOX)
+    if gray:
+        thumb = thumb.convert('L')
+    buf = io.BytesIO()
+    thumb.save(buf, 'JPEG', quality=THUMB_QUALITY)
+    return EncodedImage(thumb.size, 'DeviceGray' if gray else 'DeviceRGB', 8, 'DCTDecode',
+                        buf.getvalue())
+
+
+def encode_page(img, mode='auto', quality=75, max_width=None, dpi=None, webp=False):
+    """ページをエンコードし、(EncodedImage, 分類) を返す（max_width・dpi を指定すると縮小する）
+
+    webp=True の場合はPDF用のストリームの代わりにWebPにする。
+    """
+    size = output_size(img.size, max_width, dpi)
+    scale = 1.0
+    if size is not None:
+        original_width = img.width
+        img = resample_page(img, size)
+        scale = img.width / original_width
+
+    if mode == 'png':
+        page_class = 'gray' if img.mode in ('1', 'L', 'LA') else 'color'
+        if webp:
+            encoded = encode_webp(img, quality, page_class, lossless=True)
+        else:
+            encoded = encode_png(img)
+        encoded.scale = scale
+        return encoded, page_class
+
+    page_class = classify_page(img) if mode == 'auto' else 'color'
+    if webp:
+        encoded = encode_webp(img, quality, page_class)
+    elif page_class == 'bilevel':
+        encoded = encode_bilevel(img)
+    elif page_class == 'gray':
+        encoded = encode_gray(img, quality)
+    else:
+        encoded = encode_color(img, quality)
+    encoded.scale = scale
+    return encoded, page_class
+
+
+class PageEncoder:
+    """ページをPDF用にエンコードし、分類ごとのサイズと時間を集計する
+
+    mode='jpeg' は従来通り全ページをカラーのJPEGに、mode='auto' はページごとに方式を選ぶ。
+    mode='png' は可逆圧縮で、保存済みのPNGは passthrough() でデコードせずに埋め込む。
+    max_width・dpi を指定した場合は、エンコードの前にページを縮小する。
+    thumbnails=True の場合は、ページのサムネイルも作る（encode() の sample で縮小画像を渡せる）。
+    webp=True の場合はWebPのアーカイブ用に、ページをWebPにエンコードする。
+    複数のワーカースレッドから同時に呼び出してよい。
+    """
+
+    def __init__(self, mode='jpeg', quality=75, max_width=None, dpi=None, thumbnails=False,
+                 webp=False):
+        if mode not in ('jpeg', 'auto', 'png'):
+            raise ValueError(f"未対応のエンコード方式です: {mode}")
+        self.mode = mode
+        self.quality = quality
+        self.max_width = max_width
+        self.dpi = dpi
+        self.thumbnails = thumbnails
+        self.webp = webp
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def encode(self, img, sample=None):
+        """PIL画像をエンコードしたEncodedImageを返す
+
+        sample は (縮小画像, フレームの大きさ, 切り抜く範囲)。サムネイルを作る場合は
+        img の代わりにこれから作る。
+        """
+        start = time.perf_counter()
+        encoded, page_class = encode_page(img, self.mode, self.quality, self.max_width, self.dpi,
+                                          self.webp)
+        if self.thumbnails:
+            encoded.thumb = encode_thumbnail(*(sample or (img,)),
+                                             gray=encoded.colorspace == 'DeviceGray')
+        self.record(page_class, len(encoded.data), time.perf_counter() - start)
+        return encoded
+
+    def passthrough(self, data, box=None):
+        """保存済みのPNGファイルのデータをデコードせずにEncodedImageにする（できなければNone）
+
+        mode='png' で、切り抜き・縮小がなく、WebPにしない場合のみ。
+        """
+        if self.mode != 'png' or box or self.webp:
+            return None
+        start = time.perf_counter()
+        result = png_passthrough(data, self.max_width, self.dpi)
+        if result is None:
+            return None
+        encoded, page_class = result
+        if self.thumbnails:
+            from PIL import Image
+
+            # サムネイルを作る場合だけはデコードする
+            with Image.open(io.BytesIO(data)) as img:
+                encoded.thumb = encode_thumbnail(img, gray=page_class == 'gray')
+        self.record(page_class, len(encoded.data), time.perf_counter() - start)
+        return encoded
+
+    def record(self, page_class, size, seconds):
+        """エンコード結果を集計に加える（別プロセスでエンコードした場合にも使う）"""
+        with self._lock:
+            pages, total_size, total_seconds = self.stats.get(page_class, (0, 0, 0.0))
+            self.stats[page_class] = (pages + 1, total_size + size, total_seconds + seconds)
+
+    def report(self):
+        """分類ごとのページ数・サイズ・エンコード時間の表（文字列のリスト）"""
+        labels = {'bilevel': '白黒', 'gray': 'グレー', 'color': 'カラー'}
+        lines = [f"{'分類':<6} {'ページ数':>8} {'サイズ(MB)':>11} {'1ページ(KB)':>12} {'時間(秒)':>9}"]
+        for page_class in PAGE_CLASSES:
+            if page_class not in self.stats:
+                continue
+            pages, size, seconds = self.stats[page_class]
+            lines.append(f"{labels[page_class]:<6} {pages:>8} {size / (1024 * 1024):>11.2f} "
+                         f"{size / pages / 1024:>12.1f} {seconds:>9.2f}")
+        return lines
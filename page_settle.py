@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+ページ描画の完了検出
+ページ送り後に固定時間待つ代わりに、縮小したフレームを繰り返し取得し、
+前のページから指紋が変化したあと一定回数安定した時点で描画完了と判断する。
+"""
+
+import time
+
+from fingerprint import DEFAULT_THRESHOLD, fingerprint_frame
+
+
+class PageSettler:
+    """ページ送り後、新しいページの描画が落ち着くまで待つ
+
+    - 前のページとの指紋のハミング距離が threshold を超えたら「変化あり」
+    - その後、連続する stable_samples 回のサンプルの距離が threshold 以下なら描画完了
+    - max_wait 秒たっても変化しなければページ送りをやり直す（retries 回まで）
+    """
+
+    def __init__(self, sample, turn_page, stable_samples=3, interval=0.05,
+                 min_wait=0.1, max_wait=3.0, retries=1,
+                 threshold=DEFAULT_THRESHOLD,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.sample = sample
+        self.turn_page = turn_page
+        self.stable_samples = stable_samples
+        self.interval = interval
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.retries = retries
+        self.threshold = threshold
+        self._sleep = sleep
+        self._clock = clock
+        self.previous = None
+        self.turn_retries = 0
+
+    def reset(self):
+        """現在表示されているページを基準として記録"""
+        self.previous = fingerprint_frame(self.sample())
+
+    def next_page(self):
+        """ページを送り、描画完了まで待つ
+
+        新しいページが表示されればTrue、ページ送りをやり直しても
+        変化がなければ（最後のページ）Falseを返す。
+        """
+        if self.previous is None:
+            self.reset()
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.turn_retries += 1
+            self.turn_page()
+            signature = self._wait_settled()
+            if signature is not None:
+                self.previous = signature
+                return True
+        return False
+
+    def _wait_settled(self):
+        """変化後に安定したページの指紋を返す（変化しなければNone）"""
+        start = self._clock()
+        last = None
+        stable_count = 0
+        changed = False
+
+        while True:
+            self._sleep(self.interval)
+            signature = fingerprint_frame(self.sample())
+            elapsed = self._clock() - start
+
+            if not changed:
+                changed = not signature.matches(self.previous, self.threshold)
+                if changed:
+                    last = signature
+                    stable_count = 0
+            else:
+                if signature.matches(last, self.threshold):
+                    stable_count += 1
+                else:
+                    stable_count = 0
+                last = signature
+
+            if changed and stable_count >= self.stable_samples and elapsed >= self.min_wait:
+                return last
+            if elapsed >= self.max_wait:
+                # 変化はしたが安定しない場合は最後のサンプルを採用する
+                return last if changed else None
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+内容が同じページの共有
+描画の遅れで同じページを2回撮影した場合や、白紙の区切りページ・繰り返し出てくる扉絵などは、
+ページの内容を表すキーが一致する。キーが一致したページはエンコードを省略して
+前のページのエンコード結果を再利用し、PDFにも画像を1つだけ埋め込んで複数のページから参照する。
+
+キーは指紋（縮小画像のハッシュ）・サイズ・画素全体のCRC32を組み合わせたもので、
+指紋が似ているだけのページ（同じレイアウトの別のページなど）は一致しない。
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+
+DEDUP_MODES = ('off', 'share', 'drop')
+
+
+def frame_key(frame, fingerprint, box=None):
+    """キャプチャしたフレームの内容を表すキー（box は切り抜き範囲）"""
+    if box:
+        frame = frame.crop(box)
+    return f"{fingerprint.hex()}-{frame.width}x{frame.height}-{zlib.crc32(frame.buffer):08x}"
+
+
+def part_key(key, index):
+    """見開きを分けた左右のページ（index: 0=左, 1=右）のキー"""
+    if key is None:
+        return None
+    return f"{key}-{'LR'[index]}"
+
+
+def file_key(data, box=None):
+    """保存済みのページ画像ファイルの内容（バイト列）を表すキー"""
+    key = f"file-{len(data)}-{zlib.crc32(data):08x}"
+    if box:
+        key += "-" + "-".join(str(value) for value in box)
+    return key
+
+
+class PageStore:
+    """内容が同じページのエンコード結果を共有するストア（ワーカースレッドから使える）
+
+    最近のエンコード結果を max_bytes まで保持し、同じキーのページにはそれを返す。
+    同じキーのページを別のワーカーがエンコード中の場合は、その結果を待って再利用する。
+    キーごとのエンコード時間はすべて覚えておき、省略できた時間を集計する。
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._seconds = {}
+        # エンコード中のキー -> 完了を知らせるイベント
+        self._encoding = {}
+        self.reused = 0
+        self.saved_seconds = 0.0
+
+    def get(self, key):
+        """キーが一致するエンコード結果を返す
+
+        なければNoneを返し、呼び出し側がエンコードして put()（失敗した場合は release()）する。
+        """
+        with self._lock:
+            encoded = self._images.get(key)
+            if encoded is None:
+                event = self._encoding.get(key)
+                if event is None:
+                    self._encoding[key] = threading.Event()
+                    return None
+            else:
+                self._images.move_to_end(key)
+                self._count_reuse(key)
+                return encoded
+        # 別のワーカーのエンコードが終わるのを待つ
+        event.wait()
+        return self.get(key)
+
+    def release(self, key):
+        """get() がNoneを返したキーのエンコードを諦める（待っているワーカーが代わりにエンコードする）"""
+        with self._lock:
+            event = self._encoding.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def put(self, key, encoded, seconds):
+        """エンコード結果を記録（古いものから捨てて max_bytes 以内に収める）"""
+        with self._lock:
+            self._seconds.setdefault(key, seconds)
+            if key not in self._images:
+                self._images[key] = encoded
+                self._bytes += len(encoded.data)
+                while self._bytes > self.max_bytes and len(self._images) > 1:
+                    _, oldest = self._images.popitem(last=False)
+                    self._bytes -= len(oldest.data)
+        self.release(key)
+
+    def record(self, key, seconds):
+        """エンコード結果を保持せず、エンコード時間だけを記録"""
+        with self._lock:
+            self._seconds.setdefault(key, seconds)
+
+    def reuse(self, key):
+        """エンコード結果を保持していないキーを（PDF上で）再利用したことを記録"""
+        with self._lock:
+            self._count_reuse(key)
+
+    def _count_reuse(self, key):
+        self.reused += 1
+        self.saved_seconds += self._seconds.get(key, 0.0)
+
+    def report(self, shared_pages, shared_bytes, dropped_pages=0):
+        """重複ページの内訳（表示用の行のリスト、重複がなければ空）"""
+        if not (shared_pages or dropped_pages or self.reused):
+            return []
+        lines = [
+            f"画像を共有したページ: {shared_pages}ページ"
+            f"（{shared_bytes / (1024 * 1024):.2f} MB 削減）",
+            f"エンコードを省略: {self.reused}ページ（{self.saved_seconds:.2f} 秒）",
+        ]
+        if dropped_pages:
+            lines.append(f"削除した連続する重複ページ: {dropped_pages}ページ")
+        return lines
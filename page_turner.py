@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+ページ送りドライバー
+ページごとにosascriptを起動するとプロセス起動とAppleScriptのコンパイルに
+毎回数十ミリ秒かかるため、常駐するヘルパープロセスやプロセス内のキーイベント送信を使えるようにする。
+
+- helper:    osascript（JavaScript for Automation）を1つだけ起動し、パイプでコマンドを送る
+- quartz:    CGEventでKindleのプロセスに直接キーイベントを送る
+- osascript: 従来通りページごとにosascriptを起動する（フォールバック用）
+- stand-in:  macOSなしでベンチマークするための代替ドライバー
+
+ヘルパー・osascriptの応答は REPLY_TIMEOUT 秒まで待ち、応答がなければプロセスを止めて
+PageTurnerError にする（ヘルパーが止まってもキャプチャが止まったままにならない）。
+"""
+
+import queue
+import subprocess
+import sys
+import threading
+
+# 右矢印キー
+KEY_CODE_RIGHT = 124
+
+# ヘルパー・osascriptの応答を待つ最大秒数（アクティブ化は数秒かかることがある）
+REPLY_TIMEOUT = 10.0
+
+ACTIVATE_SCRIPT = '''
+tell application "Amazon Kindle"
+    activate
+end tell
+'''
+
+PAGE_TURN_SCRIPT = '''
+tell application "System Events"
+    tell process "Kindle"
+        key code 124
+    end tell
+end tell
+'''
+
+# 標準入力から1行ずつコマンドを受け取り、処理が終わるたびに "ok" を返すJXAスクリプト
+HELPER_SCRIPT = '''
+ObjC.import('Foundation');
+var systemEvents = Application('System Events');
+var stdin = $.NSFileHandle.fileHandleWithStandardInput;
+var stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+var buffer = '';
+function reply(text) {
+    stdout.writeData($(text + '\\n').dataUsingEncoding($.NSUTF8StringEncoding));
+}
+while (true) {
+    var data = stdin.availableData;
+    if (data.length == 0) break;
+    buffer += $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding).js;
+    var lines = buffer.split('\\n');
+    buffer = lines.pop();
+    for (var i = 0; i < lines.length; i++) {
+        try {
+            if (lines[i] == 'next') {
+                systemEvents.processes.byName('Kindle').keyCode(124);
+            } else if (lines[i] == 'activate') {
+                Application('Amazon Kindle').activate();
+            }
+            reply('ok');
+        } catch (e) {
+            reply('error ' + e);
+        }
+    }
+}
+'''
+
+# 代替ドライバー: ヘルパーと同じプロトコルで応答するだけのPythonスクリプト
+STAND_IN_SCRIPT = '''
+import sys
+for line in sys.stdin:
+    sys.stdout.write("ok\\n")
+    sys.stdout.flush()
+'''
+
+
+class PageTurnerError(RuntimeError):
+    """ページ送りドライバーが応答しない・エラーを返した"""
+
+
+class PageTurner:
+    """ページ送りドライバーの基底クラス"""
+
+    name = "base"
+    # create_page_turner がフォールバックした場合、指定したドライバーを使えなかった理由
+    fallback_reason = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def activate(self):
+        """Kindleアプリをアクティブ化"""
+        raise NotImplementedError
+
+    def next_page(self):
+        """次のページへ移動"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SubprocessPageTurner(PageTurner):
+    """コマンドごとに新しいプロセスを起動するドライバー（従来の方式）"""
+
+    name = "osascript"
+
+    def __init__(self, activate_command=None, next_command=None, timeout=REPLY_TIMEOUT):
+        self.activate_command = activate_command or ['osascript', '-e', ACTIVATE_SCRIPT]
+        self.next_command = next_command or ['osascript', '-e', PAGE_TURN_SCRIPT]
+        self.timeout = timeout
+
+    def _run(self, command):
+        try:
+            subprocess.run(command, check=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise PageTurnerError(f"osascriptが{self.timeout:g}秒以内に終了しません")
+        except subprocess.CalledProcessError as e:
+            raise PageTurnerError(f"osascriptでエラーが発生しました（終了コード {e.returncode}）")
+
+    def activate(self):
+        self._run(self.activate_command)
+
+    def next_page(self):
+        self._run(self.next_command)
+
+
+class PipePageTurner(PageTurner):
+    """常駐するヘルパープロセスにパイプでコマンドを送るドライバー"""
+
+    name = "helper"
+
+    def __init__(self, command=None, timeout=REPLY_TIMEOUT):
+        self.command = command or ['osascript', '-l', 'JavaScript', '-e', HELPER_SCRIPT]
+        self.timeout = timeout
+        self._proc = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        # 応答は別スレッドで読み、待つ時間に上限を設ける（終了したらNone）
+        self._replies = queue.Queue()
+        threading.Thread(target=self._read_replies, name="page-turner-reader",
+                         daemon=True).start()
+
+    def _read_replies(self):
+        for line in self._proc.stdout:
+            self._replies.put(line.strip())
+        self._replies.put(None)
+
+    def _send(self, command):
+        if self._proc.poll() is not None:
+            raise PageTurnerError("ページ送りヘルパーが終了しています")
+        try:
+            self._proc.stdin.write(command + "\n")
+            self._proc.stdin.flush()
+        except OSError as e:
+            raise PageTurnerError(f"ページ送りヘルパーにコマンドを送れません: {e}")
+        try:
+            reply = self._replies.get(timeout=self.timeout)
+        except queue.Empty:
+            # 止まったヘルパーは終了させ、以降のコマンドもエラーにする
+            self._proc.kill()
+            self._proc.wait()
+            raise PageTurnerError(f"ページ送りヘルパーが{self.timeout:g}秒以内に応答しません")
+        if reply != "ok":
+            raise PageTurnerError(f"ページ送りヘルパーでエラーが発生しました: {reply or '応答なし'}")
+
+    def activate(self):
+        self._send("activate")
+
+    def next_page(self):
+        self._send("next")
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            try:
+                self._proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+
+
+class QuartzPageTurner(PageTurner):
+    """CGEventでKindleのプロセスに直接キーイベントを送るドライバー"""
+
+    name = "quartz"
+
+    def __init__(self, pid=None):
+        self.pid = pid or find_kindle_pid()
+        if self.pid is None:
+            raise RuntimeError("Kindleのプロセスが見つかりません")
+
+    def activate(self):
+        from AppKit import (NSApplicationActivateIgnoringOtherApps,
+                            NSRunningApplication)
+
+        app = NSRunningApplication.runningApplicationWithProcessIdentifier_(self.pid)
+        if app is None:
+            raise RuntimeError("Kindleのプロセスが見つかりません")
+        app.activateWithOptions_(NSApplicationActivateIgnoringOtherApps)
+
+    def next_page(self):
+        from Quartz import CGEventCreateKeyboardEvent, CGEventPostToPid
+
+        for key_down in (True, False):
+            event = CGEventCreateKeyboardEvent(None, KEY_CODE_RIGHT, key_down)
+            CGEventPostToPid(self.pid, event)
+
+
+class StandInPageTurner(PipePageTurner):
+    """macOSなしでページ送りの遅延を計測するための代替ドライバー
+
+    persistent=True なら常駐プロセスにパイプでコマンドを送り、
+    False ならコマンドごとにプロセスを起動する（従来方式の比較用）。
+    on_next を渡すとページ送り時に呼び出す（シミュレーターとの連携用）。
+    """
+
+    name = "stand-in"
+
+    def __init__(self, persistent=True, on_next=None):
+        self.persistent = persistent
+        self.on_next = on_next
+        self._command = [sys.executable, '-c', STAND_IN_SCRIPT]
+        if persistent:
+            super().__init__(self._command)
+        else:
+            self._proc = None
+
+    def _send(self, command):
+        if self.persistent:
+            super()._send(command)
+        else:
+            subprocess.run(self._command, input=command + "\n", text=True,
+                           stdout=subprocess.DEVNULL, check=True, timeout=REPLY_TIMEOUT)
+
+    def next_page(self):
+        self._send("next")
+        if self.on_next:
+            self.on_next()
+
+    def close(self):
+        if self._proc is not None:
+            super().close()
+
+
+def find_kindle_pid():
+    """KindleアプリのプロセスIDを取得"""
+    import Quartz
+
+    window_list = Quartz.CGWindowListCopyWindowInfo(
+        Quartz.kCGWindowListOptionOnScreenOnly,
+        Quartz.kCGNullWindowID
+    )
+    for window in window_list:
+        if window.get('kCGWindowOwnerName', '') == 'Kindle':
+            return window.get('kCGWindowOwnerPID')
+    return None
+
+
+TURNERS = {
+    "helper": PipePageTurner,
+    "quartz": QuartzPageTurner,
+    "osascript": SubprocessPageTurner,
+}
+
+
+def create_page_turner(name="helper"):
+    """ページ送りドライバーを作成し、Kindleアプリをアクティブ化する
+
+    常駐型のドライバーが起動できない場合はosascriptにフォールバックし、
+    その理由を返すドライバーの fallback_reason に入れる（表示は呼び出し側で行う）。
+    """
+    reason = None
+    if name != "osascript":
+        turner = None
+        try:
+            turner = TURNERS[name]()
+            turner.activate()
+            return turner
+        except Exception as e:
+            if turner is not None:
+                turner.close()
+            reason = f"ページ送りドライバー {name} を使用できません（{e}）。osascriptを使用します。"
+
+    turner = SubprocessPageTurner()
+    turner.fallback_reason = reason
+    turner.activate()
+    return turner
+
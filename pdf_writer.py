@@ -0,0 +1,970 @@
+#!/usr/bin/env python3
+"""
+ストリーミングPDFライター
+ページを1枚ずつPDFオブジェクトとして書き出し、書き終えた画像はすぐに解放する。
+全ページをメモリに保持しないため、ページ数が増えてもピークメモリはほぼ一定。
+既存のPDFには増分更新（新しいオブジェクト・xref・trailerの追記）でページを追加でき、
+書き出し済みのページには触れない。
+内容が同じページ（キーが一致するページ）は、画像を1つだけ書き出して複数のページから参照する。
+エンコード済みの画像にサムネイルがあれば、ページの /Thumb として埋め込む。
+linearize=True の場合は、閉じるときにファイルを線形化（Fast Web View）する
+（最初のページとヒントテーブルを先頭に置き、ファイル全体を読まなくても最初のページを表示できる）。
+"""
+
+import io
+import os
+import re
+import time
+from pathlib import Path
+
+
+class PdfWriter:
+    """画像をページ単位でPDFへ書き出すライター
+
+    append=True の場合は既存のPDFを開き、増分更新としてページを追加する。
+    linearize=True の場合は、閉じるときにファイル全体を線形化したPDFに書き直す。
+    """
+
+    def __init__(self, path, resolution=100.0, append=False, linearize=False):
+        self.path = str(path)
+        self.resolution = resolution
+        self.linearize = linearize
+        self._offsets = {}
+        self._closed = False
+        self._prev_xref = None
+        # キー -> (画像のID, 内容のID, サムネイルのID, ページの幅, 高さ, 画像のバイト数)
+        self._shared = {}
+        self.shared_pages = 0
+        self.shared_bytes = 0
+
+        if append:
+            self._open_append()
+            return
+
+        self._fp = open(self.path, 'wb')
+        self._page_ids = []
+        self._root_id = 1
+        self._pages_id = 2
+        # 1: Catalog, 2: Pages（Pagesは最後に書き出す）
+        self._next_id = 3
+        self._base_length = 0
+
+        self._fp.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+    def _open_append(self):
+        """既存のPDFのxrefとページツリーを読み込み、末尾に追記できるようにする"""
+        self._fp = open(self.path, 'r+b')
+        try:
+            xref_offset, end = _find_startxref(self._fp)
+            # 最後の %%EOF より後ろ（書きかけの増分更新など）は捨てる
+            self._fp.truncate(end)
+            offsets, trailer = _read_xref_chain(self._fp, xref_offset)
+            self._root_id = _ref(trailer, b'Root')
+            self._next_id = int(_value(trailer, b'Size'))
+            catalog = _read_object(self._fp, offsets[self._root_id])
+            self._pages_id = _ref(catalog, b'Pages')
+            pages = _read_object(self._fp, offsets[self._pages_id])
+            kids = re.search(rb'/Kids\s*\[([^\]]*)\]', pages)
+            if kids is None:
+                raise ValueError("ページツリーを読み込めません")
+            self._page_ids = [int(obj_id) for obj_id in re.findall(rb'(\d+)\s+0\s+R', kids.group(1))]
+        except (KeyError, ValueError) as e:
+            self._fp.close()
+            raise ValueError(f"{self.path} には追記できません: {e}")
+        self._prev_xref = xref_offset
+        self._fp.seek(0, os.SEEK_END)
+        self._base_length = self._fp.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    @property
+    def page_count(self):
+        return len(self._page_ids)
+
+    def _alloc_id(self):
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id, body):
+        self._offsets[obj_id] = self._fp.tell()
+        self._fp.write(b'%d 0 obj\n' % obj_id)
+        self._fp.write(body)
+        self._fp.write(b'\nendobj\n')
+
+    def _write_stream(self, obj_id, dictionary, data):
+        self._offsets[obj_id] = self._fp.tell()
+        self._fp.write(b'%d 0 obj\n' % obj_id)
+        self._fp.write(b'<< %s /Length %d >>\nstream\n' % (dictionary, len(data)))
+        self._fp.write(data)
+        self._fp.write(b'\nendstream\nendobj\n')
+
+    def add_image(self, img):
+        """PIL画像を1ページとして書き出す"""
+        encoded = encode_image(img)
+        self.add_encoded_page(encoded)
+
+    def has_image(self, key):
+        """キーが一致する画像を書き出し済みか"""
+        return key in self._shared
+
+    def add_shared_page(self, key):
+        """書き出し済みの画像（キーで指定）を参照するページを追加"""
+        if self._closed:
+            raise RuntimeError("PDFは既に閉じられています")
+        image_id, content_id, thumb_id, page_width, page_height, length = self._shared[key]
+        self._write_page(image_id, content_id, page_width, page_height, thumb_id)
+        self.shared_pages += 1
+        self.shared_bytes += length
+
+    def add_encoded_page(self, encoded, key=None):
+        """エンコード済みの画像データを1ページとして書き出す
+
+        key を指定した場合、同じキーの画像を書き出し済みなら画像は書かずにそれを参照する。
+        """
+        if key is not None and key in self._shared:
+            self.add_shared_page(key)
+            return
+        if self._closed:
+            raise RuntimeError("PDFは既に閉じられています")
+        if encoded.filter == 'WebP':
+            raise ValueError("WebPのページはPDFに埋め込めません（--format webp で書き出してください）")
+
+        image_id = self._alloc_id()
+        content_id = self._alloc_id()
+        self._write_stream(image_id, _image_dictionary(encoded), encoded.data)
+        thumb_id = None
+        if encoded.thumb is not None:
+            thumb_id = self._alloc_id()
+            self._write_stream(thumb_id, _image_dictionary(encoded.thumb), encoded.thumb.data)
+
+        width, height = encoded.size
+
+        # 画像をページ全体に描画（縮小した画像は解像度を上げて元の大きさで表示する）
+        resolution = self.resolution * encoded.scale
+        page_width = width * 72.0 / resolution
+        page_height = height * 72.0 / resolution
+        content = b'q %s 0 0 %s 0 0 cm /Im0 Do Q' % (
+            _format_number(page_width), _format_number(page_height))
+        self._write_stream(content_id, b'', content)
+        if key is not None:
+            self._shared[key] = (image_id, content_id, thumb_id, page_width, page_height,
+                                 len(encoded.data))
+        self._write_page(image_id, content_id, page_width, page_height, thumb_id)
+
+    def _write_page(self, image_id, content_id, page_width, page_height, thumb_id=None):
+        page_id = self._alloc_id()
+        thumb = b' /Thumb %d 0 R' % thumb_id if thumb_id is not None else b''
+        self._write_object(page_id, (
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] '
+            b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R%s >>'
+            % (self._pages_id, _format_number(page_width), _format_number(page_height),
+               image_id, content_id, thumb)
+        ))
+        self._page_ids.append(page_id)
+        self._fp.flush()
+
+    def abort(self):
+        """書きかけのファイルを閉じて削除（追記の場合は追記前の状態に戻す）"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._prev_xref is not None:
+            self._fp.truncate(self._base_length)
+            self._fp.close()
+            return
+        self._fp.close()
+        os.remove(self.path)
+
+    def close(self):
+        """ページツリー・xref・trailerを書き出してファイルを閉じる"""
+        if self._closed:
+            return
+        self._closed = True
+
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in self._page_ids)
+        self._write_object(self._pages_id, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            kids, len(self._page_ids)))
+
+        xref_offset = self._fp.tell()
+        size = self._next_id
+        if self._prev_xref is None:
+            self._fp.write(b'xref\n0 %d\n' % size)
+            self._fp.write(b'0000000000 65535 f \n')
+            for obj_id in range(1, size):
+                offset = self._offsets.get(obj_id)
+                if offset is None:
+                    self._fp.write(b'0000000000 65535 f \n')
+                else:
+                    self._fp.write(b'%010d 00000 n \n' % offset)
+            self._fp.write(b'trailer\n<< /Size %d /Root %d 0 R >>\n' % (size, self._root_id))
+        else:
+            # 増分更新: 今回書き出したオブジェクトだけを連続する番号ごとにまとめて書く
+            # （多くのリーダーに合わせ、先頭には0番の空きエントリを置く）
+            self._fp.write(b'xref\n0 1\n0000000000 65535 f \n')
+            for start, offsets in _subsections(self._offsets):
+                self._fp.write(b'%d %d\n' % (start, len(offsets)))
+                for offset in offsets:
+                    self._fp.write(b'%010d 00000 n \n' % offset)
+            self._fp.write(b'trailer\n<< /Size %d /Root %d 0 R /Prev %d >>\n' % (
+                size, self._root_id, self._prev_xref))
+        self._fp.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+        self._fp.close()
+        if self.linearize and self._page_ids:
+            linearize_pdf(self.path)
+
+
+class EncodedImage:
+    """PDFに埋め込むエンコード済み画像ストリーム
+
+    scale は元の画像に対する縮小率（縮小してもPDFのページの大きさは変えない）。
+    thumb はページのサムネイル（EncodedImage、なければNone）。
+    """
+
+    __slots__ = ('size', 'colorspace', 'bits', 'filter', 'data', 'decode_parms', 'scale',
+                 'thumb')
+
+    def __init__(self, size, colorspace, bits, filter, data, decode_parms=None, scale=1.0,
+                 thumb=None):
+        self.size = size
+        self.colorspace = colorspace
+        self.bits = bits
+        self.filter = filter
+        self.data = data
+        self.decode_parms = decode_parms
+        self.scale = scale
+        self.thumb = thumb
+
+
+def _image_dictionary(encoded):
+    """画像XObjectのストリーム辞書（/Length を除く）"""
+    width, height = encoded.size
+    dictionary = (
+        b'/Type /XObject /Subtype /Image /Width %d /Height %d '
+        b'/ColorSpace /%s /BitsPerComponent %d /Filter /%s'
+        % (width, height, encoded.colorspace.encode(), encoded.bits, encoded.filter.encode())
+    )
+    if encoded.decode_parms:
+        dictionary += b' /DecodeParms ' + encoded.decode_parms
+    return dictionary
+
+
+def flatten_image(img):
+    """RGBAをRGBに変換（PNGの透過対応）"""
+    from PIL import Image
+
+    if img.mode == 'RGBA':
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[3])
+        return rgb_img
+    return img.convert('RGB')
+
+
+def encode_image(img, quality=75):
+    """PIL画像をPDF用ストリームにエンコード（PillowのPDF保存と同じくJPEG）"""
+    img = flatten_image(img)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=quality)
+    return EncodedImage(img.size, 'DeviceRGB', 8, 'DCTDecode', buf.getvalue())
+
+
+def add_image_files(writer, image_files, progress=None, box=None, encoder=None, jobs=1,
+                    store=None, classifier=None, cache=None, on_warning=None):
+    """画像ファイルを1枚ずつ読み込んでPDFに追加（box を指定した場合は切り抜く）
+
+    encoder（page_encoder.PageEncoder）を指定した場合はそのエンコード方式を使う。
+    jobs が2以上の場合は複数のプロセスでエンコードし、ページ順に書き出す。
+    store（page_store.PageStore）を指定した場合、内容が同じファイルはエンコードせずに
+    書き出し済みの画像を参照する。
+    classifier（page_classifier.PageClassifier）を指定した場合、白紙のページは書き出さず、
+    見開きは左右の2ページに分けて書き出す。
+    cache（stream_cache.StreamCache）を指定した場合、同じ画像を同じ設定でエンコードした
+    ストリームがあればそれを使い、エンコードしたストリームはキャッシュに追加する。
+    image_files にはスプールのページ（frame_spool.SpoolPage）も指定できる。
+    encoder の mode が 'png' の場合、PNGファイルはデコードせずにIDATをそのまま埋め込む。
+    box が収まらない小さいページは切り抜かずに書き出し、on_warning（省略時は表示しない）に知らせる。
+    """
+    from PIL import Image
+
+    from frame_spool import SpoolPage, source_key
+    from page_encoder import PageEncoder
+    from page_store import file_key
+    from trim import crop_to_box, uncropped_warning
+
+    if box and on_warning is not None:
+        warning = uncropped_warning(image_files, box)
+        if warning:
+            on_warning(warning)
+
+    # PDFのページごとの (ファイル, 切り抜く範囲)
+    if classifier is not None:
+        items = classifier.split_files(image_files, box)
+    else:
+        items = [(path, box) for path in image_files]
+    total = len(items)
+    if jobs > 1 or cache is not None:
+        encoder = encoder or PageEncoder()
+    if jobs > 1:
+        from encode_pool import encode_files
+
+        keys = [None] * total
+        cache_keys = [None] * total
+        unique_items = items
+        if store is not None or cache is not None:
+            # 内容が同じファイルは最初の1枚だけを、キャッシュにないファイルだけをエンコードする
+            sources = [source_key(path, part) for path, part in items]
+            if store is not None:
+                keys = sources
+            if cache is not None:
+                cache_keys = [cache.key(source, encoder) for source in sources]
+            seen = set()
+            unique_items = []
+            for item, key, cache_key in zip(items, keys, cache_keys):
+                if key is not None and (key in seen or writer.has_image(key)):
+                    continue
+                seen.add(key)
+                if cache_key is None or cache_key not in cache:
+                    unique_items.append(item)
+        results = encode_files([path for path, _ in unique_items], jobs, box, encoder.mode,
+                               encoder.quality, max_width=encoder.max_width, dpi=encoder.dpi,
+                               boxes=[part for _, part in unique_items],
+                               thumbnails=encoder.thumbnails, webp=encoder.webp)
+        for index, (key, cache_key) in enumerate(zip(keys, cache_keys), 1):
+            if key is not None and writer.has_image(key):
+                writer.add_shared_page(key)
+                store.reuse(key)
+            else:
+                encoded = cache.get(cache_key) if cache_key is not None else None
+                if encoded is None:
+                    encoded, page_class, seconds = next(results)
+                    encoder.record(page_class, len(encoded.data), seconds)
+                    if key is not None:
+                        store.record(key, seconds)
+                    if cache_key is not None:
+                        cache.put(cache_key, encoded, seconds)
+                writer.add_encoded_page(encoded, key)
+            if progress:
+                progress(index, total)
+        return
+
+    for index, (img_path, part) in enumerate(items, 1):
+        if isinstance(img_path, SpoolPage):
+            data = None
+            source = img_path.key(part)
+        else:
+            data = Path(img_path).read_bytes()
+            source = file_key(data, part) if store is not None or cache is not None else None
+        key = source if store is not None else None
+        cache_key = cache.key(source, encoder) if cache is not None else None
+        if key is not None and writer.has_image(key):
+            writer.add_shared_page(key)
+            store.reuse(key)
+        else:
+            encoded = cache.get(cache_key) if cache_key is not None else None
+            if encoded is None and data is not None and encoder is not None:
+                # 可逆圧縮（mode='png'）ではPNGのIDATをデコードせずに使う
+                start = time.perf_counter()
+                encoded = encoder.passthrough(data, part)
+                if encoded is not None and key is not None:
+                    store.record(key, time.perf_counter() - start)
+            if encoded is None:
+                start = time.perf_counter()
+                with (img_path.open() if data is None else Image.open(io.BytesIO(data))) as img:
+                    img = crop_to_box(img, part)
+                    encoded = encode_image(img) if encoder is None else encoder.encode(img)
+                seconds = time.perf_counter() - start
+                if key is not None:
+                    store.record(key, seconds)
+                if cache_key is not None:
+                    cache.put(cache_key, encoded, seconds)
+            writer.add_encoded_page(encoded, key)
+        if progress:
+            progress(index, total)
+
+
+def write_pdf(image_files, output_path, resolution=100.0, progress=None, trim=False,
+              encoder=None, jobs=1, store=None, classifier=None):
+    """画像ファイルを1枚ずつ読み込んでPDFに書き出す
+
+    trim=True の場合は、全ページ共通の切り抜き範囲で余白とウィンドウ枠を取り除く。
+    """
+    box = None
+    if trim:
+        from trim import trim_box_for_images
+        box = trim_box_for_images(image_files)
+    with PdfWriter(output_path, resolution=resolution) as writer:
+        add_image_files(writer, image_files, progress, box, encoder, jobs, store, classifier)
+
+
+def linearize_pdf(path, output_path=None):
+    """PdfWriterで書き出したPDFを線形化（Fast Web View）したPDFに書き直す
+
+    最初のページのオブジェクトとヒントテーブル（PDF仕様の付属書F）をファイルの先頭に置き、
+    残りのページはページごとにまとめて並べる。増分更新で追加したページも1つのxrefにまとめ、
+    参照されなくなったオブジェクトは捨てる。ストリームは元のファイルから少しずつコピーするため、
+    ファイルが大きくてもメモリ使用量はほぼ一定。output_path を省略した場合は path を置き換える。
+    """
+    path = str(path)
+    output_path = str(output_path or path)
+    temp_path = output_path + '.linearizing'
+    with open(path, 'rb') as src:
+        layout = _LinearLayout(src, _document_id(path))
+        try:
+            with open(temp_path, 'wb') as out:
+                layout.write(src, out)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, output_path)
+
+
+# 線形化辞書と先頭のtrailerの数値を書き込む幅（後から値を埋めるため、空白で詰めて大きさを固定する）
+_NUMBER_PLACEHOLDER = 9999999999
+
+_COPY_CHUNK = 1024 * 1024
+
+
+class _LinearLayout:
+    """線形化したPDFのオブジェクトの並びと位置を求め、書き出す
+
+    ファイルの並び: ヘッダー / 線形化辞書 / 最初のページのxref・trailer / Catalog / ヒントストリーム /
+    最初のページ / 残りのページ / 複数のページから参照する画像 / サムネイル / ページツリー /
+    残りのxref・trailer
+    最初のページの部分のオブジェクトには、残りより大きい番号を振る（仕様の付属書Fの形）。
+    ページから参照するオブジェクトは付属書F（とqpdf）と同じく /Parent と /Thumb をたどらずに求め、
+    サムネイルはページの部分に含めない（ページのオブジェクト数・大きさ・/E にも数えない）。
+    """
+
+    def __init__(self, src, document_id):
+        self.document_id = document_id
+        xref_offset, _ = _find_startxref(src)
+        offsets, trailer = _read_xref_chain(src, xref_offset)
+        self._objects = {}
+        self._offsets = offsets
+
+        root_id = _ref(trailer, b'Root')
+        catalog = self._load(src, root_id)[0]
+        pages_id = _ref(catalog, b'Pages')
+        kids = re.search(rb'/Kids\s*\[([^\]]*)\]', self._load(src, pages_id)[0])
+        if kids is None:
+            raise ValueError("ページツリーを読み込めません")
+        page_ids = [int(obj_id) for obj_id in re.findall(rb'(\d+)\s+0\s+R', kids.group(1))]
+        if not page_ids:
+            raise ValueError("ページがありません")
+        tree = {root_id, pages_id, *page_ids}
+
+        # ページごとの (ページから参照するオブジェクト, 内容ストリーム) とサムネイル
+        resources = []
+        thumbs = []
+        references = {}
+        for page_id in page_ids:
+            page = self._load(src, page_id)[0]
+            if not re.search(rb'/Type\s*/Page\b(?!s)', page):
+                raise ValueError("入れ子のページツリーには対応していません")
+            contents = re.search(rb'/Contents\s+(\d+)\s+\d+\s+R', page)
+            thumb = re.search(rb'/Thumb\s+(\d+)\s+\d+\s+R', page)
+            if thumb:
+                thumbs.append(int(thumb.group(1)))
+            used = self._collect(
+                src, _references(re.sub(rb'/(?:Parent|Thumb)\s+\d+\s+\d+\s+R', b'', page)), tree)
+            resources.append((used, int(contents.group(1)) if contents else None))
+            for obj_id in used:
+                references[obj_id] = references.get(obj_id, 0) + 1
+
+        # 最初のページの部分（複数のページから参照するものも含む）
+        first = [page_ids[0]] + resources[0][0]
+        placed = set(first)
+        # 残りのページの部分（そのページだけが参照するオブジェクト）
+        sections = []
+        for page_id, (used, _) in zip(page_ids[1:], resources[1:]):
+            sections.append([page_id] + [obj_id for obj_id in used if references[obj_id] == 1])
+        shared = []
+        for used, _ in resources[1:]:
+            for obj_id in used:
+                if references[obj_id] > 1 and obj_id not in placed:
+                    placed.add(obj_id)
+                    shared.append(obj_id)
+        placed.update(obj_id for section in sections for obj_id in section)
+        # サムネイル（付属書Fのパート9、内容が同じページのものは1つ）
+        thumbnails = self._collect(src, thumbs, tree | placed)
+        placed.update(thumbnails)
+        # ページに属さないオブジェクト（ページツリーとCatalogから参照するもの）
+        others = [pages_id] + self._collect(
+            src, [obj_id for obj_id in _references(catalog) if obj_id != pages_id], tree | placed)
+
+        # 番号の振り直し（最初のページの部分は線形化辞書・Catalog・ヒントストリームの後）
+        main = ([obj_id for section in sections for obj_id in section] + shared + thumbnails +
+                others)
+        self.main_count = len(main) + 1
+        self.linear_id = self.main_count
+        self.root_id = self.linear_id + 1
+        self.hint_id = self.linear_id + 2
+        numbers = {obj_id: index for index, obj_id in enumerate(main, 1)}
+        numbers[root_id] = self.root_id
+        for index, obj_id in enumerate(first):
+            numbers[obj_id] = self.hint_id + 1 + index
+        self.first_count = 3 + len(first)
+        self.page_count = len(page_ids)
+        self.first_page_id = numbers[page_ids[0]]
+
+        # 書き出すオブジェクトの (新しい番号, 書き直した辞書, ストリームの位置, 終わり)
+        sizes = {}
+
+        def entry(obj_id):
+            dictionary, data_start, data_end = self._objects[obj_id]
+            item = (numbers[obj_id], _renumber(dictionary, numbers), data_start, data_end)
+            sizes[obj_id] = _object_size(item)
+            return item
+
+        self.catalog = entry(root_id)
+        self.first = [entry(obj_id) for obj_id in first]
+        self.sections = [[entry(obj_id) for obj_id in section] for section in sections]
+        self.shared = [entry(obj_id) for obj_id in shared]
+        self.thumbnails = [entry(obj_id) for obj_id in thumbnails]
+        self.others = [entry(obj_id) for obj_id in others]
+        self._objects = None
+
+        # ページごとの (オブジェクト数, 大きさ, 内容ストリームの位置と大きさ, 参照する共有オブジェクト)
+        # 共有オブジェクトの番号は、最初のページの部分のオブジェクト、共有オブジェクトの部分の順に数える
+        shared_index = {obj_id: index for index, obj_id in enumerate(first + shared)}
+        self.page_hints = []
+        for index, (objects, (used, contents)) in enumerate(zip([first] + sections, resources)):
+            position = content_offset = content_length = 0
+            for obj_id in objects:
+                if obj_id == contents:
+                    content_offset, content_length = position, sizes[obj_id]
+                position += sizes[obj_id]
+            shared_refs = [] if index == 0 else [
+                shared_index[obj_id] for obj_id in used if references[obj_id] > 1]
+            self.page_hints.append((len(objects), position, content_offset, content_length,
+                                    shared_refs))
+        self.shared_lengths = [sizes[obj_id] for obj_id in first + shared]
+
+    def _load(self, src, obj_id):
+        item = self._objects.get(obj_id)
+        if item is None:
+            offset = self._offsets.get(obj_id)
+            if offset is None:
+                raise ValueError(f"オブジェクト {obj_id} がありません")
+            item = self._objects[obj_id] = _read_indirect(src, offset)
+        return item
+
+    def _collect(self, src, obj_ids, exclude):
+        """obj_ids とそこから参照するオブジェクトを、最初に現れた順に返す（exclude は除く）"""
+        found = []
+        seen = set(exclude)
+        stack = list(reversed(obj_ids))
+        while stack:
+            obj_id = stack.pop()
+            if obj_id in seen:
+                continue
+            seen.add(obj_id)
+            found.append(obj_id)
+            dictionary = self._load(src, obj_id)[0]
+            stack.extend(reversed(_references(dictionary)))
+        return found
+
+    def _hint_stream(self, first_page_offset, shared_id, shared_offset):
+        """ヒントストリームのデータと、共有オブジェクトのヒントテーブルの位置"""
+        bits = _BitWriter()
+        _write_page_offset_hints(bits, self.page_hints, first_page_offset)
+        shared_table = len(bits.data)
+        _write_shared_object_hints(bits, self.shared_lengths, len(self.first), shared_id,
+                                   shared_offset)
+        return bytes(bits.data), shared_table
+
+    def write(self, src, out):
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        linear_size = len(self._linear_dictionary(*[_NUMBER_PLACEHOLDER] * 5))
+        first_xref_size = (len(b'xref\n%d %d\n' % (self.linear_id, self.first_count)) +
+                           20 * self.first_count)
+        first_trailer_size = len(self._first_trailer(_NUMBER_PLACEHOLDER))
+        hint_data, shared_table = self._hint_stream(0, 0, 0)
+
+        # 各オブジェクトの位置（ヒントストリームの大きさは位置によらない）
+        offsets = {}
+        position = len(header)
+        offsets[self.linear_id] = position
+        position += linear_size
+        first_xref = position
+        position += first_xref_size + first_trailer_size
+        offsets[self.root_id] = position
+        position += _object_size(self.catalog)
+        hint_offset = position
+        hint_object = self._hint_object(hint_data, shared_table)
+        offsets[self.hint_id] = hint_offset
+        position += len(hint_object)
+        for item in self.first:
+            offsets[item[0]] = position
+            position += _object_size(item)
+        first_end = position
+        shared_offset = None
+        for group in (*self.sections, self.shared, self.thumbnails, self.others):
+            if group is self.shared and group:
+                shared_offset = position
+            for item in group:
+                offsets[item[0]] = position
+                position += _object_size(item)
+        main_xref = position
+        main_xref_head = b'xref\n0 %d\n' % self.main_count
+        length = main_xref + len(main_xref_head) + 20 * self.main_count + len(
+            self._main_trailer(first_xref))
+
+        def hint_position(offset):
+            # ヒントテーブルに書く位置は、ヒントストリームがないものとして数える（付属書F.3）
+            return offset - len(hint_object) if offset > hint_offset else offset
+
+        hint_data, shared_table = self._hint_stream(
+            hint_position(offsets[self.first_page_id]),
+            self.shared[0][0] if self.shared else 0,
+            hint_position(shared_offset) if shared_offset is not None else 0)
+        hint_object = self._hint_object(hint_data, shared_table)
+
+        out.write(header)
+        if length >= 1 << 32:
+            raise ValueError("4GB以上のPDFは線形化できません")
+        out.write(self._linear_dictionary(length, hint_offset, len(hint_object), first_end,
+                                          main_xref + len(main_xref_head) - 1, linear_size))
+        out.write(b'xref\n%d %d\n' % (self.linear_id, self.first_count))
+        for obj_id in range(self.linear_id, self.linear_id + self.first_count):
+            out.write(b'%010d 00000 n \n' % offsets[obj_id])
+        out.write(self._first_trailer(main_xref, first_trailer_size))
+        _copy_object(src, out, self.catalog)
+        out.write(hint_object)
+        for group in (self.first, *self.sections, self.shared, self.thumbnails, self.others):
+            for item in group:
+                _copy_object(src, out, item)
+        out.write(main_xref_head)
+        out.write(b'0000000000 65535 f \n')
+        for obj_id in range(1, self.main_count):
+            out.write(b'%010d 00000 n \n' % offsets[obj_id])
+        out.write(self._main_trailer(first_xref))
+        if out.tell() != length:
+            raise RuntimeError("線形化したPDFの大きさが計算と一致しません")
+
+    def _linear_dictionary(self, length, hint_offset, hint_length, first_end, main_xref,
+                           size=None):
+        """線形化辞書のオブジェクト（size を指定した場合は、辞書の後ろを空白で詰めてその大きさにする）"""
+        body = b'<< /Linearized 1 /L %d /H [%d %d] /O %d /E %d /N %d /T %d >>' % (
+            length, hint_offset, hint_length, self.first_page_id, first_end, self.page_count,
+            main_xref)
+        head = b'%d 0 obj\n' % self.linear_id
+        if size is not None:
+            body = body.ljust(size - len(head) - len(b'\nendobj\n'))
+        return head + body + b'\nendobj\n'
+
+    def _first_trailer(self, main_xref, size=None):
+        """最初のページのxrefのtrailer（/Prev で残りのxrefを指す、size まで空白で詰める）"""
+        dictionary = b'<< /Size %d /Root %d 0 R /Prev %d /ID [<%s><%s>] >>' % (
+            self.main_count + self.first_count, self.root_id, main_xref, self.document_id,
+            self.document_id)
+        tail = b'\nstartxref\n0\n%%EOF\n'
+        if size is not None:
+            dictionary = dictionary.ljust(size - len(b'trailer\n') - len(tail))
+        return b'trailer\n' + dictionary + tail
+
+    def _main_trailer(self, first_xref):
+        return b'trailer\n<< /Size %d >>\nstartxref\n%d\n%%%%EOF\n' % (self.main_count, first_xref)
+
+    def _hint_object(self, data, shared_table):
+        return (b'%d 0 obj\n<< /S %d /Length %d >>\nstream\n' % (self.hint_id, shared_table,
+                                                               len(data)) +
+                data + b'\nendstream\nendobj\n')
+
+
+class _BitWriter:
+    """ヒントテーブル用に、値を上位ビットから順に詰めて書く"""
+
+    __slots__ = ('data', '_value', '_bits')
+
+    def __init__(self):
+        self.data = bytearray()
+        self._value = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        if bits == 0:
+            return
+        self._value = (self._value << bits) | value
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self.data.append((self._value >> self._bits) & 0xff)
+        self._value &= (1 << self._bits) - 1
+
+    def flush(self):
+        """次の値をバイト境界から書く"""
+        if self._bits:
+            self.data.append((self._value << (8 - self._bits)) & 0xff)
+            self._value = self._bits = 0
+
+
+def _bit_width(values, least=0):
+    return max((value - least for value in values), default=0).bit_length()
+
+
+def _write_page_offset_hints(bits, pages, first_page_offset):
+    """ページオフセットのヒントテーブル（付属書F.4.1）"""
+    counts = [page[0] for page in pages]
+    lengths = [page[1] for page in pages]
+    content_offsets = [page[2] for page in pages]
+    content_lengths = [page[3] for page in pages]
+    shared = [page[4] for page in pages]
+    shared_ids = [obj for refs in shared for obj in refs]
+
+    bits.write(min(counts), 32)
+    bits.write(first_page_offset, 32)
+    bits.write(_bit_width(counts, min(counts)), 16)
+    bits.write(min(lengths), 32)
+    bits.write(_bit_width(lengths, min(lengths)), 16)
+    bits.write(min(content_offsets), 32)
+    bits.write(_bit_width(content_offsets, min(content_offsets)), 16)
+    bits.write(min(content_lengths), 32)
+    bits.write(_bit_width(content_lengths, min(content_lengths)), 16)
+    bits.write(_bit_width(len(refs) for refs in shared), 16)
+    bits.write(_bit_width(shared_ids), 16)
+    # 共有オブジェクトの参照位置（分子）は使わない
+    bits.write(0, 16)
+    bits.write(1, 16)
+
+    for values, least in ((counts, min(counts)), (lengths, min(lengths))):
+        width = _bit_width(values, least)
+        for value in values:
+            bits.write(value - least, width)
+        bits.flush()
+    width = _bit_width(len(refs) for refs in shared)
+    for refs in shared:
+        bits.write(len(refs), width)
+    bits.flush()
+    width = _bit_width(shared_ids)
+    for refs in shared:
+        for obj in refs:
+            bits.write(obj, width)
+    bits.flush()
+    for values in (content_offsets, content_lengths):
+        least = min(values)
+        width = _bit_width(values, least)
+        for value in values:
+            bits.write(value - least, width)
+        bits.flush()
+
+
+def _write_shared_object_hints(bits, lengths, first_count, shared_id, shared_offset):
+    """共有オブジェクトのヒントテーブル（付属書F.4.2、1オブジェクトを1グループとする）"""
+    least = min(lengths)
+    width = _bit_width(lengths, least)
+    bits.write(shared_id, 32)
+    bits.write(shared_offset, 32)
+    bits.write(first_count, 32)
+    bits.write(len(lengths), 32)
+    bits.write(0, 16)
+    bits.write(least, 32)
+    bits.write(width, 16)
+    for length in lengths:
+        bits.write(length - least, width)
+    bits.flush()
+    # 署名はなし（1ビットずつ）
+    for _ in lengths:
+        bits.write(0, 1)
+    bits.flush()
+
+
+def _document_id(path):
+    """trailerの /ID（パス・大きさ・更新時刻のMD5、16進）"""
+    import hashlib
+
+    stat = os.stat(path)
+    return hashlib.md5(b'%s %d %d' % (os.path.abspath(path).encode('utf-8', 'surrogateescape'),
+                                      stat.st_size, stat.st_mtime_ns)).hexdigest().encode()
+
+
+def _read_indirect(fp, offset):
+    """間接オブジェクトを (辞書, ストリームの先頭, ストリームの終わり) で返す（ストリームがなければNone）"""
+    fp.seek(offset)
+    data = b''
+    while b'endobj' not in data and b'stream' not in data:
+        block = fp.read(65536)
+        if not block:
+            break
+        data += block
+    data += fp.read(64)
+    header = re.match(rb'\s*\d+\s+\d+\s+obj\s*', data)
+    if header is None or not data.startswith(b'<<', header.end()):
+        raise ValueError("辞書ではないオブジェクトには対応していません")
+    dictionary = _read_dictionary(data[header.end():])
+    end = header.end() + len(dictionary)
+    stream = re.match(rb'\s*stream\r?\n', data[end:end + 64])
+    if stream is None:
+        return dictionary, None, None
+    data_start = offset + end + stream.end()
+    return dictionary, data_start, data_start + int(_value(dictionary, b'Length'))
+
+
+def _references(dictionary):
+    """辞書の中の間接参照の番号（現れた順）"""
+    return [int(obj_id) for obj_id in re.findall(rb'(?<![\w.])(\d+)\s+\d+\s+R\b', dictionary)]
+
+
+def _renumber(dictionary, numbers):
+    """辞書の中の間接参照を新しい番号に書き換える"""
+    def replace(match):
+        obj_id = int(match.group(1))
+        if obj_id not in numbers:
+            raise ValueError(f"オブジェクト {obj_id} がありません")
+        return b'%d 0 R' % numbers[obj_id]
+    return re.sub(rb'(?<![\w.])(\d+)\s+\d+\s+R\b', replace, dictionary)
+
+
+def _object_size(item):
+    obj_id, body, data_start, data_end = item
+    size = len(b'%d 0 obj\n' % obj_id) + len(body) + len(b'\nendobj\n')
+    if data_start is not None:
+        size += len(b'\nstream\n') + data_end - data_start + len(b'\nendstream')
+    return size
+
+
+def _copy_object(src, out, item):
+    """オブジェクトを新しい番号で書き出す（ストリームは元のファイルから少しずつコピー）"""
+    obj_id, body, data_start, data_end = item
+    out.write(b'%d 0 obj\n' % obj_id)
+    out.write(body)
+    if data_start is not None:
+        out.write(b'\nstream\n')
+        src.seek(data_start)
+        remaining = data_end - data_start
+        while remaining > 0:
+            block = src.read(min(remaining, _COPY_CHUNK))
+            if not block:
+                raise ValueError("ストリームが途中で終わっています")
+            out.write(block)
+            remaining -= len(block)
+        out.write(b'\nendstream')
+    out.write(b'\nendobj\n')
+
+
+def _find_startxref(fp):
+    """ファイル末尾から最後の startxref を探し、(xrefの位置, %%EOF行の終わり) を返す"""
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    chunk = 4096
+    while True:
+        start = max(size - chunk, 0)
+        fp.seek(start)
+        data = fp.read(size - start)
+        match = None
+        for match in re.finditer(rb'startxref\s+(\d+)\s+%%EOF[ \t]*(\r\n|\r|\n)?', data):
+            pass
+        if match is not None:
+            return int(match.group(1)), start + match.end()
+        if start == 0:
+            raise ValueError("startxref が見つかりません")
+        chunk *= 4
+
+
+def _read_xref_chain(fp, xref_offset):
+    """xrefテーブルを /Prev をたどって読み込み、(オブジェクト番号→位置, 最新のtrailer) を返す"""
+    offsets = {}
+    latest_trailer = None
+    while xref_offset is not None:
+        fp.seek(xref_offset)
+        data = fp.read(64)
+        if not data.startswith(b'xref'):
+            raise ValueError("xrefストリーム形式のPDFには対応していません")
+        fp.seek(xref_offset)
+        section = b''
+        while b'trailer' not in section:
+            block = fp.read(65536)
+            if not block:
+                raise ValueError("trailer が見つかりません")
+            section += block
+        table, _, rest = section.partition(b'trailer')
+        trailer = _read_dictionary(rest)
+
+        tokens = table.split()[1:]
+        index = 0
+        while index < len(tokens):
+            start, count = int(tokens[index]), int(tokens[index + 1])
+            index += 2
+            for obj_id in range(start, start + count):
+                offset, _, kind = tokens[index:index + 3]
+                index += 3
+                # 新しいxrefの内容を優先する
+                if kind == b'n' and obj_id not in offsets:
+                    offsets[obj_id] = int(offset)
+
+        if latest_trailer is None:
+            latest_trailer = trailer
+        prev = re.search(rb'/Prev\s+(\d+)', trailer)
+        xref_offset = int(prev.group(1)) if prev else None
+    return offsets, latest_trailer
+
+
+def _read_dictionary(data):
+    """先頭の << ... >> を（入れ子を考慮して）取り出す"""
+    start = data.index(b'<<')
+    depth = 0
+    index = start
+    while index < len(data) - 1:
+        pair = data[index:index + 2]
+        if pair == b'<<':
+            depth += 1
+            index += 2
+        elif pair == b'>>':
+            depth -= 1
+            index += 2
+            if depth == 0:
+                return data[start:index]
+        else:
+            index += 1
+    raise ValueError("辞書が閉じていません")
+
+
+def _read_object(fp, offset):
+    """指定位置のオブジェクトの辞書部分を読む"""
+    fp.seek(offset)
+    data = b''
+    while b'endobj' not in data and b'stream' not in data:
+        block = fp.read(65536)
+        if not block:
+            break
+        data += block
+    return _read_dictionary(data)
+
+
+def _value(dictionary, key):
+    match = re.search(rb'/' + key + rb'\s+(\d+)', dictionary)
+    if match is None:
+        raise ValueError(f"/{key.decode()} がありません")
+    return match.group(1)
+
+
+def _ref(dictionary, key):
+    match = re.search(rb'/' + key + rb'\s+(\d+)\s+\d+\s+R', dictionary)
+    if match is None:
+        raise ValueError(f"/{key.decode()} がありません")
+    return int(match.group(1))
+
+
+def _subsections(offsets):
+    """オブジェクト番号→位置 を、番号が連続する (開始番号, [位置...]) の並びにまとめる"""
+    sections = []
+    for obj_id in sorted(offsets):
+        if sections and sections[-1][0] + len(sections[-1][1]) == obj_id:
+            sections[-1][1].append(offsets[obj_id])
+        else:
+            sections.append((obj_id, [offsets[obj_id]]))
+    return sections
+
+
+def _format_number(value):
+    text = ('%.4f' % value).rstrip('0').rstrip('.')
+    return text.encode()
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+保存したページ画像からのPDFの作り直し
+--keep-images で保存したページ画像（PNGまたはスプール）から、キャプチャし直さずにPDFを作る。
+ページ画像の読み込みとエンコードは複数のプロセスで行い、ページの範囲や除くページを指定できる。
+--format でCBZ・TIFFなどの画像アーカイブ（archive_writer）も作れる。
+
+エンコード済みのストリームは画像ディレクトリの rebuild_cache/ にキャッシュし（stream_cache）、
+同じ画像を同じ設定でエンコードしたページは次回からエンコードしない。
+出力プロファイルなどを変えて試す場合も、前に試した設定に戻すのは速い。
+画像がなくジャーナル（journal.jsonl・streams.bin）だけが残っている場合は、
+記録済みのストリームからPDFを作る（エンコード設定はキャプチャ時のまま）。
+--target-size を指定した場合は、上限に収まる最大幅と品質をサンプルのエンコードから選ぶ（target_size）。
+
+使い方:
+    python kindle_to_pdf.py rebuild kindle_screenshots -o book.pdf --profile tablet
+    python rebuild.py kindle_screenshots -o book.pdf --pages 1-200 --skip 17,42-45
+    python kindle_to_pdf.py rebuild kindle_screenshots -o book.pdf --target-size 50MB
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from archive_writer import FORMATS, create_writer, output_path_for
+from frame_spool import page_number, saved_pages
+from journal import JOURNAL_FILE, CaptureJournal, load_features
+from page_encoder import PROFILES, PageEncoder, parse_quality
+from pdf_writer import add_image_files
+from stage_timer import format_duration
+from stream_cache import CACHE_DIR, StreamCache, sources_signature
+from target_size import DEFAULT_SAMPLES, MAX_ATTEMPTS, TargetSearch, format_size, parse_size
+
+
+def parse_page_ranges(text):
+    """"1-50,60,70-" の形のページ指定を (開始, 終わり) のリストにする（終わりがNoneなら最後まで）"""
+    ranges = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                start, _, end = part.partition('-')
+                ranges.append((int(start) if start else 1, int(end) if end else None))
+            else:
+                ranges.append((int(part), int(part)))
+        except ValueError:
+            raise ValueError(f"ページの指定が正しくありません: {part}")
+    return ranges
+
+
+def page_selected(page_num, pages=None, skip=None):
+    """ページ番号が pages の範囲に含まれ、skip の範囲に含まれないか"""
+    def contains(ranges):
+        return any(start <= page_num and (end is None or page_num <= end) for start, end in ranges)
+    return (pages is None or contains(pages)) and not (skip and contains(skip))
+
+
+def _page_ranges_argument(text):
+    try:
+        return parse_page_ranges(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _size_argument(text):
+    try:
+        return parse_size(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _quality_argument(text):
+    try:
+        return parse_quality(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+class RebuildResult:
+    """作り直しの結果"""
+
+    __slots__ = ('output_path', 'page_count', 'sources', 'cached', 'encoded', 'saved_seconds',
+                 'from_journal', 'target')
+
+    def __init__(self, output_path, page_count, sources, cached=0, encoded=0, saved_seconds=0.0,
+                 from_journal=False, target=None):
+        self.output_path = output_path
+        self.page_count = page_count
+        # 使ったページ画像（ジャーナルから作った場合はレコード）の数
+        self.sources = sources
+        # キャッシュから読んだページ数とエンコードしたページ数
+        self.cached = cached
+        self.encoded = encoded
+        self.saved_seconds = saved_seconds
+        self.from_journal = from_journal
+        # --target-size の設定の選択（target_size.TargetSearch、指定しなければNone）
+        self.target = target
+
+
+def _selected_sources(directory, pages, skip):
+    return [source for source in saved_pages(directory)
+            if page_selected(page_number(source), pages, skip)]
+
+
+def _trim_box(sources, cache):
+    """全ページ共通の切り抜き範囲（cache があれば同じ画像の一覧に対して記録した範囲を使う）"""
+    from trim import trim_box_for_images
+
+    # 切り抜き範囲は全ページの解析が必要なので、同じ画像の一覧なら記録した範囲を使う
+    signature = sources_signature(sources) if cache is not None else None
+    box = cache.trim_box(signature) if cache is not None else None
+    if box is None:
+        box = trim_box_for_images(sources)
+        if cache is not None and box is not None:
+            cache.put_trim_box(signature, box)
+    return box
+
+
+def rebuild_pdf(directory, output_path, encoder=None, jobs=1, trim=False, pages=None, skip=None,
+                store=None, classifier=None, use_cache=True, linearize=False, progress=None,
+                output_format='pdf', cache_dir=None, on_warning=None):
+    """保存したページ画像（なければジャーナルのストリーム）からPDFを作り、RebuildResultを返す
+
+    output_format に 'cbz' などを指定した場合は画像アーカイブ（archive_writer）を作る。
+    pages・skip は parse_page_ranges の形の撮影時のページ番号の範囲。
+    use_cache=True の場合は cache_dir（省略時は directory の rebuild_cache/）のストリームを使い、
+    エンコードしたものを追加する。
+    on_warning は切り抜けないページがあった場合などの警告の通知先（省略時は知らせない）。
+    """
+    directory = Path(directory)
+    sources = _selected_sources(directory, pages, skip)
+    if not sources:
+        if (directory / JOURNAL_FILE).exists():
+            return _rebuild_from_journal(directory, output_path, pages, skip, store, linearize,
+                                         progress, output_format)
+        raise ValueError(f"{directory} に対象のページ画像がありません")
+
+    encoder = encoder or PageEncoder()
+    if classifier is not None:
+        classifier.cache.update(load_features(directory))
+    cache = StreamCache(Path(cache_dir or directory / CACHE_DIR)) if use_cache else None
+    try:
+        box = _trim_box(sources, cache) if trim else None
+        with create_writer(output_path, output_format, resolution=100.0,
+                           linearize=linearize) as writer:
+            add_image_files(writer, sources, progress, box, encoder, jobs, store, classifier,
+                            cache, on_warning)
+    finally:
+        if cache is not None:
+            cache.close()
+    if cache is None:
+        return RebuildResult(output_path, writer.page_count, len(sources), encoded=len(sources))
+    return RebuildResult(output_path, writer.page_count, len(sources), cache.hits, cache.misses,
+                         cache.saved_seconds)
+
+
+def rebuild_to_size(directory, output_path, target_size, encoder=None, jobs=1, trim=False,
+                    pages=None, skip=None, store=None, classifier=None, use_cache=True,
+                    linearize=False, progress=None, output_format='pdf', samples=DEFAULT_SAMPLES,
+                    sample_progress=None, on_warning=None):
+    """出力ファイルが target_size バイト以下になる設定を選んで作り、RebuildResultを返す
+
+    encoder の品質・最大幅を上限として、サンプルのページのエンコードから設定を選ぶ（target_size）。
+    サンプルのエンコード結果はキャッシュに追加して本全体のエンコードで使う
+    （use_cache=False の場合は一時ディレクトリのキャッシュを使い、終わったら消す）。
+    書き出したファイルが上限を超えた場合は、MAX_ATTEMPTS 回まで小さい設定で作り直す。
+    結果の target.met が False なら、どの設定でも上限に収まらなかった。
+    on_warning は rebuild_pdf と同じ。
+    """
+    directory = Path(directory)
+    sources = _selected_sources(directory, pages, skip)
+    if not sources:
+        raise ValueError(f"{directory} に対象のページ画像がありません"
+                         "（ジャーナルからの作り直しでは --target-size は使えません）")
+    encoder = encoder or PageEncoder()
+    if classifier is not None:
+        classifier.cache.update(load_features(directory))
+    with tempfile.TemporaryDirectory(prefix="rebuild_cache_") as temp_dir:
+        cache_dir = directory / CACHE_DIR if use_cache else Path(temp_dir)
+        search = TargetSearch(target_size, encoder, samples)
+        with StreamCache(cache_dir) as cache:
+            box = _trim_box(sources, cache) if trim else None
+            if box and on_warning is not None:
+                from trim import uncropped_warning
+
+                # 作り直すたびに知らせないよう、ここで一度だけ知らせる
+                warning = uncropped_warning(sources, box)
+                if warning:
+                    on_warning(warning)
+            search.estimate(sources, jobs, box, classifier, cache, sample_progress)
+
+        correction = 1.0
+        result = None
+        for _ in range(MAX_ATTEMPTS):
+            estimate = search.choose(correction)
+            if estimate is None:
+                break
+            result = rebuild_pdf(directory, output_path, estimate.encoder, jobs, trim, pages, skip,
+                                 store, classifier, True, linearize, progress, output_format,
+                                 cache_dir)
+            correction = search.record(estimate, os.path.getsize(output_path))
+            if search.met:
+                break
+    result.target = search
+    return result
+
+
+def _rebuild_from_journal(directory, output_path, pages, skip, store, linearize, progress,
+                          output_format='pdf'):
+    """ジャーナルに記録したストリームからPDFを作る（再エンコードはしない）"""
+    # 再開と同じく、書きかけの末尾は切り捨てる
+    journal = CaptureJournal(directory, resume=True)
+    try:
+        entries = [entry for entry in journal.entries
+                   if (journal.end_page is None or entry['page'] <= journal.end_page)
+                   and page_selected(entry['page'], pages, skip)]
+        if not any('offset' in entry for entry in entries):
+            raise ValueError(f"{directory} のジャーナルにはPDFにできるページがありません")
+        with create_writer(output_path, output_format, resolution=100.0,
+                           linearize=linearize) as writer:
+            for index, result in enumerate(journal.replay(), 1):
+                if progress:
+                    progress(index, len(journal.entries))
+                if (journal.end_page is not None and result.page_num > journal.end_page
+                        or not page_selected(result.page_num, pages, skip)):
+                    continue
+                for encoded, key in result.pages():
+                    if encoded is None:
+                        continue
+                    key = key if store is not None else None
+                    if key is not None and writer.has_image(key):
+                        writer.add_shared_page(key)
+                    else:
+                        writer.add_encoded_page(encoded, key)
+    finally:
+        journal.close()
+    return RebuildResult(output_path, writer.page_count, len(entries), from_journal=True)
+
+
+def main(argv=None):
+    """rebuild のエントリーポイント（戻り値: RebuildResult）"""
+    parser = argparse.ArgumentParser(
+        prog="kindle_to_pdf.py rebuild",
+        description="保存したページ画像（またはジャーナル）から、キャプチャし直さずにPDFを作る"
+    )
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default="kindle_screenshots",
+        help="ページ画像（PNGまたはスプール）を保存したディレクトリ（デフォルト: kindle_screenshots）"
+    )
+    parser.add_argument(
+        "--output", "-o",
+        type=str,
+        required=True,
+        help="出力ファイル名"
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(FORMATS),
+        default="pdf",
+        help="出力形式（pdf / cbz / tiff / webp、デフォルト: pdf）"
+    )
+    parser.add_argument(
+        "--pages", "-p",
+        type=_page_ranges_argument,
+        default=None,
+        metavar="RANGE",
+        help="PDFにするページ（撮影時のページ番号、例: 1-200,250-、省略時は全ページ）"
+    )
+    parser.add_argument(
+        "--skip",
+        type=_page_ranges_argument,
+        default=None,
+        metavar="RANGE",
+        help="PDFから除くページ（例: 17,42-45）"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help=f"エンコードプロセス数（デフォルト: CPU数 {os.cpu_count() or 1}）"
+    )
+    parser.add_argument(
+        "--trim", "-t",
+        action="store_true",
+        help="ツールバーや余白を自動で切り抜く（NumPyが必要）"
+    )
+    parser.add_argument(
+        "--encoding",
+        choices=["jpeg", "auto", "png"],
+        default="jpeg",
+        help="ページのエンコード方式（jpeg: 全ページJPEG, auto: 白黒/グレー/カラーをページごとに選択, "
+             "png: 可逆圧縮（保存したPNGはそのまま埋め込む）、デフォルト: jpeg）"
+    )
+    parser.add_argument(
+        "--quality",
+        type=_quality_argument,
+        default=75,
+        help="JPEGの品質（1〜95、デフォルト: 75）"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default="archive",
+        help="出力プロファイル（archive: 撮影した解像度のまま, tablet: 幅2048画素まで, "
+             "ereader: 幅1264画素まで、デフォルト: archive）"
+    )
+    parser.add_argument(
+        "--max-width",
+        type=int,
+        default=None,
+        help="ページ画像の最大幅（画素、--profile より優先）"
+    )
+    parser.add_argument(
+        "--dpi",
+        type=float,
+        default=None,
+        help="ページ画像の解像度の上限（撮影した画像を100dpiとしたページの大きさに対する値）"
+    )
+    parser.add_argument(
+        "--classify",
+        action="store_true",
+        help="ページを分類し、白紙のページを削除・見開きを左右の2ページに分割する（NumPyが必要）"
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=["off", "share"],
+        default="share",
+        help="内容が同じページの扱い（off: そのまま, share: 画像を1つだけ埋め込んで共有、デフォルト: share）"
+    )
+    parser.add_argument(
+        "--thumbnails",
+        action="store_true",
+        help="ページごとのサムネイル（/Thumb）をPDFに埋め込む"
+    )
+    parser.add_argument(
+        "--linearize",
+        action="store_true",
+        help="PDFを線形化（Fast Web View）し、ファイル全体を読まなくても最初のページを表示できるようにする"
+    )
+    parser.add_argument(
+        "--target-size",
+        type=_size_argument,
+        default=None,
+        metavar="SIZE",
+        help="出力ファイルのサイズの上限（例: 50MB、1.5GB、MiB・GiBも可）。上限に収まる最大幅と品質を自動で選ぶ"
+             "（--quality・--profile・--max-width の値が上限）"
+    )
+    parser.add_argument(
+        "--target-samples",
+        type=int,
+        default=DEFAULT_SAMPLES,
+        help=f"--target-size の見積もりに使うページ数（デフォルト: {DEFAULT_SAMPLES}）"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="エンコード済みストリームのキャッシュを使わない"
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="作り直す前にキャッシュを空にする"
+    )
+
+    args = parser.parse_args(argv)
+    if args.format != "pdf" and (args.linearize or args.thumbnails):
+        parser.error("--linearize・--thumbnails は --format pdf の場合のみ使えます")
+    output_path = output_path_for(args.output, args.format)
+    source = Path(args.source)
+    if not source.is_dir():
+        print(f"エラー: ディレクトリがありません: {source}")
+        sys.exit(1)
+
+    from page_store import PageStore
+
+    encoder = PageEncoder(args.encoding, args.quality,
+                          args.max_width if args.max_width is not None else PROFILES[args.profile],
+                          args.dpi, args.thumbnails, webp=args.format == "webp")
+    store = PageStore() if args.dedup != "off" else None
+    classifier = None
+    if args.classify:
+        from page_classifier import PageClassifier
+        classifier = PageClassifier()
+    if args.clear_cache and (source / CACHE_DIR).exists():
+        with StreamCache(source / CACHE_DIR) as cache:
+            cache.clear()
+
+    def progress(index, total):
+        print(f"\rPDFを作成中... {index}/{total}", end="", flush=True)
+
+    def warn(message):
+        print(f"警告: {message}")
+
+    def sample_progress(index, total):
+        print(f"\rサイズを見積もり中... {index}/{total}", end="", flush=True)
+
+    start = time.perf_counter()
+    try:
+        if args.target_size is not None:
+            print(f"目標サイズ: {format_size(args.target_size)}以下")
+            result = rebuild_to_size(source, output_path, args.target_size, encoder,
+                                     max(args.jobs, 1), args.trim, args.pages, args.skip, store,
+                                     classifier, not args.no_cache, args.linearize, progress,
+                                     args.format, max(args.target_samples, 1), sample_progress,
+                                     warn)
+            encoder = result.target.chosen.encoder
+        else:
+            result = rebuild_pdf(source, output_path, encoder, max(args.jobs, 1), args.trim,
+                                 args.pages, args.skip, store, classifier, not args.no_cache,
+                                 args.linearize, progress, args.format, on_warning=warn)
+    except (OSError, ValueError) as e:
+        print(f"\nエラー: {e}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    label = 'PDF' if args.format == 'pdf' else 'ファイル'
+    print(f"\n{label}作成完了: {output_path}（{result.page_count}ページ, {format_duration(elapsed)}）")
+    if result.from_journal:
+        print(f"ページ画像がないため、ジャーナルに記録した{result.sources}ページのストリームから作りました"
+              "（エンコード設定はキャプチャ時のままです）。")
+        return result
+    if result.target is not None:
+        print("\n目標サイズ:")
+        for line in result.target.report():
+            print(f"  {line}")
+    if not args.no_cache or result.target is not None:
+        print(f"キャッシュ: {result.cached}ページを再利用（エンコード {result.saved_seconds:.1f} 秒分）, "
+              f"{result.encoded}ページをエンコード")
+    if result.encoded and (args.encoding == "auto" or encoder.max_width or args.dpi):
+        print("\nエンコード内訳:")
+        for line in encoder.report():
+            print(f"  {line}")
+    if classifier is not None:
+        print("\nページの分類:")
+        for line in classifier.report():
+            print(f"  {line}")
+    if result.target is not None and not result.target.met:
+        print(f"\nエラー: どの設定でも {format_size(args.target_size)} 以下になりませんでした。"
+              "--classify・--trim を使うか、--max-width・--quality を下げてください。")
+        sys.exit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
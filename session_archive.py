@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+キャプチャセッションの記録と再生
+実際のキャプチャ中に、撮影・サンプルしたフレームと、それが見えた時刻（直前のページ送りからの秒数）、
+ページ送りと撮影にかかった時間を1つのアーカイブに記録する。
+記録したセッションは capture_backend の replay バックエンドで、元のタイミングのまま
+キャプチャループに流せるため、描画遅延のばらつき・描きかけのフレーム・ページ送りの取りこぼしを含む
+実際の動作に対して、描画完了検出・最後のページの検出・パイプラインの変更の速さと正確さを
+macOSやKindleアプリなしで確かめられる。
+
+ファイル形式（ZIP）:
+    session.json   記録したバックエンドの名前・ページ送りの回数・作成日時など
+    events.jsonl   1行1レコードのJSON。"type" が "frame"（フレームの大きさ・ピクセル形式・指紋）、
+                   "turn"（ページ送り、"duration" はページ送りにかかった秒数）、
+                   "grab" / "sample"（撮影・サンプル、"turn" 回目のページ送りから "t" 秒後に
+                   "frame" が見えた、"duration" は撮影にかかった秒数）のいずれか
+    frames/NNNNNN  フレームの生のピクセル（ZIPの圧縮レベル1）。内容が同じフレームは1つだけ保存する
+ページ送りの前（0回目）のフレームも記録する。
+フレームの比較・圧縮・書き込みは別スレッドで行い、撮影のタイミングにはほとんど影響しない。
+アーカイブは閉じるときに完成するため、強制終了した場合の記録は残らない。
+"""
+
+import bisect
+import hashlib
+import json
+import queue
+import threading
+import time
+import zipfile
+
+from fingerprint import DEFAULT_THRESHOLD, Fingerprint, fingerprint_frame
+from frame import Frame
+
+SESSION_VERSION = 1
+
+# 書き込み待ちのフレームの上限（超えると撮影側が待つ）
+QUEUE_SIZE = 64
+
+
+class SessionRecorder:
+    """フレームとページ送りのタイミングをアーカイブに記録する
+
+    turn() はページ送りの前、observe() は撮影の前に取った時刻と、それぞれにかかった秒数を渡す。
+    """
+
+    def __init__(self, path, backend_name=None, clock=time.monotonic):
+        self.path = path
+        self._clock = clock
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+        self.session = {'version': SESSION_VERSION, 'backend': backend_name,
+                        'created': time.time()}
+        self.turns = 0
+        self.frame_count = 0
+        self.observations = 0
+        self._turned_at = None
+        self._events = []
+        # フレームの内容のハッシュ -> フレーム番号
+        self._frames = {}
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, name="session-recorder",
+                                        daemon=True)
+        self._thread.start()
+
+    def now(self):
+        return self._clock()
+
+    def turn(self, started, duration):
+        """started に始めたページ送りを記録"""
+        self.turns += 1
+        self._turned_at = started
+        self._queue.put(({'type': 'turn', 'turn': self.turns, 'duration': round(duration, 5)},
+                         None))
+
+    def observe(self, kind, frame, started, duration):
+        """started に撮影（kind: 'grab' / 'sample'）を始めたフレームを記録"""
+        if self._error is not None:
+            raise self._error
+        self.observations += 1
+        offset = started - self._turned_at if self._turned_at is not None else 0.0
+        self._queue.put(({'type': kind, 'turn': self.turns, 't': round(offset, 5),
+                          'duration': round(duration, 5)}, frame))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            event, frame = item
+            try:
+                if frame is not None:
+                    event['frame'] = self._add_frame(frame)
+                self._events.append(event)
+            except Exception as e:
+                self._error = e
+
+    def _add_frame(self, frame):
+        """フレームを保存し（内容が同じなら保存済みのもの）、フレーム番号を返す"""
+        data = frame.buffer.cast('B') if frame.buffer.format != 'B' else frame.buffer
+        digest = hashlib.sha1(data).digest()
+        key = (frame.width, frame.height, frame.stride, frame.pixel_format, digest)
+        frame_id = self._frames.get(key)
+        if frame_id is None:
+            frame_id = self.frame_count
+            self.frame_count += 1
+            self._zip.writestr(_frame_name(frame_id), data)
+            self._events.append({
+                'type': 'frame', 'id': frame_id, 'width': frame.width, 'height': frame.height,
+                'stride': frame.stride, 'pixel_format': frame.pixel_format,
+                'fingerprint': fingerprint_frame(frame).hex(),
+            })
+            self._frames[key] = frame_id
+        return frame_id
+
+    def close(self):
+        """書き込み待ちのフレームを書いてアーカイブを完成させる"""
+        if self._zip.fp is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self.session.update({'turns': self.turns, 'frames': self.frame_count,
+                                 'observations': self.observations})
+            self._zip.writestr('events.jsonl', ''.join(
+                json.dumps(event) + '\n' for event in self._events))
+            self._zip.writestr('session.json', json.dumps(self.session, indent=2))
+        finally:
+            self._zip.close()
+        if self._error is not None:
+            raise self._error
+
+
+def _frame_name(frame_id):
+    return f"frames/{frame_id:06d}"
+
+
+class RecordedSession:
+    """記録したセッションの読み込み
+
+    timeline[n] は n 回目のページ送り（0 はページ送りの前）の後に見えたフレームの
+    (秒数, 撮影用のフレーム番号, サンプル用のフレーム番号, 撮影にかかった秒数) のリスト（時刻順）。
+    サンプルだけで見えたフレーム（Retinaの等倍解像度など、撮影と大きさが違うもの）は、
+    指紋が一致する撮影したフレームで撮影の代わりにする。
+    """
+
+    def __init__(self, path, threshold=DEFAULT_THRESHOLD):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        try:
+            self.session = json.loads(self._zip.read('session.json'))
+            lines = self._zip.read('events.jsonl').decode('utf-8').splitlines()
+        except KeyError:
+            self._zip.close()
+            raise ValueError(f"{path} は記録したセッションではありません")
+        events = [json.loads(line) for line in lines if line]
+        self.frames = {event['id']: event for event in events if event['type'] == 'frame'}
+        self.turn_durations = {}
+        observations = []
+        for event in events:
+            if event['type'] == 'turn':
+                self.turn_durations[event['turn']] = event['duration']
+            elif event['type'] in ('grab', 'sample'):
+                observations.append(event)
+
+        grab_size = self._grab_size(observations)
+        equivalents = self._equivalent_grabs(observations, grab_size, threshold)
+        self.timeline = [[] for _ in range(self.session.get('turns', 0) + 1)]
+        for event in observations:
+            frame_id = event['frame']
+            self.timeline[event['turn']].append(
+                (event['t'], equivalents.get(frame_id, frame_id), frame_id, event['duration']))
+        for entries in self.timeline:
+            entries.sort(key=lambda entry: entry[0])
+        self._times = [[entry[0] for entry in entries] for entries in self.timeline]
+        self.grab_size = grab_size
+        self.pages = self._recorded_pages(observations)
+
+    @property
+    def turns(self):
+        return len(self.timeline) - 1
+
+    def frame_size(self, frame_id):
+        frame = self.frames[frame_id]
+        return (frame['width'], frame['height'])
+
+    def _grab_size(self, observations):
+        """撮影したフレームの大きさ（最も多いもの）"""
+        counts = {}
+        for event in observations:
+            if event['type'] == 'grab':
+                size = self.frame_size(event['frame'])
+                counts[size] = counts.get(size, 0) + 1
+        return max(counts, key=counts.get) if counts else None
+
+    def _equivalent_grabs(self, observations, grab_size, threshold):
+        """撮影と大きさが違うフレーム -> 指紋が一致する撮影したフレーム（後に撮影したものを優先）"""
+        grabs = [(index, event['frame']) for index, event in enumerate(observations)
+                 if event['type'] == 'grab' and self.frame_size(event['frame']) == grab_size]
+        equivalents = {}
+        for index, event in enumerate(observations):
+            frame_id = event['frame']
+            if grab_size is None or frame_id in equivalents or self.frame_size(frame_id) == grab_size:
+                continue
+            fingerprint = Fingerprint.from_hex(self.frames[frame_id]['fingerprint'])
+            later = [grab for position, grab in grabs if position > index]
+            earlier = [grab for position, grab in reversed(grabs) if position < index]
+            for grab_id in later + earlier:
+                if fingerprint.matches(Fingerprint.from_hex(self.frames[grab_id]['fingerprint']),
+                                       threshold):
+                    equivalents[frame_id] = grab_id
+                    break
+        return equivalents
+
+    def _recorded_pages(self, observations):
+        """記録時に撮影したページ（ページ送りごとの最後の撮影、続けて同じものは1つ）のフレーム番号"""
+        last_grabs = {}
+        for event in observations:
+            if event['type'] == 'grab':
+                last_grabs[event['turn']] = event['frame']
+        pages = []
+        for turn in sorted(last_grabs):
+            if not pages or pages[-1] != last_grabs[turn]:
+                pages.append(last_grabs[turn])
+        return pages
+
+    def visible(self, turn, elapsed):
+        """turn 回目のページ送りから elapsed 秒後に見えていたフレームの記録（見えたものがなければ None）"""
+        turn = min(turn, self.turns)
+        index = bisect.bisect_right(self._times[turn], elapsed) - 1
+        if index >= 0:
+            return self.timeline[turn][index]
+        # このページ送りの後に最初に撮影するまでは、前のページ送りの最後のフレームが見えている
+        for previous in range(turn - 1, -1, -1):
+            if self.timeline[previous]:
+                return self.timeline[previous][-1]
+        return self.timeline[turn][0] if self.timeline[turn] else None
+
+    def load_frame(self, frame_id, size=None):
+        """フレームを読み込む（size を指定した場合、大きさが違えばその大きさに拡大縮小する）"""
+        info = self.frames[frame_id]
+        frame = Frame(self._zip.read(_frame_name(frame_id)), info['width'], info['height'],
+                      info['stride'], info['pixel_format'])
+        if size is not None and frame.size != tuple(size):
+            from PIL import Image
+
+            frame = Frame.from_image(frame.to_image().resize(size, Image.BILINEAR),
+                                     info['pixel_format'])
+        return frame
+
+    def frames_of(self, turn):
+        """turn 回目のページ送りの後に見える可能性のあるフレーム番号"""
+        turn = min(turn, self.turns)
+        first = self.visible(turn, -1.0)
+        ids = {entry[1] for entry in self.timeline[turn]} | {entry[2] for entry in self.timeline[turn]}
+        if first is not None:
+            ids.update(first[1:3])
+        return ids
+
+    def close(self):
+        self._zip.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Kindleアプリのシミュレーター
+macOSやKindleアプリがない環境で、キャプチャループの速度と正確さを確認するために使う。
+ページ送り後、描画遅延の間は前のページ（途中からは描きかけのページ）を返す。
+"""
+
+import random
+import time
+
+from frame import Frame
+
+
+class SimulatedKindle:
+    """描画遅延を再現するKindleウィンドウ
+
+    pages: ページごとのPIL画像のシーケンス（SyntheticBookのように参照時に描画するものでもよい）
+    render_latency: 描画にかかる秒数（数値、またはページ番号を受け取る関数）
+    partial_time: 描画完了直前に描きかけの状態が見える秒数
+    最後のページでページ送りしても表示は変わらない。
+    フレームは表示中・直前のページの分だけを保持する。
+    """
+
+    def __init__(self, pages, render_latency=0.3, partial_time=0.08, clock=time.monotonic):
+        self._pages = pages
+        self._cache = {}
+        if callable(render_latency):
+            self._latency = render_latency
+        else:
+            self._latency = lambda index: render_latency
+        self.partial_time = partial_time
+        self._clock = clock
+        self.index = 0
+        self._previous = 0
+        self._turned_at = None
+        self.turn_count = 0
+
+    @staticmethod
+    def _half_drawn(before, after):
+        """上半分だけ新しいページが描かれた状態"""
+        img = before.convert('RGB').copy()
+        box = (0, 0, after.width, after.height // 2)
+        img.paste(after.convert('RGB').crop(box), box)
+        return Frame.from_image(img)
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def _frame(self, index, partial=False):
+        key = (index, partial)
+        if key not in self._cache:
+            if partial:
+                self._cache[key] = self._half_drawn(self._frame(index - 1).to_image(),
+                                                    self._frame(index).to_image())
+            else:
+                self._cache[key] = Frame.from_image(self._pages[index])
+        return self._cache[key]
+
+    def turn_page(self):
+        """次のページへ移動"""
+        self.turn_count += 1
+        if self.index + 1 < len(self._pages):
+            self._previous = self.index
+            self.index += 1
+            # 表示される可能性のあるフレーム以外は捨て、次のページを描画しておく
+            keep = {(self.index, False), (self.index, True), (self._previous, False)}
+            for key in list(self._cache):
+                if key not in keep:
+                    del self._cache[key]
+            self._frame(self.index)
+            self._turned_at = self._clock()
+
+    def _rendered(self):
+        return self._clock() - self._turned_at >= self._latency(self.index)
+
+    def grab(self):
+        """現在表示されているフレームを返す"""
+        if self._turned_at is None or self._rendered():
+            return self._frame(self.index)
+        if self._clock() - self._turned_at >= self._latency(self.index) - self.partial_time:
+            return self._frame(self.index, partial=True)
+        return self._frame(self._previous)
+
+    def page_of(self, frame):
+        """フレームがどのページの完成画像か（描きかけ・不明ならNone）
+
+        直前に grab() したフレームに対して使う（古いフレームは判定できない）。
+        """
+        for (index, partial), page_frame in self._cache.items():
+            if frame is page_frame and not partial:
+                return index
+        return None
+
+
+def random_latency(mean=0.3, spread=0.2, slow_rate=0.05, slow_latency=1.5, seed=0):
+    """ページごとに揺らぎのある描画遅延（まれに遅いページを含む）"""
+    rng = random.Random(seed)
+    cache = {}
+
+    def latency(index):
+        if index not in cache:
+            if rng.random() < slow_rate:
+                cache[index] = slow_latency
+            else:
+                cache[index] = max(0.0, rng.uniform(mean - spread, mean + spread))
+        return cache[index]
+
+    return latency
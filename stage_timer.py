@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+処理段階ごとの時間計測
+撮影・ページ送り・待機・指紋・エンコード・PDF書き出しなどの所要時間を段階ごとに記録し、
+中央値（p50）・95パーセンタイル（p95）・ページ/分・残り時間を集計する。
+ワーカーで計測した時間は PageResult.timings から取り込む。
+
+trace_path を指定した場合は、各段階をChrome trace形式のイベントとしても書き出す
+（chrome://tracing や https://ui.perfetto.dev で開くと、スレッドごとの時系列で表示できる）。
+1行1イベントで書き出し、途中で終了した場合も閉じ括弧のない配列として読み込める。
+"""
+
+import json
+import math
+import time
+from contextlib import contextmanager
+
+
+class TraceWriter:
+    """Chrome trace形式（JSON配列）でイベントを書き出す"""
+
+    def __init__(self, path, origin):
+        self.path = path
+        self._origin = origin
+        self._threads = {}
+        self._fp = open(path, 'w', encoding='utf-8')
+        self._separator = '[\n'
+
+    def _write(self, event):
+        self._fp.write(self._separator + json.dumps(event, ensure_ascii=False))
+        self._separator = ',\n'
+
+    def event(self, name, start, seconds, thread, args=None):
+        """start（計測に使う時計の時刻）から seconds 秒かかった処理を書き出す"""
+        tid = self._threads.get(thread)
+        if tid is None:
+            tid = self._threads[thread] = len(self._threads) + 1
+            self._write({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                         'args': {'name': thread}})
+        event = {'name': name, 'ph': 'X', 'pid': 1, 'tid': tid,
+                 'ts': round((start - self._origin) * 1e6, 1), 'dur': round(seconds * 1e6, 1)}
+        if args:
+            event['args'] = args
+        self._write(event)
+
+    def close(self):
+        if not self._fp.closed:
+            self._fp.write('\n]\n' if self._separator != '[\n' else '[]\n')
+            self._fp.close()
+
+
+class StageTimer:
+    """処理段階ごとの所要時間を記録する（キャプチャループのスレッドから使う）
+
+    計測値は段階ごとのリストに追加するだけなので、トレースを出力しない場合の負荷は無視できる。
+    """
+
+    def __init__(self, clock=time.perf_counter, trace_path=None):
+        self._clock = clock
+        self.started = clock()
+        self.samples = {}
+        self.pages = 0
+        self._trace = TraceWriter(trace_path, self.started) if trace_path else None
+
+    @contextmanager
+    def stage(self, name):
+        """with文の中の処理時間を name の段階として記録する"""
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.add(name, self._clock() - start, start)
+
+    def add(self, name, seconds, start=None, thread='capture', page=None):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = []
+        samples.append(seconds)
+        if self._trace is not None and start is not None:
+            # キャプチャループの段階は撮影回数、ワーカーの段階はページ番号を付ける
+            self._trace.event(name, start, seconds, thread,
+                              {'shot': self.pages} if page is None else {'page': page})
+
+    def add_results(self, results):
+        """ワーカーで処理が終わったページの計測結果を取り込む"""
+        for result in results:
+            # timings は処理した順に並んでいるので、開始時刻を順に進めてトレースに書く
+            start = result.started
+            for name, seconds in result.timings.items():
+                self.add(name, seconds, start, result.worker or 'worker', result.page_num)
+                if start is not None:
+                    start += seconds
+
+    @property
+    def elapsed(self):
+        return self._clock() - self.started
+
+    def pages_per_minute(self):
+        elapsed = self.elapsed
+        return self.pages * 60.0 / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, remaining_pages):
+        """ここまでの速度で remaining_pages ページを撮影するのにかかる秒数（未計測ならNone）"""
+        if self.pages == 0:
+            return None
+        return self.elapsed / self.pages * max(remaining_pages, 0)
+
+    def percentile(self, name, percent):
+        """name の段階の percent パーセンタイル（秒）"""
+        ordered = sorted(self.samples[name])
+        rank = max(math.ceil(len(ordered) * percent / 100.0), 1)
+        return ordered[rank - 1]
+
+    def summary(self):
+        """段階ごとの {name: (合計秒, 回数)}"""
+        return {name: (sum(samples), len(samples)) for name, samples in self.samples.items()}
+
+    def report(self):
+        """段階ごとの集計表（合計時間の長い順）の行のリスト"""
+        lines = [f"{'段階':<12} {'合計(秒)':>9} {'回数':>6} {'p50(ms)':>9} {'p95(ms)':>9}"]
+        for name, (total, count) in sorted(self.summary().items(), key=lambda item: -item[1][0]):
+            lines.append(f"{name:<12} {total:>9.2f} {count:>6} "
+                         f"{self.percentile(name, 50) * 1000:>9.1f} "
+                         f"{self.percentile(name, 95) * 1000:>9.1f}")
+        lines.append(f"{self.pages}ページを撮影, 経過 {format_duration(self.elapsed)}, "
+                     f"{self.pages_per_minute():.1f} ページ/分")
+        return lines
+
+    def close(self):
+        """トレースファイルを閉じる"""
+        if self._trace is not None:
+            self._trace.close()
+
+
+def format_duration(seconds):
+    """秒数を「1時間2分」「3分20秒」「45秒」の形で表す"""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}時間{seconds % 3600 // 60}分"
+    if seconds >= 60:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    return f"{seconds}秒"
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+エンコード済みストリームのキャッシュ（PDFの作り直し用）
+保存したページ画像からPDFを作り直す際に、ページ画像の内容とエンコード設定ごとの
+エンコード結果をディスクに残し、同じ画像を同じ設定で作り直す場合はエンコードを省略する。
+設定を変えた結果は別のキーで追加するため、前に試した設定に戻す場合も速い。
+
+ファイル形式（キャッシュのディレクトリ内）:
+    index.jsonl  1行1レコードのJSON。"type" が "stream"（"key" とストリームの位置・形式、
+                 ジャーナルの "page" レコードと同じ項目）または "trim"（ページ画像の一覧に対する
+                 自動トリミングの切り抜き範囲）
+    streams.bin  エンコード済みストリーム（とサムネイル）を連結したもの
+ストリームを書いてからレコードを書くため、途中で書きかけになった末尾は読み込み時に無視する。
+"""
+
+import json
+import os
+import threading
+
+from journal import read_stream, stream_end, write_stream
+
+CACHE_DIR = "rebuild_cache"
+INDEX_FILE = "index.jsonl"
+STREAMS_FILE = "streams.bin"
+
+
+def encoder_settings(encoder):
+    """エンコード結果を左右する設定を表す文字列（キャッシュのキーに使う）"""
+    settings = (f"{encoder.mode}-q{encoder.quality}-w{encoder.max_width or 0}-d{encoder.dpi or 0}"
+                f"-t{int(encoder.thumbnails)}")
+    return settings + "-webp" if encoder.webp else settings
+
+
+class StreamCache:
+    """ページ画像の内容（frame_spool.source_key）とエンコード設定をキーとするストリームのキャッシュ
+
+    get() は複数のスレッドから呼び出してよい。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = directory / INDEX_FILE
+        self.streams_path = directory / STREAMS_FILE
+        self._streams = {}
+        self._trim = {}
+        self._lock = threading.Lock()
+        # キャッシュから読んだページ数と、エンコードして追加したページ数
+        self.hits = 0
+        self.misses = 0
+        # キャッシュから読んだページのエンコードに、前回かかった時間の合計
+        self.saved_seconds = 0.0
+        self._load()
+        self._index = open(self.index_path, 'a', encoding='utf-8')
+        self._writer = open(self.streams_path, 'ab')
+        self._reader = open(self.streams_path, 'rb')
+
+    def _load(self):
+        if not self.index_path.exists():
+            return
+        streams_length = self.streams_path.stat().st_size if self.streams_path.exists() else 0
+        with open(self.index_path, encoding='utf-8') as fp:
+            for line in fp:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record['type'] == 'stream' and stream_end(record) <= streams_length:
+                    self._streams[record['key']] = record
+                elif record['type'] == 'trim':
+                    self._trim[record['sources']] = record['box']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self._streams)
+
+    def key(self, source_key, encoder):
+        return f"{source_key}@{encoder_settings(encoder)}"
+
+    def __contains__(self, key):
+        return key in self._streams
+
+    def get(self, key):
+        """キャッシュしたストリームをEncodedImageで返す（なければNone）"""
+        record = self._streams.get(key)
+        if record is None:
+            return None
+        with self._lock:
+            encoded = read_stream(self._reader, record)
+            self.hits += 1
+            self.saved_seconds += record.get('seconds', 0.0)
+        return encoded
+
+    def put(self, key, encoded, seconds=0.0):
+        """エンコード結果を追加"""
+        if key in self._streams:
+            return
+        with self._lock:
+            self.misses += 1
+            record = {'type': 'stream', 'key': key, 'seconds': round(seconds, 4)}
+            record.update(write_stream(self._writer, encoded))
+            self._writer.flush()
+            self._append(record)
+            self._streams[key] = record
+
+    def trim_box(self, sources):
+        """ページ画像の一覧（sources_signature）に対して記録した切り抜き範囲（なければNone）"""
+        box = self._trim.get(sources)
+        return tuple(box) if box else None
+
+    def put_trim_box(self, sources, box):
+        with self._lock:
+            self._append({'type': 'trim', 'sources': sources, 'box': list(box) if box else None})
+            self._trim[sources] = box
+
+    def _append(self, record):
+        self._index.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._index.flush()
+
+    def close(self):
+        if not self._index.closed:
+            self._index.close()
+            self._writer.close()
+            self._reader.close()
+
+    def clear(self):
+        """キャッシュを空にする"""
+        self.close()
+        for path in (self.index_path, self.streams_path):
+            if path.exists():
+                path.unlink()
+        self._streams = {}
+        self._trim = {}
+        self._index = open(self.index_path, 'a', encoding='utf-8')
+        self._writer = open(self.streams_path, 'ab')
+        self._reader = open(self.streams_path, 'rb')
+
+
+def sources_signature(sources):
+    """ページ画像の一覧を表す文字列（ファイルの大きさと更新時刻、スプールのページはその内容のキー）"""
+    import hashlib
+
+    from frame_spool import SpoolPage
+
+    digest = hashlib.sha1()
+    for source in sources:
+        if isinstance(source, SpoolPage):
+            digest.update(f"{source.name}:{source.key()}\n".encode())
+        else:
+            stat = os.stat(source)
+            digest.update(f"{os.path.basename(source)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return f"{len(sources)}-{digest.hexdigest()}"
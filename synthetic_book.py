@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+合成した本
+macOSやKindleアプリがない環境での動作確認・ベンチマーク用に、
+本文・挿絵のページやKindleウィンドウ風の画像を決まった内容で描画する。
+"""
+
+
+def draw_synthetic_page(page_num, size=(1600, 2400)):
+    """本文らしき行を並べた合成ページ画像を作成"""
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    img = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    margin = width // 10
+    line_height = max(height // 50, 4)
+    for row, y in enumerate(range(margin, height - margin, line_height * 2)):
+        jitter = (page_num * 37 + row * 53) % max(width // 4, 1)
+        line_width = max(width - margin * 2 - jitter, 1)
+        draw.rectangle((margin, y, margin + line_width, y + line_height), fill=(30, 30, 30))
+    return img
+
+
+def draw_synthetic_illustration(page_num, size=(1600, 2400), color=True):
+    """グラデーションと図形による挿絵ページ（color=False ならグレースケール）を作成"""
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    if color:
+        img = Image.merge('RGB', (gradient, gradient.rotate(90).resize(size),
+                                  Image.new('L', size, 160)))
+    else:
+        img = gradient.convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for index in range(6):
+        x = (page_num * 97 + index * 211) % max(width - width // 5, 1)
+        y = (page_num * 53 + index * 307) % max(height - height // 5, 1)
+        fill = ((index * 40) % 256, (page_num * 60) % 256, 200) if color else (index * 40,) * 3
+        draw.ellipse((x, y, x + width // 5, y + width // 5), fill=fill)
+    return img
+
+
+def draw_synthetic_window(page_num, size=(2880, 1800), page=None, spread=False):
+    """ツールバーと広い余白を含む、Kindleウィンドウのキャプチャ風の合成画像
+
+    page を指定した場合は、本文の代わりにその画像をページ部分に縮小して配置する。
+    spread=True の場合は、page_num とその次のページを見開きで左右に並べる。
+    """
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    img = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    toolbar = height // 16
+    draw.rectangle((0, 0, width, toolbar), fill=(232, 232, 232))
+    for x in range(toolbar // 2, toolbar * 6, toolbar):
+        draw.rectangle((x, toolbar // 4, x + toolbar // 2, toolbar * 3 // 4), fill=(90, 90, 90))
+    page_height = height - toolbar * 3
+    page_size = (page_height * 2 // 3, page_height)
+    if spread:
+        gutter = width // 64
+        img.paste(draw_synthetic_page(page_num, page_size),
+                  (width // 2 - gutter - page_size[0], toolbar * 2))
+        img.paste(draw_synthetic_page(page_num + 1, page_size), (width // 2 + gutter, toolbar * 2))
+        return img
+    if page is None:
+        page = draw_synthetic_page(page_num, page_size)
+    else:
+        page = page.resize(page_size, Image.NEAREST)
+    img.paste(page, ((width - page.width) // 2, toolbar * 2))
+    return img
+
+
+class SyntheticBook:
+    """決まった内容の合成本（ページは参照されたときに描画する）
+
+    本文ページを基本に、illustration_every ページごとにグレーとカラーの挿絵を交互に挟む。
+    blank_every・spread_every を指定すると、その間隔で白紙のページ・見開き（ウィンドウ時のみ）も挟む。
+    window=True の場合は、ツールバーと余白を含むウィンドウのキャプチャ風に描画する。
+    ページ数が多くても、全ページを描画してメモリに保持することはない。
+    """
+
+    def __init__(self, page_count, size=(1600, 2400), illustration_every=8, window=False,
+                 blank_every=0, spread_every=0):
+        self.page_count = page_count
+        self.size = size
+        self.illustration_every = illustration_every
+        self.window = window
+        self.blank_every = blank_every
+        self.spread_every = spread_every
+
+    def __len__(self):
+        return self.page_count
+
+    def kind(self, index):
+        """ページの種類（'text' / 'gray' / 'color' / 'blank' / 'spread'）"""
+        if self.blank_every and index % self.blank_every == self.blank_every - 1:
+            return 'blank'
+        if self.window and self.spread_every and index % self.spread_every == self.spread_every - 1:
+            return 'spread'
+        if self.illustration_every and index % self.illustration_every == self.illustration_every - 1:
+            return 'gray' if (index // self.illustration_every) % 2 == 0 else 'color'
+        return 'text'
+
+    def __getitem__(self, index):
+        from PIL import Image
+
+        if not 0 <= index < self.page_count:
+            raise IndexError(index)
+        page_num = index + 1
+        kind = self.kind(index)
+        if self.window:
+            page = None
+            if kind == 'blank':
+                page = Image.new('RGB', (800, 1200), (255, 255, 255))
+            elif kind in ('gray', 'color'):
+                page = draw_synthetic_illustration(page_num, (800, 1200), color=kind == 'color')
+            return draw_synthetic_window(page_num, self.size, page, spread=kind == 'spread')
+        if kind == 'blank':
+            return Image.new('RGB', self.size, (255, 255, 255))
+        if kind == 'text':
+            return draw_synthetic_page(page_num, self.size)
+        return draw_synthetic_illustration(page_num, self.size, color=kind == 'color')
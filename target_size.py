@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+出力ファイルの目標サイズに合わせたエンコード設定の選択（rebuild の --target-size）
+メール送信の上限などファイルサイズに上限がある場合に、手で設定を変えて作り直す代わりに、
+本全体から均等に選んだ数ページを、最大幅とJPEGの品質の候補ごとに複数のプロセスで並列にエンコードし、
+その結果から本全体のサイズを見積もって、上限に収まる中で最も大きくなる（画質の高い）設定を選ぶ。
+指定した設定のままで収まる場合は、ほかの候補はエンコードしない。
+
+サイズの見積もりは、ページ画像の圧縮後の大きさ（PNGファイルやスプールに記録した大きさ）に
+エンコード後のサイズが比例するとした比推定で、サンプルのばらつきから誤差も求め、
+見積もり + 誤差の2倍が上限に収まる候補だけを使う。
+内容が同じページの共有（--dedup share）は見積もりに含めないため、実際はそれより小さくなる。
+
+サンプルのページは1プロセスで1回だけ読み込み、最大幅ごとに1回縮小した画像を品質の候補で使い回す。
+サンプルのエンコード結果はストリームのキャッシュ（stream_cache）に追加するため、
+選んだ設定で本全体をエンコードする際にはサンプルのページをエンコードし直さない。
+書き出したファイルが上限を超えた場合は、見積もりとの比で補正して次の候補で作り直す。
+"""
+
+import math
+import os
+import re
+import time
+
+# サンプルにするページ数
+DEFAULT_SAMPLES = 12
+
+# 候補にするJPEG（WebP）の品質と最大幅（指定した --quality・最大幅以下のもの）
+QUALITY_STEPS = (95, 85, 75, 65, 55, 45, 35)
+WIDTH_STEPS = (2048, 1600, 1264, 1024, 800)
+
+# ページごとの画像以外のオブジェクト（ページ・内容・画像の辞書など）のバイト数の見積もり
+PAGE_OVERHEAD = 512
+
+# 見積もりの誤差（標準誤差）の何倍までを上限に収めるか
+ERROR_MARGIN = 2.0
+
+# 書き出したファイルが上限を超えた場合に作り直す回数の上限（最初の1回を含む）
+MAX_ATTEMPTS = 3
+
+_UNITS = {'': 1, 'B': 1, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3,
+          'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3}
+
+
+def parse_size(text):
+    """"50MB"・"1.5GB"・"700KiB" の形のサイズをバイト数にする（MB は10の6乗、MiB は2の20乗）"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]i?B|B)?\s*', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"サイズの指定が正しくありません: {text}")
+    size = int(float(match.group(1)) * _UNITS[(match.group(2) or '').upper()])
+    if size <= 0:
+        raise ValueError(f"サイズの指定が正しくありません: {text}")
+    return size
+
+
+def format_size(size):
+    """バイト数を "12.3 MB" の形にする（parse_size と同じく1000単位）"""
+    for unit, factor in (('GB', 1000 ** 3), ('MB', 1000 ** 2), ('KB', 1000)):
+        if size >= factor:
+            return f"{size / factor:.1f} {unit}"
+    return f"{int(size)} B"
+
+
+def source_bytes(source):
+    """ページ画像の圧縮後の大きさ（見積もりの補助変数）"""
+    from frame_spool import SpoolPage
+
+    if isinstance(source, SpoolPage):
+        return source.length
+    return os.stat(source).st_size
+
+
+def sample_indices(count, samples=DEFAULT_SAMPLES):
+    """count ページから均等に選んだ samples ページの位置（count 以下ならすべて）"""
+    if count <= samples:
+        return list(range(count))
+    step = count / samples
+    return [int(step * index + step / 2) for index in range(samples)]
+
+
+def candidate_encoders(encoder, page_width):
+    """encoder の設定を上限とする候補のエンコーダー（最初が encoder と同じ設定）"""
+    from page_encoder import PageEncoder
+
+    limit = min(page_width, encoder.max_width or page_width)
+    widths = [encoder.max_width] + [width for width in WIDTH_STEPS if width < limit]
+    # 可逆圧縮は品質の影響を受けない
+    qualities = [encoder.quality]
+    if encoder.mode != 'png':
+        qualities += [quality for quality in QUALITY_STEPS if quality < encoder.quality]
+    return [PageEncoder(encoder.mode, quality, width, encoder.dpi, encoder.thumbnails,
+                        webp=encoder.webp)
+            for width in widths for quality in qualities]
+
+
+def encode_sample(path, box, settings):
+    """ワーカープロセスでページを1回だけ読み込み、settings の候補ごとにエンコードする
+
+    settings は (mode, quality, max_width, dpi, thumbnails, webp) のリスト。
+    encode_pool.encode_file と同じく (EncodedImage, 分類, 秒数) のリストを返す。
+    """
+    from encode_pool import encode_file
+    from frame_spool import open_page
+    from page_encoder import encode_page, encode_thumbnail, output_size, resample_page
+    from trim import crop_to_box
+
+    if len(settings) == 1 or settings[0][0] == 'png':
+        # 可逆圧縮は保存済みのPNGをそのまま使えることがあるため、encode_file に任せる
+        return [encode_file(path, box, *setting) for setting in settings]
+    results = []
+    with open_page(path) as img:
+        img = crop_to_box(img, box)
+        img.load()
+        resized = {}
+        thumbs = {}
+        for mode, quality, max_width, dpi, thumbnails, webp in settings:
+            start = time.perf_counter()
+            size = output_size(img.size, max_width, dpi)
+            if size not in resized:
+                resized[size] = img if size is None else resample_page(img, size)
+            page = resized[size]
+            encoded, page_class = encode_page(page, mode, quality, webp=webp)
+            encoded.scale = page.width / img.width
+            if thumbnails:
+                gray = encoded.colorspace == 'DeviceGray'
+                if gray not in thumbs:
+                    thumbs[gray] = encode_thumbnail(img, gray=gray)
+                encoded.thumb = thumbs[gray]
+            results.append((encoded, page_class, time.perf_counter() - start))
+    return results
+
+
+def describe(encoder):
+    """候補の設定を表す文字列（"品質75・幅1264画素" など）"""
+    parts = [f"品質{encoder.quality}"] if encoder.mode != 'png' else []
+    parts.append(f"幅{encoder.max_width}画素" if encoder.max_width else "撮影した解像度")
+    return '・'.join(parts)
+
+
+class SizeEstimate:
+    """候補の設定での本全体のサイズの見積もり（バイト数）と、その標準誤差"""
+
+    __slots__ = ('encoder', 'total', 'error', 'sample_bytes')
+
+    def __init__(self, encoder, total, error, sample_bytes):
+        self.encoder = encoder
+        self.total = total
+        self.error = error
+        self.sample_bytes = sample_bytes
+
+    def bound(self, correction=1.0):
+        """誤差を含めた見積もりの上限"""
+        return (self.total + ERROR_MARGIN * self.error) * correction
+
+
+def fit_size_model(sample_sizes, sample_aux, total_aux, count):
+    """比推定で本全体のサイズを見積もり、(見積もり, 標準誤差) を返す
+
+    sample_sizes はサンプルのページのエンコード後のサイズ、sample_aux はその補助変数
+    （ページ画像の圧縮後の大きさ）、total_aux は全 count ページの補助変数の合計。
+    """
+    n = len(sample_sizes)
+    if not n:
+        return 0.0, 0.0
+    aux_sum = sum(sample_aux)
+    if aux_sum <= 0 or total_aux <= 0:
+        sample_aux = [1] * n
+        aux_sum, total_aux = n, count
+    ratio = sum(sample_sizes) / aux_sum
+    total = ratio * total_aux
+    if n < 2 or n >= count:
+        return total, 0.0 if n >= count else total
+    residuals = sum((size - ratio * aux) ** 2 for size, aux in zip(sample_sizes, sample_aux))
+    # サンプルの補助変数の平均で本全体の平均に揃えた、有限母集団修正つきの分散
+    scale = total_aux / count / (aux_sum / n)
+    variance = count ** 2 * (1 - n / count) * residuals / (n - 1) / n * scale ** 2
+    return total, math.sqrt(variance)
+
+
+class TargetSearch:
+    """目標サイズに合わせた設定の選択（estimate() でサンプルをエンコードし、choose() で選ぶ）"""
+
+    def __init__(self, budget, encoder, samples=DEFAULT_SAMPLES):
+        self.budget = budget
+        self.encoder = encoder
+        self.samples = samples
+        self.estimates = []
+        # サンプルにしたページ数・エンコードした数・キャッシュにあった数・かかった秒数
+        self.sample_pages = 0
+        self.sample_encoded = 0
+        self.sample_cached = 0
+        self.seconds = 0.0
+        # 書き出した (SizeEstimate, 実際のサイズ) のリスト
+        self.attempts = []
+
+    @property
+    def chosen(self):
+        return self.attempts[-1][0] if self.attempts else None
+
+    @property
+    def met(self):
+        return bool(self.attempts) and self.attempts[-1][1] <= self.budget
+
+    def estimate(self, sources, jobs=1, box=None, classifier=None, cache=None, progress=None):
+        """sources から選んだページを候補ごとにエンコードし、候補ごとの見積もりを求める
+
+        classifier を指定した場合はサンプルのページも同じく分類して、白紙を除き見開きを分ける。
+        cache（stream_cache.StreamCache）にあるものは使い、エンコードしたものは追加する。
+        """
+        from frame_spool import open_page, source_key
+
+        start = time.perf_counter()
+        indices = sample_indices(len(sources), self.samples)
+        self.sample_pages = len(indices)
+        sampler = None
+        if classifier is not None:
+            from page_classifier import PageClassifier
+
+            # 集計が本全体の分類と重ならないよう、特徴量のキャッシュだけを共有する
+            sampler = PageClassifier(classifier.batch_size)
+            sampler.cache = classifier.cache
+        # サンプルのページごとの (ファイル, 範囲, 内容のキー) のリスト
+        items = []
+        for index in indices:
+            source = sources[index]
+            parts = sampler.split_files([source], box) if sampler else [(source, box)]
+            items.append([(path, part, source_key(path, part)) for path, part in parts])
+
+        with open_page(sources[indices[0]]) as img:
+            page_width = box[2] - box[0] if box else img.width
+        candidates = candidate_encoders(self.encoder, page_width)
+        aux = [source_bytes(sources[index]) for index in indices]
+        total_aux = sum(source_bytes(source) for source in sources)
+
+        def estimates(stage):
+            sizes = self._encode_samples(stage, items, jobs, cache, progress)
+            return [SizeEstimate(candidate, *fit_size_model(candidate_sizes, aux, total_aux,
+                                                             len(sources)), sum(candidate_sizes))
+                    for candidate, candidate_sizes in zip(stage, sizes)]
+
+        # 指定した設定のままで収まれば、ほかの候補はエンコードしない
+        self.estimates = estimates(candidates[:1])
+        if self.estimates[0].bound() > self.budget:
+            self.estimates += estimates(candidates[1:])
+        self.seconds = time.perf_counter() - start
+        return self.estimates
+
+    def _encode_samples(self, candidates, items, jobs, cache, progress):
+        """候補ごとのサンプルのページのサイズ（画像以外のオブジェクトを含む）のリストを返す"""
+        sizes = [[0] * len(items) for _ in candidates]
+        # サンプルのページの範囲ごとの (ページの位置, ファイル, 範囲, [(候補の位置, キャッシュのキー)])
+        tasks = []
+        for item_index, parts in enumerate(items):
+            for path, part, key in parts:
+                pending = []
+                for candidate_index, candidate in enumerate(candidates):
+                    cache_key = cache.key(key, candidate) if cache is not None else None
+                    encoded = cache.get(cache_key) if cache_key is not None else None
+                    if encoded is not None:
+                        self.sample_cached += 1
+                        sizes[candidate_index][item_index] += _page_bytes(encoded)
+                    else:
+                        pending.append((candidate_index, cache_key))
+                if pending:
+                    tasks.append((item_index, path, part, pending))
+        total = sum(len(task[3]) for task in tasks)
+
+        def arguments(task):
+            settings = [(candidates[index].mode, candidates[index].quality,
+                         candidates[index].max_width, candidates[index].dpi,
+                         candidates[index].thumbnails, candidates[index].webp)
+                        for index, _ in task[3]]
+            return task[1], task[2], settings
+
+        def finished(task, results):
+            for (candidate_index, cache_key), (encoded, _, seconds) in zip(task[3], results):
+                self.sample_encoded += 1
+                sizes[candidate_index][task[0]] += _page_bytes(encoded)
+                if cache_key is not None:
+                    cache.put(cache_key, encoded, seconds)
+            if progress:
+                progress(self.sample_encoded, total)
+
+        if jobs <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                finished(task, encode_sample(*arguments(task)))
+            return sizes
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # encode_pool と同じく spawn でワーカーを起動する
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), mp_context=context) as executor:
+            futures = [(task, executor.submit(encode_sample, *arguments(task))) for task in tasks]
+            for task, future in futures:
+                finished(task, future.result())
+        return sizes
+
+    def choose(self, correction=1.0):
+        """上限に収まる候補のうち最も大きくなるもの（まだ書き出していないもの）を返す
+
+        収まるものがなければ最も小さくなるもの（それも書き出していればNone）。
+        """
+        tried = {id(estimate) for estimate, _ in self.attempts}
+        fitting = [index for index, estimate in enumerate(self.estimates)
+                   if id(estimate) not in tried and estimate.bound(correction) <= self.budget
+                   and not self._dominated(estimate)]
+        if fitting:
+            # 同じ大きさなら先の候補（幅が大きいもの）を使う
+            return self.estimates[max(fitting, key=lambda index: (self.estimates[index].total,
+                                                                  -index))]
+        smallest = min(self.estimates, key=lambda estimate: estimate.total)
+        return None if id(smallest) in tried else smallest
+
+    def _dominated(self, estimate):
+        """最大幅・品質がともに以上で、見積もりが大きくない別の候補があるか（縮小でかえって大きくなる場合など）"""
+        def rank(encoder):
+            return (encoder.max_width or float('inf'), encoder.quality)
+
+        width, quality = rank(estimate.encoder)
+        return any(other is not estimate and other.total <= estimate.total
+                   and rank(other.encoder)[0] >= width and rank(other.encoder)[1] >= quality
+                   for other in self.estimates)
+
+    def record(self, estimate, actual):
+        """書き出した結果を記録し、次に選ぶ際の補正（実際のサイズと見積もりの比）を返す"""
+        self.attempts.append((estimate, actual))
+        return max(actual / estimate.total if estimate.total else 1.0
+                   for estimate, actual in self.attempts)
+
+    def report(self):
+        """選んだ設定と見積もり・実際のサイズの表（文字列のリスト）"""
+        lines = [f"サンプル: {self.sample_pages}ページ × {len(self.estimates)}候補"
+                 f"（エンコード {self.sample_encoded}, キャッシュ {self.sample_cached}, "
+                 f"{self.seconds:.1f} 秒）"]
+        for estimate, actual in self.attempts:
+            mark = "上限以下" if actual <= self.budget else "上限超過"
+            lines.append(f"{describe(estimate.encoder)}: 見積もり {format_size(estimate.total)}"
+                         f"（±{format_size(estimate.error)}）, 実際 {format_size(actual)}（{mark}）")
+        return lines
+
+
+def _page_bytes(encoded):
+    """エンコードしたページがファイルに占めるバイト数の見積もり"""
+    size = len(encoded.data) + PAGE_OVERHEAD
+    if encoded.thumb is not None:
+        size += len(encoded.thumb.data)
+    return size
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+余白・ウィンドウ枠の自動トリミング
+ウィンドウのキャプチャにはKindleのツールバーや広い余白が含まれるため、
+数ページ分をまとめてNumPyで解析し、本全体（またはセクションごと）で共通の切り抜き範囲を求める。
+ページごとに範囲を変えないので、PDFにしたときにページの位置がずれない。
+"""
+
+# 解析時に間引いた後の幅の目安（ピクセル）
+SAMPLE_WIDTH = 400
+
+# 背景色とみなす色の差
+BACKGROUND_TOLERANCE = 24
+
+# 上下端からこの割合以上が背景色でない行はツールバー等の枠とみなす
+CHROME_ROW_RATIO = 0.5
+
+# 切り抜き範囲に加える余白（ページサイズに対する割合）
+PADDING_RATIO = 0.02
+
+
+def _import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("トリミングにはNumPyが必要です。インストール: pip install numpy")
+    return np
+
+
+def _sample_step(width):
+    return max(width // SAMPLE_WIDTH, 1)
+
+
+def sample_array(source, step):
+    """フレームまたはPIL画像を間引いたRGB配列（高さ, 幅, 3）にする"""
+    np = _import_numpy()
+
+    if hasattr(source, 'buffer'):
+        # フレームのバッファをコピーせずに配列として扱い、間引いたものだけを取り出す
+        bytes_per_pixel = len(source.pixel_format)
+        raw = np.frombuffer(source.buffer, dtype=np.uint8)
+        rows = np.lib.stride_tricks.as_strided(
+            raw, shape=(source.height, source.width * bytes_per_pixel),
+            strides=(source.stride, 1), writeable=False)
+        pixels = rows[::step].reshape(-1, source.width, bytes_per_pixel)[:, ::step]
+        if source.pixel_format == 'L':
+            return np.repeat(pixels, 3, axis=2)
+        channels = [source.pixel_format.index(c) for c in 'RGB']
+        return pixels[:, :, channels]
+
+    img = source.convert('RGB')
+    return np.asarray(img)[::step, ::step]
+
+
+def ink_masks(samples):
+    """間引いた画像のバッチから、背景色（紙の色）でない画素のマスクを求める
+
+    samples: 同じサイズの配列 (高さ, 幅, 3) のリスト
+    戻り値: bool配列 (ページ数, 高さ, 幅)
+    """
+    np = _import_numpy()
+
+    batch = np.stack(samples).astype(np.int16)
+    count = batch.shape[0]
+
+    # ページごとに最も多い色（16階調に量子化）の画素の平均を背景色とする
+    pixels = batch.reshape(count, -1, 3)
+    quantized = pixels >> 4
+    keys = (quantized[:, :, 0] << 8) | (quantized[:, :, 1] << 4) | quantized[:, :, 2]
+    modes = np.array([np.bincount(page_keys, minlength=4096).argmax() for page_keys in keys])
+    in_mode = (keys == modes[:, None])[:, :, None]
+    background = (pixels * in_mode).sum(axis=1) // in_mode.sum(axis=1)
+
+    # 色の軸（長さ3）での max より、チャンネルごとの maximum の方が一桁速い
+    diff = np.abs(batch - background[:, None, None, :])
+    return np.maximum(np.maximum(diff[..., 0], diff[..., 1]), diff[..., 2]) > BACKGROUND_TOLERANCE
+
+
+def page_area(mask):
+    """上下左右の端から、大半が背景色でない行・列（ツールバーや枠）を除いた範囲"""
+    top, bottom = _strip_edges(mask.mean(axis=1))
+    left, right = _strip_edges(mask.mean(axis=0))
+    return (left, top, right, bottom)
+
+
+def _strip_edges(ratios):
+    start = 0
+    end = len(ratios)
+    while start < end and ratios[start] >= CHROME_ROW_RATIO:
+        start += 1
+    while end > start and ratios[end - 1] >= CHROME_ROW_RATIO:
+        end -= 1
+    return start, end
+
+
+def common_area(areas):
+    """ページ領域の中央値（挿絵のページなどの外れ値に左右されないようにする）"""
+    np = _import_numpy()
+
+    return tuple(int(value) for value in np.median(np.array(areas), axis=0))
+
+
+def ink_box(mask, area):
+    """ページ領域内で背景色でない画素を囲む範囲（なければNone）"""
+    np = _import_numpy()
+
+    left, top, right, bottom = area
+    region = mask[top:bottom, left:right]
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    if rows.size == 0:
+        return None
+    return (left + int(cols[0]), top + int(rows[0]),
+            left + int(cols[-1]) + 1, top + int(rows[-1]) + 1)
+
+
+def union_box(boxes, area, size, step):
+    """ページごとの範囲の和に余白を加え、元の解像度の座標にした切り抜き範囲"""
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+
+    width, height = size
+    pad = max(int(max(width, height) * PADDING_RATIO), step)
+    left = max(min(box[0] for box in boxes) * step - pad, area[0] * step)
+    top = max(min(box[1] for box in boxes) * step - pad, area[1] * step)
+    right = min(max(box[2] for box in boxes) * step + pad, area[2] * step, width)
+    bottom = min(max(box[3] for box in boxes) * step + pad, area[3] * step, height)
+    if left >= right or top >= bottom:
+        return None
+    return (left, top, right, bottom)
+
+
+def stable_box(samples, size, step):
+    """間引いた画像のバッチから、共通の切り抜き範囲・ページ領域・ページごとの本文の範囲を求める"""
+    masks = ink_masks(samples)
+    area = common_area([page_area(mask) for mask in masks])
+    boxes = [ink_box(mask, area) for mask in masks]
+    return union_box(boxes, area, size, step), area, boxes
+
+
+def contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+def fits(box, size):
+    """切り抜き範囲が画像の大きさ (幅, 高さ) に収まるか"""
+    return box[2] <= size[0] and box[3] <= size[1]
+
+
+def crop_to_box(img, box):
+    """共通の切り抜き範囲で切り抜く
+
+    範囲が収まらない小さいページ（ウィンドウの大きさを変えた後のページなど）は切り抜かずに返す。
+    どのページが切り抜かれないかは uncropped_pages で確かめられる。
+    """
+    if box and fits(box, img.size):
+        return img.crop(box)
+    return img
+
+
+def uncropped_pages(image_files, box):
+    """保存済みの画像ファイル（またはスプールのページ）のうち、box が収まらず切り抜かないもの
+
+    画像はデコードせず、ファイルのヘッダー（スプールのページは記録した大きさ）だけを読む。
+    """
+    from PIL import Image
+
+    from frame_spool import SpoolPage
+
+    pages = []
+    for path in image_files:
+        if isinstance(path, SpoolPage):
+            size = path.size
+        else:
+            with Image.open(path) as img:
+                size = img.size
+        if not fits(box, size):
+            pages.append(path)
+    return pages
+
+
+def uncropped_warning(image_files, box):
+    """box で切り抜けないページがあれば、それを知らせる警告の文を返す（なければNone）"""
+    from frame_spool import page_name
+
+    pages = uncropped_pages(image_files, box)
+    if not pages:
+        return None
+    names = ", ".join(page_name(path) for path in pages[:3])
+    if len(pages) > 3:
+        names += " など"
+    return f"{len(pages)}ページは共通の切り抜き範囲より小さいため、切り抜かずに書き出します（{names}）"
+
+
+class AutoTrimmer:
+    """キャプチャ中のフレームに共通の切り抜き範囲を適用する
+
+    最初の batch_size ページを解析して切り抜き範囲を決め、それまでのフレームは保留する。
+    以降、範囲からはみ出すページが現れたら範囲を広げて新しいセクションとする。
+    """
+
+    def __init__(self, batch_size=4):
+        self.batch_size = batch_size
+        self.box = None
+        self.sections = 0
+        self._size = None
+        self._step = 1
+        self._area = None
+        self._boxes = []
+        self._pending = []
+        self._samples = []
+
+    def add(self, page_num, frame):
+        """フレームを追加し、切り抜き範囲が決まったものを (page_num, frame, box) のリストで返す"""
+        if self._size is not None and frame.size != self._size:
+            # ウィンドウサイズが変わった場合は解析をやり直す
+            ready = self.flush()
+            self.box = None
+            self._area = None
+            self._boxes = []
+            self._size = None
+            return ready + self.add(page_num, frame)
+        if self._size is None:
+            self._size = frame.size
+            self._step = _sample_step(frame.width)
+
+        sample = sample_array(frame, self._step)
+
+        if self._area is None:
+            self._pending.append((page_num, frame))
+            self._samples.append(sample)
+            if len(self._pending) < self.batch_size:
+                return []
+            return self._release()
+
+        content = ink_box(ink_masks([sample])[0], self._area)
+        if content is not None and not contains(self._scaled(), content):
+            # 範囲からはみ出したページから新しいセクションにする
+            self._boxes.append(content)
+            self.box = union_box(self._boxes, self._area, self._size, self._step)
+            self.sections += 1
+        return [(page_num, frame, self.box)]
+
+    def _scaled(self):
+        """現在の切り抜き範囲を間引いた座標で表したもの"""
+        if self.box is None:
+            return (0, 0, 0, 0)
+        return tuple(value // self._step for value in self.box)
+
+    def _release(self):
+        self.box, self._area, self._boxes = stable_box(self._samples, self._size, self._step)
+        self._boxes = [box for box in self._boxes if box is not None]
+        self.sections += 1
+        ready = [(page_num, frame, self.box) for page_num, frame in self._pending]
+        self._pending = []
+        self._samples = []
+        return ready
+
+    def flush(self):
+        """保留中のフレームを返す（キャプチャ終了時）"""
+        if not self._pending:
+            return []
+        return self._release()
+
+
+def trim_box_for_images(image_files, batch_size=16):
+    """保存済みの画像ファイル全体で共通の切り抜き範囲を求める
+
+    最初のバッチでページ領域を決め、以降はバッチごとに本文の範囲だけを求めるので、
+    ページ数が多くてもメモリ使用量は一定。
+    """
+    from frame_spool import open_page
+
+    size = None
+    step = 1
+    area = None
+    boxes = []
+    batch = []
+
+    def analyze(samples):
+        nonlocal area
+        masks = ink_masks(samples)
+        if area is None:
+            area = common_area([page_area(mask) for mask in masks])
+        boxes.extend(box for box in (ink_box(mask, area) for mask in masks) if box is not None)
+
+    for path in image_files:
+        with open_page(path) as img:
+            if size is None:
+                size = img.size
+                step = _sample_step(img.width)
+            if img.size != size:
+                continue
+            batch.append(sample_array(img, step))
+        if len(batch) >= batch_size:
+            analyze(batch)
+            batch = []
+    if batch:
+        analyze(batch)
+    if area is None:
+        return None
+    return union_box(boxes, area, size, step)